@@ -1,11 +1,28 @@
+import logging
+
 # imports all openGL functions
 from OpenGL.GL import *
+from gldispatch import gl
 
 # and we import a bunch of helper functions
 from matutils import *
 
 from material import Material
 
+from buffers import StreamingBuffer
+
+logger = logging.getLogger(__name__)
+
+
+# OpenGL type of the vertex attributes for each numpy type. Integer types are normalised to [0,1] or [-1,1].
+ATTRIBUTE_TYPES = {
+    np.dtype('float32'): (GL_FLOAT, False),
+    np.dtype('uint16'): (GL_UNSIGNED_SHORT, True),
+    np.dtype('int16'): (GL_SHORT, True),
+    np.dtype('uint8'): (GL_UNSIGNED_BYTE, True),
+    np.dtype('int8'): (GL_BYTE, True),
+}
+
 
 class BaseModel:
     '''
@@ -18,7 +35,7 @@ class BaseModel:
         Initialises the model data
         '''
 
-        print('+ Initializing {}'.format(self.__class__.__name__))
+        logger.debug('+ Initializing %s', self.__class__.__name__)
 
         # if this flag is set to False, the model is not rendered
         self.visible = visible
@@ -51,11 +68,22 @@ class BaseModel:
         # dict of attributes
         self.attributes = {}
 
+        # dict of streaming buffers, for attributes that change every frame
+        self.streams = {}
+
         # store the position of the model in the scene, ...
         self.M = M
 
+        # whether the model can be drawn in the depth pre-pass: its fragments are never discarded or blended
+        self.opaque = True
+
+        # bounding sphere and (min, max) bounding box in model space, see bounding_sphere() and bounding_box()
+        self.center = None
+        self.radius = None
+        self.box = None
+
     def initialise_vbo(self, name, data):
-        print('Initialising VBO for attribute {}'.format(name))
+        logger.debug('Initialising VBO for attribute %s', name)
 
         # bind the GLSL program to find the attribute locations
         # glUseProgram(self.scene.shaders.program)
@@ -65,26 +93,54 @@ class BaseModel:
         self.attributes[name] = len(self.vbos)
 
         if data is None:
-            print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
-                self.__class__.__name__, name))
+            logger.warning('%s.bind_attribute(): Data array for attribute %s is None!',
+                           self.__class__.__name__, name)
             return
 
         # create a buffer object...
-        self.vbos[name] = glGenBuffers(1)
+        self.vbos[name] = gl.glGenBuffers(1)
         # and bind it
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
 
         # ... and we set the data in the buffer as the vertex array
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        gl.glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
 
         # enable the attribute
-        glEnableVertexAttribArray(self.attributes[name])
+        gl.glEnableVertexAttribArray(self.attributes[name])
 
         # Associate the bound buffer to the corresponding input location in the shader
         # Each instance of the vertex shader will get one row of the array
         # so this can be processed in parallel!
-        glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
-                              stride=0, pointer=None)
+        gl_type, normalized = ATTRIBUTE_TYPES.get(data.dtype, (GL_FLOAT, False))
+        gl.glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=gl_type, normalized=normalized,
+                                 stride=0, pointer=None)
+
+    def initialise_stream(self, name, data):
+        '''
+        Replaces the VBO of an attribute by a StreamingBuffer, for data that is rewritten every frame.
+        Write the new data into stream(name), then call commit_stream(name).
+        '''
+        logger.debug('Initialising streaming buffer for attribute %s', name)
+
+        self.streams[name] = StreamingBuffer(data)
+
+        # the static buffer is not needed anymore
+        if name in self.vbos:
+            gl.glDeleteBuffers(1, [self.vbos.pop(name)])
+
+        self.streams[name].bind_attribute(self.attributes[name], self.vao)
+
+    def stream(self, name):
+        '''
+        Returns the array to write the next frame of a streamed attribute into.
+        '''
+        return self.streams[name].map()
+
+    def commit_stream(self, name):
+        '''
+        Sends the frame written into stream(name) to the GPU.
+        '''
+        self.streams[name].commit(self.attributes[name], self.vao)
 
     def bind_all_attributes(self):
         '''
@@ -92,10 +148,10 @@ class BaseModel:
         '''
         for attribute in self.vbos:
             # bind the buffer corresponding to the attribute
-            glBindBuffer(GL_ARRAY_BUFFER, self.vbos[attribute])
+            gl.glBindBuffer(GL_ARRAY_BUFFER, self.vbos[attribute])
 
             # enable the attribute
-            glEnableVertexAttribArray(self.attributes[attribute])
+            gl.glEnableVertexAttribArray(self.attributes[attribute])
 
     def bind(self):
         '''
@@ -104,14 +160,13 @@ class BaseModel:
         '''
 
         # We use a Vertex Array Object to pack all buffers for rendering in the GPU (see lecture on OpenGL)
-        self.vao = glGenVertexArrays(1)
+        self.vao = gl.glGenVertexArrays(1)
 
         # bind the VAO to retrieve all buffers and rendering context
-        glBindVertexArray(self.vao)
+        gl.glBindVertexArray(self.vao)
 
         if self.vertices is None:
-            print('(W) Warning in {}.bind(): No vertex array!'.format(
-                self.__class__.__name__))
+            logger.warning('%s.bind(): No vertex array!', self.__class__.__name__)
 
         # initialise vertex position VBO and link to shader program attribute
         self.initialise_vbo('position', self.vertices)
@@ -120,20 +175,72 @@ class BaseModel:
 
         # if indices are provided, put them in a buffer too
         if self.indices is not None:
-            self.index_buffer = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices, GL_STATIC_DRAW)
+            self.index_buffer = gl.glGenBuffers(1)
+            gl.glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+            gl.glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices, GL_STATIC_DRAW)
 
         # bind all attributes to the correct locations in the VAO
         for name in self.attributes:
-            glBindAttribLocation(self.scene.shaders.program,
-                                 self.attributes[name], name)
-            print('Binding attribute {} to location {}'.format(
-                name, self.attributes[name]))
+            gl.glBindAttribLocation(self.scene.shaders.program,
+                                    self.attributes[name], name)
+            logger.debug('Binding attribute %s to location %s', name, self.attributes[name])
 
         # finally we unbind the VAO and VBO when we're done to avoid side effects
-        glBindVertexArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def bounding_sphere(self):
+        '''
+        Returns the center and radius of a sphere holding the model, computed the first time from the vertices.
+        '''
+        if self.center is None and self.vertices is not None:
+            self.center = 0.5 * (np.max(self.vertices, axis=0) + np.min(self.vertices, axis=0))
+            self.radius = np.max(np.linalg.norm(self.vertices - self.center, axis=1))
+        return self.center, self.radius
+
+    def bounding_box(self):
+        '''
+        Returns the (min, max) corners of a box holding the model, computed the first time from the vertices.
+        '''
+        if self.box is None and self.vertices is not None:
+            self.box = (np.min(self.vertices, axis=0), np.max(self.vertices, axis=0))
+        return self.box
+
+    def draw_depth(self, Mp, shaders):
+        '''
+        Draws the model into the depth buffer only, for the depth pre-pass.
+        :param shaders: The DepthShader
+        '''
+        if not self.visible or self.vertices is None:
+            return
+
+        shaders.bind(P=self.scene.P, V=self.scene.camera.V, M=np.matmul(Mp, self.M), PV=self.scene.camera.PV)
+
+        gl.glBindVertexArray(self.vao)
+        if self.indices is not None:
+            gl.glDrawElements(self.primitive, self.indices.size, GL_UNSIGNED_INT, None)
+        else:
+            gl.glDrawArrays(self.primitive, 0, self.vertices.shape[0])
+        gl.glBindVertexArray(0)
+
+    def bind_shaders(self, Mp, shaders):
+        '''
+        Enables the shader program and sets the matrices, light and material uniforms of the model.
+        '''
+        # tell OpenGL to use this shader program for rendering
+        gl.glUseProgram(shaders.program)
+
+        # setup the shader program and provide it the Model, View and Projection matrices to use
+        # for rendering this model
+        shaders.bind(
+            P=self.scene.P,
+            V=self.scene.camera.V,
+            M=np.matmul(Mp, self.M),
+            mode=self.scene.mode,
+            material=self.material,
+            light=self.scene.light,
+            PV=self.scene.camera.PV
+        )
 
     def draw(self, Mp, shaders):
         '''
@@ -144,38 +251,57 @@ class BaseModel:
         if self.visible:
 
             if self.vertices is None:
-                print('(W) Warning in {}.draw(): No vertex array!'.format(
-                    self.__class__.__name__))
-
-            # tell OpenGL to use this shader program for rendering
-            glUseProgram(shaders.program)
-
-            # setup the shader program and provide it the Model, View and Projection matrices to use
-            # for rendering this model
-            shaders.bind(
-                P=self.scene.P,
-                V=self.scene.camera.V,
-                M=np.matmul(Mp, self.M),
-                mode=self.scene.mode,
-                material=self.material,
-                light=self.scene.light
-            )
+                logger.warning('%s.draw(): No vertex array!', self.__class__.__name__)
+
+            self.bind_shaders(Mp, shaders)
 
             # bind the Vertex Array Object so that all buffers are bound correctly and the following operations affect them
-            glBindVertexArray(self.vao)
+            gl.glBindVertexArray(self.vao)
 
             # check whether the data is stored as vertex array or index array
             if self.indices is not None:
                 # draw the data in the buffer using the index array
-                glDrawElements(self.primitive, self.indices.flatten(
+                gl.glDrawElements(self.primitive, self.indices.flatten(
                 ).shape[0], GL_UNSIGNED_INT, None)
                 pass
             else:
                 # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.vertices.shape[0])
+                gl.glDrawArrays(self.primitive, 0, self.vertices.shape[0])
 
             # unbind the shader to avoid side effects
-            glBindVertexArray(0)
+            gl.glBindVertexArray(0)
+
+    def draw_culled(self, Mp, shaders, culler):
+        '''
+        Draws the model unless its bounding box was hidden behind the models drawn before it.
+        :param culler: The OcclusionCuller of the scene
+        '''
+        box = self.bounding_box()
+        if not self.visible or box is None:
+            self.draw(Mp, shaders)
+            return
+
+        if culler.test(self, np.matmul(Mp, self.M), *box):
+            culler.begin_conditional(self)
+            self.draw(Mp, shaders)
+            culler.end_conditional(self)
+
+    def delete(self):
+        '''
+        Releases the OpenGL buffers of the model.
+        '''
+        if self.vbos:
+            gl.glDeleteBuffers(len(self.vbos), list(self.vbos.values()))
+            self.vbos = {}
+        for stream in self.streams.values():
+            stream.delete()
+        self.streams = {}
+        if getattr(self, 'index_buffer', None) is not None:
+            gl.glDeleteBuffers(1, [self.index_buffer])
+            self.index_buffer = None
+        if getattr(self, 'vao', None) is not None:
+            gl.glDeleteVertexArrays(1, [self.vao])
+            self.vao = None
 
 
 def __del__(self):
@@ -183,4 +309,4 @@ def __del__(self):
     Release all VBO objects when finished.
     '''
     for vbo in self.vbos.items():
-        glDeleteBuffers(1, vbo)
+        gl.glDeleteBuffers(1, vbo)
@@ -1,11 +1,22 @@
+import ctypes
+import logging
+
 # imports all openGL functions
 from OpenGL.GL import *
+from gldispatch import gl
 
 # and we import a bunch of helper functions
 from matutils import *
 
 from material import Material
 from BaseModel import BaseModel
+from sampling import SurfaceSampler
+from furcache import fur_key
+from furdynamics import FurDynamics
+from furcompact import encode_strands
+from ShellFurModel import ShellFurModel
+
+logger = logging.getLogger(__name__)
 
 
 class FurModel(BaseModel):
@@ -13,9 +24,27 @@ class FurModel(BaseModel):
     Fur model. Can be instansiated with the vertices, normals, and indices from any model. Will create a separate mesh that adds fur. 
     """
 
-    def __init__(self, scene, vertices, normals, indices, fur_length=0.2, fur_angle=0, fur_density=0, M=poseMatrix(), material=None, primitive=GL_LINES, visible=True):
+    # the fur is drawn as strands, as shells and fins (see ShellFurModel), or as shells when far away
+    TECHNIQUES = ('strands', 'shells', 'auto')
+
+    # in auto mode, shells are used when the model covers less than this radius on screen, in pixels
+    SHELL_SCREEN_SIZE = 150
+
+    # sampled strands are grouped in the cells of a CLUSTER_GRID^3 grid over the mesh, each cluster being
+    # tested for occlusion on its own (see draw_culled)
+    CLUSTER_GRID = 4
+
+    def __init__(self, scene, vertices, normals, indices, fur_length=0.2, fur_angle=0, fur_density=0, M=poseMatrix(), material=None, primitive=GL_LINES, visible=True, fur_count=None, sampler=None, seed=0, slot=None, upload=True, compact=False, technique='strands'):
         """
         Initialises the model data
+        :param fur_count: [optional] If set, exactly this many strands are rooted uniformly over the surface, instead of at the vertices and face centroids
+        :param sampler: [optional] The SurfaceSampler of the mesh, to avoid rebuilding its area table
+        :param seed: The seed used to sample the roots, so that changing other parameters keeps the same roots
+        :param slot: [optional] Identifies the fur models that replace each other when parameters change
+        :param upload: Whether to create the OpenGL buffers now. Set to False to build the fur outside of the
+                       OpenGL thread, and call bind() later.
+        :param compact: Whether to store the strands with quantized positions and octahedral normals (needs fur_count)
+        :param technique: One of TECHNIQUES
         """
         BaseModel.__init__(self, scene=scene, M=M,
                            primitive=primitive, visible=visible)
@@ -29,9 +58,39 @@ class FurModel(BaseModel):
         self.fur_length = fur_length
         self.fur_angle = fur_angle
         self.fur_density = fur_density
+        self.fur_count = fur_count
+
+        self.sampler = sampler
+        self.seed = seed
+
+        self.compact = compact
+
+        self.technique = technique
+        self.shells = None
+
+        # thin lines gain little from the depth pre-pass
+        self.opaque = False
+
+        # bounding sphere of the fur, to choose the technique from its size on screen, to sort and to cull the model
+        # (see BaseModel.bounding_sphere()). It is computed from the mesh rather than from the strands, so that it
+        # also holds the compact fur, stored in the units of its encoding, and the strands moved by the dynamics.
+        self.center = 0.5 * (np.max(vertices, axis=0) + np.min(vertices, axis=0))
+        self.radius = np.max(np.linalg.norm(vertices - self.center, axis=1)) + fur_length
+
+        # bounding box of the mesh, and of the fur around it
+        self.mesh_box = (np.min(vertices, axis=0), np.max(vertices, axis=0))
+        self.box = (self.mesh_box[0] - fur_length, self.mesh_box[1] + fur_length)
+
+        # models rebuilt from this one share its slot
+        self.slot = slot if slot is not None else object()
 
         self.initialise_vertices()
 
+        # (starts, counts, box minimums, box maximums) of the clusters of strands, None for the legacy fur
+        self.clusters = None
+        if self.fur_count is not None:
+            self.initialise_clusters()
+
         self.vertex_colors = None
 
         # Sets the colour of the fur.
@@ -41,12 +100,287 @@ class FurModel(BaseModel):
             Ks=np.array([176/255, 119/255, 85/255], "f"),
             Ns=10.0,
         )
-        self.bind()
+
+        # strand simulation, see enable_dynamics()
+        self.dynamics = None
+        self.pool = None
+
+        # bounding box of the compact encoding, None if the strands are stored as floats
+        self.bbox_min = None
+        self.bbox_extent = None
+        if self.compact:
+            self.initialise_compact()
+
+        if upload:
+            self.bind()
+
+    def parameters(self):
+        '''
+        Returns the arguments needed to re-create this model with its current parameters.
+        '''
+        return {
+            'scene': self.scene,
+            'vertices': self.initial_vertices,
+            'normals': self.initial_normals,
+            'indices': self.initial_indices,
+            'fur_length': self.fur_length,
+            'fur_angle': self.fur_angle,
+            'fur_density': self.fur_density,
+            'M': self.M,
+            'material': self.material,
+            'primitive': self.primitive,
+            'visible': self.visible,
+            'fur_count': self.fur_count,
+            'sampler': self.sampler,
+            'seed': self.seed,
+            'compact': self.compact,
+            'technique': self.technique,
+        }
+
+    def cluster_cells(self, roots):
+        '''
+        Returns the index of the cell of the cluster grid holding each root.
+        '''
+        low, high = self.mesh_box
+        grid = self.CLUSTER_GRID
+        cells = np.clip(((roots - low) / np.maximum(high - low, 1e-6) * grid).astype(int), 0, grid - 1)
+        return (cells[:, 0] * grid + cells[:, 1]) * grid + cells[:, 2]
+
+    def initialise_clusters(self):
+        '''
+        Splits the strands into clusters of consecutive strands rooted in the same cell of the grid. The strands
+        are generated sorted by cell, so that each cell is a single cluster.
+        '''
+        strands = np.asarray(self.vertices).reshape(-1, 4, 3)
+        if strands.shape[0] == 0:
+            return
+
+        cells = self.cluster_cells(strands[:, 0])
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        counts = np.diff(np.r_[starts, strands.shape[0]])
+
+        # the boxes are padded by the length of the strands, which may bend any way under the dynamics
+        lows = np.minimum.reduceat(np.min(strands, axis=1), starts) - self.fur_length
+        highs = np.maximum.reduceat(np.max(strands, axis=1), starts) + self.fur_length
+        self.clusters = (starts, counts, lows, highs)
+
+    def initialise_compact(self):
+        '''
+        Replaces the strand arrays by their compact encoding, decoded by the FurCompact shader. See furcompact.
+        '''
+        if self.fur_count is None:
+            logger.warning('FurModel.initialise_compact(): compact fur needs fur_count to be set.')
+            return
+
+        self.vertices, self.normals, self.indices, self.bbox_min, self.bbox_extent = encode_strands(
+            self.vertices, self.normals)
+
+    def use_shells(self, Mp):
+        '''
+        Returns whether the fur is drawn as shells and fins this frame.
+        '''
+        if self.technique == 'auto':
+            size = self.scene.camera.projected_size(np.matmul(Mp, self.M), self.center, self.radius)
+            return size < self.SHELL_SCREEN_SIZE
+        return self.technique == 'shells'
+
+    def shell_model(self):
+        '''
+        Returns the shells and fins version of this fur, created the first time it is drawn.
+        '''
+        if self.shells is None:
+            self.shells = ShellFurModel(self.scene, self.initial_vertices, self.initial_normals, self.initial_indices,
+                                        fur_length=self.fur_length, M=self.M, material=self.material)
+        self.shells.M = self.M
+        self.shells.visible = self.visible
+        return self.shells
+
+    def strand_shaders(self, shaders):
+        '''
+        Returns the shaders drawing the strands: the compact fur is decoded by its own shader.
+        '''
+        if self.bbox_min is not None:
+            shaders = self.scene.shaders_list['FurCompact']
+            shaders.set_bounding_box(self.bbox_min, self.bbox_extent)
+        return shaders
+
+    def draw(self, Mp, shaders):
+        if self.use_shells(Mp):
+            self.shell_model().draw(Mp, shaders)
+            return
+
+        BaseModel.draw(self, Mp, self.strand_shaders(shaders))
+
+    def draw_culled(self, Mp, shaders, culler):
+        '''
+        Draws the fur, skipping the clusters of strands hidden behind the models drawn before it, such as the
+        fur on the far side of the model. The queries are keyed by slot, so that the models rebuilt from this one
+        carry on with them.
+        '''
+        if not self.visible:
+            return
+
+        M = np.matmul(Mp, self.M)
+        if self.clusters is None or self.use_shells(Mp):
+            if culler.test(self.slot, M, *self.box):
+                culler.begin_conditional(self.slot)
+                self.draw(Mp, shaders)
+                culler.end_conditional(self.slot)
+            return
+
+        starts, counts, lows, highs = self.clusters
+        visible = [i for i in range(starts.shape[0]) if culler.test((self.slot, i), M, lows[i], highs[i])]
+        if not visible:
+            return
+
+        self.bind_shaders(Mp, self.strand_shaders(shaders))
+        gl.glBindVertexArray(self.vao)
+        for i in visible:
+            culler.begin_conditional((self.slot, i))
+            # 4 vertices, or 4 indices, per strand
+            if self.indices is not None:
+                gl.glDrawElements(self.primitive, 4 * int(counts[i]), GL_UNSIGNED_INT,
+                                  ctypes.c_void_p(16 * int(starts[i])))
+            else:
+                gl.glDrawArrays(self.primitive, 4 * int(starts[i]), 4 * int(counts[i]))
+            culler.end_conditional((self.slot, i))
+        gl.glBindVertexArray(0)
+
+    def delete(self):
+        self.disable_dynamics(reset=False)
+        if self.shells is not None:
+            self.shells.delete()
+            self.shells = None
+        BaseModel.delete(self)
+
+    def enable_dynamics(self, workers=1):
+        '''
+        Starts simulating the strands. Only sampled fur (fur_count set) has one clean line strip per strand.
+        :param workers: The number of processes sharing the simulation. With more than one, the strands are
+                        split between worker processes and each frame shows the step computed during the previous one.
+        '''
+        if self.fur_count is None:
+            logger.warning('FurModel.enable_dynamics(): dynamics need fur_count to be set.')
+            return
+
+        if self.bbox_min is not None:
+            logger.warning('FurModel.enable_dynamics(): compact fur cannot be simulated.')
+            return
+
+        # the cached arrays may be read-only memory maps
+        self.vertices = np.array(self.vertices, dtype='f')
+        self.dynamics = FurDynamics(self.vertices)
+
+        self.pool = None
+        if workers > 1:
+            # multiprocessing is slow to import, and only needed once dynamics are turned on
+            from furpool import FurSimulationPool
+            self.pool = FurSimulationPool(self.dynamics, self.vertices, workers)
+
+        # the positions are rewritten every frame
+        if 'position' not in self.streams:
+            self.initialise_stream('position', self.vertices)
+
+        # motion of the model, to apply its inertia to the strands
+        self.previous_position = None
+        self.previous_velocity = np.zeros(3, 'f')
+
+    def disable_dynamics(self, reset=True):
+        '''
+        Stops simulating the strands.
+        :param reset: Whether to put the strands back in their rest pose
+        '''
+        if self.dynamics is None:
+            return
+
+        # the vertices may be a view of the pool's shared memory, or of the mapped stream: keep a copy that
+        # outlives them
+        self.vertices = np.array(self.vertices, dtype='f')
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+        if reset:
+            self.dynamics.mid[...] = self.dynamics.rest_mid
+            self.dynamics.tip[...] = self.dynamics.rest_tip
+            view = self.stream('position')
+            self.dynamics.write(view)
+            self.commit_stream('position')
+            self.vertices = np.array(view)
+
+        self.dynamics = None
+
+    def step(self, dt, gravity, wind, steps=1):
+        '''
+        Advances the strand simulation and streams the new positions to the position buffer.
+        :param dt: The duration of a simulation step, in seconds
+        :param gravity: The gravity acceleration in world space
+        :param wind: The wind acceleration in world space
+        :param steps: The number of steps of dt to simulate before the positions are streamed
+        '''
+        if self.dynamics is None or dt <= 0 or steps <= 0:
+            return
+
+        # the model moving one way pushes the strands the other way
+        elapsed = dt * steps
+        position = np.array(self.M[:3, 3], 'f')
+        if self.previous_position is None:
+            self.previous_position = position
+        velocity = (position - self.previous_position) / elapsed
+        inertia = -(velocity - self.previous_velocity) / elapsed
+        self.previous_position = position
+        self.previous_velocity = velocity
+
+        # the simulation runs in model space
+        world_to_model = np.linalg.inv(self.M[:3, :3])
+        acceleration = np.dot(world_to_model, np.asarray(gravity) + inertia)
+        wind = np.dot(world_to_model, wind)
+
+        if self.pool is not None:
+            # show the step finished by the workers, and start the next one
+            if self.pool.wait():
+                self.vertices = self.streams['position'].write(self.pool.vertices)
+                self.commit_stream('position')
+            self.pool.submit(dt, acceleration, wind, steps)
+        else:
+            # the strands are written straight into the buffer memory
+            for _ in range(steps):
+                self.dynamics.step(dt, acceleration, wind)
+            self.vertices = self.stream('position')
+            self.dynamics.write(self.vertices)
+            self.commit_stream('position')
 
     def initialise_vertices(self):
         '''
-        Initialises the vertices that will be rendered according to the fur parameters
+        Initialises the vertices that will be rendered according to the fur parameters.
+        The result is looked up in the fur cache of the scene first, if it has one.
+        '''
+        cache = getattr(self.scene, 'fur_cache', None)
+        if cache is None:
+            self.generate_vertices()
+            return
+
+        key = fur_key(self.initial_vertices, self.initial_normals, self.initial_indices,
+                      self.fur_length, self.fur_angle, self.fur_density, self.fur_count, self.seed,
+                      self.CLUSTER_GRID)
+
+        cached = cache.get(key)
+        if cached is not None:
+            self.vertices, self.normals = cached
+            return
+
+        self.generate_vertices()
+        cache.put(key, self.vertices, self.normals)
+
+    def generate_vertices(self):
+        '''
+        Generates the fur vertices and normals from the fur parameters
         '''
+        if self.fur_count is not None:
+            self.initialise_sampled_vertices()
+            return
+
         # Create a deep copy so that the initials are not modified
         initial_vertices_copy = self.initial_vertices[:]
         initial_normals_copy = self.initial_normals[:]
@@ -99,6 +433,46 @@ class FurModel(BaseModel):
         self.vertices = new_vertices
         self.normals = new_normals
 
+    def initialise_sampled_vertices(self):
+        '''
+        Initialises exactly fur_count strands, with roots sampled uniformly over the surface of the model.
+        '''
+        if self.sampler is None:
+            self.sampler = SurfaceSampler(
+                self.initial_vertices, self.initial_normals, self.initial_indices)
+
+        roots, normals = self.sampler.sample(self.fur_count, seed=self.seed)
+
+        # neighbouring strands are stored together, see initialise_clusters()
+        order = np.argsort(self.cluster_cells(roots), kind='stable')
+        roots, normals = roots[order], normals[order]
+
+        self.vertices, self.normals = self.build_strands(roots, normals)
+
+    def build_strands(self, roots, normals):
+        '''
+        Builds the line segments of all strands at once. Each strand is a straight section along the
+        normal followed by an angled section, stored as 4 vertices (root, midpoint, midpoint, endpoint).
+        :param roots: The (N, 3) array of root positions
+        :param normals: The (N, 3) array of root normals
+        :return: The (4N, 3) vertex and normal arrays
+        '''
+        fur_length_a = self.fur_length / 3
+        fur_length_b = self.fur_length * (2/3)
+
+        midpoints = roots + normals * fur_length_a
+
+        # the angled section is the same for all strands
+        offset = np.array([
+            np.cos(self.fur_angle) * np.cos(self.fur_angle) * fur_length_b,
+            np.sin(self.fur_angle) * fur_length_b,
+            fur_length_b * np.sin(self.fur_angle) * np.cos(self.fur_angle),
+        ], 'f')
+        endpoints = midpoints + offset
+
+        vertices = np.stack((roots, midpoints, midpoints, endpoints), axis=1)
+        return vertices.reshape(-1, 3).astype('f'), np.repeat(normals, 4, axis=0).astype('f')
+
     def curvy_hair(self, vertex, normal, vertices, normals, fur_length):
         '''
         Deprecated fancy hair function. Created a smoother arc for the fur but was too resource intensive :(
@@ -0,0 +1,152 @@
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+# and we import a bunch of helper functions
+from matutils import *
+
+from material import Material
+from BaseModel import BaseModel
+from simplify import triangulate
+
+
+def build_fins(vertices, normals, faces, seed=0):
+    '''
+    Builds one fin per edge of a mesh: a quad standing on the edge, extruded along the vertex normals.
+    :param vertices: The (N, 3) vertex array
+    :param normals: The (N, 3) unit vertex normals
+    :param faces: The (F, 3) triangle index array
+    :param seed: The seed of the random offsets of the strand pattern along each fin
+    :return: positions, normals, fin coordinates (distance along the edge, height), fin plane normals and the
+             triangle indices of the fins
+    '''
+    edges = np.sort(np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+    edges = np.unique(edges, axis=0)
+    a, b = edges[:, 0], edges[:, 1]
+
+    edge = vertices[b] - vertices[a]
+    length = np.linalg.norm(edge, axis=1)
+    plane = np.cross(edge, normals[a] + normals[b])
+    plane /= np.maximum(np.linalg.norm(plane, axis=1, keepdims=True), 1e-12)
+
+    # the 4 corners of each fin: the root and tip of a, then of b
+    corners = np.stack((a, a, b, b), axis=1).reshape(-1)
+    offset = np.random.default_rng(seed).uniform(0., 1000., edges.shape[0])
+    coords = np.stack((
+        np.stack((offset, offset, offset + length, offset + length), axis=1),
+        np.tile([0., 1., 0., 1.], (edges.shape[0], 1)),
+    ), axis=2).reshape(-1, 2)
+
+    first = 4 * np.arange(edges.shape[0], dtype=np.uint32)[:, None]
+    indices = (first + np.array([0, 2, 3, 0, 3, 1], dtype=np.uint32)).reshape(-1, 3)
+
+    return (vertices[corners].astype('f'), normals[corners].astype('f'), coords.astype('f'),
+            np.repeat(plane, 4, axis=0).astype('f'), indices)
+
+
+class ShellFurModel(BaseModel):
+    '''
+    Fur drawn as shells and fins, a cheaper alternative to the strands of FurModel: the base mesh is drawn
+    shell_count times, each copy pushed further along the normals, and a procedural mask discards the
+    fragments between the strands. Fins standing on the edges of the mesh fill in the silhouette, where the
+    shells are seen edge on. The cost depends on the number of shells and the size of the mesh, not on the
+    number of strands.
+    '''
+
+    def __init__(self, scene, vertices, normals, indices, fur_length=0.2, shell_count=16, strand_density=60.,
+                 M=poseMatrix(), material=None, visible=True, upload=True):
+        '''
+        :param fur_length: The length of the strands
+        :param shell_count: The number of shells
+        :param strand_density: The number of strands per unit of length along the surface
+        :param upload: Whether to create the OpenGL buffers now
+        '''
+        BaseModel.__init__(self, scene=scene, M=M, primitive=GL_TRIANGLES, visible=visible)
+
+        self.fur_length = fur_length
+        self.shell_count = shell_count
+        self.strand_density = strand_density
+
+        self.vertices = np.asarray(vertices, dtype='f')
+        self.normals = np.asarray(normals, dtype='f')
+        self.normals = self.normals / np.maximum(np.linalg.norm(self.normals, axis=1, keepdims=True), 1e-12)
+        self.indices = triangulate(np.asarray(indices)).astype(np.uint32)
+
+        (self.fin_vertices, self.fin_normals, self.fin_coords,
+         self.fin_planes, self.fin_indices) = build_fins(self.vertices, self.normals, self.indices)
+
+        # same colours as the strands
+        self.material = material if material is not None else Material(
+            Ka=np.array([67/255, 45/255, 31/255], "f"),
+            Kd=np.array([75/255, 63/255, 34/255], "f"),
+            Ks=np.array([176/255, 119/255, 85/255], "f"),
+            Ns=10.0,
+        )
+
+        if upload:
+            self.bind()
+
+    def bind(self):
+        '''
+        Creates one vertex array for the shells and one for the fins.
+        '''
+        self.vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vao)
+        self.initialise_vbo('position', self.vertices)
+        self.initialise_vbo('normal', self.normals)
+        self.index_buffer = gl.glGenBuffers(1)
+        gl.glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        gl.glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices, GL_STATIC_DRAW)
+
+        # the fins use the attribute locations of ShellFurShader
+        self.fin_vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.fin_vao)
+        self.fin_vbos = gl.glGenBuffers(4)
+        for location, (vbo, data) in enumerate(zip(
+                self.fin_vbos, (self.fin_vertices, self.fin_normals, self.fin_coords, self.fin_planes))):
+            gl.glBindBuffer(GL_ARRAY_BUFFER, vbo)
+            gl.glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+            gl.glEnableVertexAttribArray(location)
+            gl.glVertexAttribPointer(index=location, size=data.shape[1], type=GL_FLOAT, normalized=False,
+                                     stride=0, pointer=None)
+        self.fin_index_buffer = gl.glGenBuffers(1)
+        gl.glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.fin_index_buffer)
+        gl.glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.fin_indices, GL_STATIC_DRAW)
+
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def draw(self, Mp, shaders):
+        if not self.visible:
+            return
+
+        shaders = self.scene.shaders_list['FurShells']
+        shaders.set_fur(self.fur_length, self.shell_count, self.strand_density, fins=False)
+        shaders.bind(
+            P=self.scene.P,
+            V=self.scene.camera.V,
+            M=np.matmul(Mp, self.M),
+            mode=self.scene.mode,
+            material=self.material,
+            light=self.scene.light,
+            PV=self.scene.camera.PV
+        )
+
+        # all the shells in one call, the shader offsets each instance along the normals
+        gl.glBindVertexArray(self.vao)
+        gl.glDrawElementsInstanced(GL_TRIANGLES, self.indices.size, GL_UNSIGNED_INT, None, self.shell_count)
+
+        # the fins are seen from both sides
+        shaders.set_fins(True)
+        gl.glDisable(GL_CULL_FACE)
+        gl.glBindVertexArray(self.fin_vao)
+        gl.glDrawElements(GL_TRIANGLES, self.fin_indices.size, GL_UNSIGNED_INT, None)
+        gl.glEnable(GL_CULL_FACE)
+
+        gl.glBindVertexArray(0)
+
+    def delete(self):
+        gl.glDeleteBuffers(len(self.vbos), list(self.vbos.values()))
+        gl.glDeleteBuffers(4, self.fin_vbos)
+        gl.glDeleteBuffers(2, [self.index_buffer, self.fin_index_buffer])
+        gl.glDeleteVertexArrays(2, [self.vao, self.fin_vao])
@@ -0,0 +1,281 @@
+import argparse
+import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from log import setup_logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Offline batch renderer: renders turntables of furry models for every combination of fur parameters, across a
+pool of processes each drawing off screen in its own OpenGL context. For example, 5 fur lengths of the bunny
+and the torus, seen from 2 heights with 36 frames per orbit:
+
+    python batch.py --models bunny torus --fur-length 0.1:0.5:5 --elevation 0,30 --frames 36 --output renders
+
+Each parameter takes a value, a comma separated list of values, or start:stop:count for count evenly
+spaced values. The images are written to <output>/<model>_<parameters>/elevation<degrees>_<frame>.png.
+With --overdraw, the overdraw of each frame is written next to them, to overdraw.csv.
+'''
+
+# models known by name, other names are read as paths to object files
+MODELS = {
+    'bunny': 'models/bunny_world.obj',
+    'torus': 'models/torus.obj',
+}
+
+
+def parse_range(text, kind=float):
+    '''
+    Parses the values of a parameter.
+    :param text: A value, a comma separated list of values, or start:stop:count
+    :param kind: The type of the values
+    :return: The list of values
+    '''
+    if ':' in text:
+        start, stop, count = text.split(':')
+        values = np.linspace(float(start), float(stop), int(count))
+        return [kind(round(value, 6)) if kind is float else kind(round(value)) for value in values]
+    return [kind(value) for value in text.split(',')]
+
+
+def build_jobs(args):
+    '''
+    Returns one job per model and combination of fur parameters. All the orbits of a job share its fur.
+    '''
+    # the density only changes the vertex based fur: the sampled fur would be rendered again for each value
+    densities = parse_range(args.fur_density, int) if args.fur_count == 0 else [0]
+
+    jobs = []
+    for model, length, angle, density in itertools.product(
+            args.models, parse_range(args.fur_length), parse_range(args.fur_angle), densities):
+        name = os.path.splitext(os.path.basename(model))[0]
+        jobs.append({
+            'name': '{}_length{:g}_angle{:g}_density{:d}'.format(name, length, angle, density),
+            'path': MODELS.get(model, model),
+            'fur_length': length,
+            'fur_angle': angle,
+            'fur_density': density,
+        })
+    return jobs
+
+
+class BatchWorker:
+    '''
+    Renders jobs in one process, into a framebuffer object the size of the images.
+    '''
+
+    def __init__(self, width, height, fur_count, technique, elevations, frames, distance, output, extension,
+                 overdraw=False, depth_prepass=False):
+        self.open_window(width, height)
+
+        # the OpenGL modules are only imported in the worker processes
+        from OpenGL.GL import glGenFramebuffers, glBindFramebuffer, glGenRenderbuffers, glBindRenderbuffer, \
+            glRenderbufferStorage, glFramebufferRenderbuffer, glCheckFramebufferStatus, GL_FRAMEBUFFER, \
+            GL_RENDERBUFFER, GL_RGBA8, GL_DEPTH_COMPONENT24, GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT, \
+            GL_FRAMEBUFFER_COMPLETE
+        from scene import Scene
+        from readback import AsyncReadback, ImageWriter
+
+        self.fur_count = fur_count
+        self.technique = technique
+        self.elevations = elevations
+        self.frames = frames
+        self.distance = distance
+        self.output = output
+        self.extension = extension
+        # whether the fragments shaded per frame are counted, see Scene.measure_overdraw()
+        self.overdraw = overdraw
+
+        self.scene = Scene(width, height, max_fps=None, idle=False, visible=False)
+        self.scene.depth_prepass = depth_prepass
+
+        # the default framebuffer of a hidden window may not be drawn at all
+        self.framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        self.renderbuffers = glGenRenderbuffers(2)
+        for renderbuffer, storage, attachment in zip(
+                self.renderbuffers, (GL_RGBA8, GL_DEPTH_COMPONENT24), (GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT)):
+            glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, storage, width, height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('BatchWorker: incomplete framebuffer')
+
+        self.readback = AsyncReadback(width, height)
+        self.writer = ImageWriter()
+
+        # base models, by path
+        self.models = {}
+
+    def open_window(self, width, height):
+        '''
+        Called before OpenGL is imported and the scene creates its window. Override to provide another
+        OpenGL context.
+        '''
+        pass
+
+    def model(self, path):
+        '''
+        Returns the base model of an object file, loaded the first time.
+        '''
+        if path not in self.models:
+            from blender import load_obj_file
+            from main import DrawModelFromMesh
+            from matutils import poseMatrix
+
+            mesh = load_obj_file(path)[0]
+            self.models[path] = DrawModelFromMesh(scene=self.scene, M=poseMatrix(), mesh=mesh)
+        return self.models[path]
+
+    def render(self, job):
+        '''
+        Renders the orbits of a job.
+        :return: The number of frames rendered, the time taken, the id of the process, and the mean overdraw
+                 (None unless counted)
+        '''
+        from FurModel import FurModel
+
+        start = time.perf_counter()
+
+        base = self.model(job['path'])
+        fur = FurModel(scene=self.scene, vertices=base.vertices, normals=base.normals, indices=base.indices,
+                       M=base.M, material=base.material, fur_length=job['fur_length'], fur_angle=job['fur_angle'],
+                       fur_density=job['fur_density'], fur_count=self.fur_count or None, technique=self.technique)
+        self.scene.models = [base, fur]
+
+        # (elevation, frame, statistics) of each frame, when the overdraw is counted
+        overdraw = []
+
+        camera = self.scene.camera
+        camera.distance = self.distance
+        for elevation in self.elevations:
+            camera.psi = -math.radians(elevation)
+            for i in range(self.frames):
+                camera.phi = 2. * math.pi * i / self.frames
+                if self.overdraw:
+                    # waits for the frame to finish, to read the number of fragments back
+                    overdraw.append((elevation, i, self.scene.measure_overdraw()))
+                else:
+                    self.scene.redraw = True
+                    self.scene.draw()
+
+                file_name = os.path.join(self.output, job['name'], 'elevation{:g}_{:04d}.{}'.format(
+                    elevation, i, self.extension))
+                for name, pixels in self.readback.read(file_name):
+                    self.writer.write(name, pixels)
+
+        for name, pixels in self.readback.flush():
+            self.writer.write(name, pixels)
+        self.writer.wait()
+
+        fur.delete()
+        mean = self.write_overdraw(job, overdraw) if self.overdraw else None
+        return len(self.elevations) * self.frames, time.perf_counter() - start, os.getpid(), mean
+
+    def write_overdraw(self, job, overdraw):
+        '''
+        Writes the overdraw statistics of the frames of a job to overdraw.csv, and logs the mean of each orbit.
+        :param overdraw: The list of (elevation, frame, statistics) of the frames
+        :return: The mean overdraw of the job
+        '''
+        directory = os.path.join(self.output, job['name'])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'overdraw.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['elevation', 'frame', 'fragments', 'pixels', 'overdraw'])
+            for elevation, i, stats in overdraw:
+                writer.writerow([elevation, i, stats['fragments'], stats['pixels'],
+                                 '{:.4f}'.format(stats['overdraw'])])
+
+        for elevation in self.elevations:
+            values = [stats['overdraw'] for e, _, stats in overdraw if e == elevation]
+            logger.info('%s, elevation %g: overdraw %.2f (max %.2f)', job['name'], elevation,
+                        np.mean(values), np.max(values))
+        return float(np.mean([stats['overdraw'] for _, _, stats in overdraw]))
+
+
+# the worker of the current process, see initialise_worker()
+worker = None
+
+
+def initialise_worker(level, *args):
+    global worker
+    setup_logging(level)
+    worker = BatchWorker(*args)
+
+
+def render_job(job):
+    return job['name'], worker.render(job)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Renders turntables of furry models for ranges of fur parameters')
+    parser.add_argument('--models', nargs='+', default=['bunny'],
+                        help='model names ({}) or paths to object files'.format(', '.join(MODELS)))
+    parser.add_argument('--fur-length', default='0.2', help='fur lengths')
+    parser.add_argument('--fur-angle', default='0', help='fur angles')
+    parser.add_argument('--fur-density', default='0', help='fur densities, only used when --fur-count is 0')
+    parser.add_argument('--fur-count', type=int, default=8192, help='number of strands, 0 for the vertex based fur')
+    parser.add_argument('--technique', default='strands', help='fur technique: strands, shells or auto')
+    parser.add_argument('--elevation', default='0', help='heights of the orbits, in degrees')
+    parser.add_argument('--frames', type=int, default=36, help='frames per orbit')
+    parser.add_argument('--distance', type=float, default=5., help='distance of the camera to the model')
+    parser.add_argument('--size', type=int, nargs=2, default=(640, 480), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--format', default='png', help='image file format')
+    parser.add_argument('--depth-prepass', action='store_true',
+                        help='draw the opaque models into the depth buffer first')
+    parser.add_argument('--overdraw', action='store_true',
+                        help='count the fragments shaded per covered pixel, written to overdraw.csv for each job')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of processes')
+    parser.add_argument('--output', default='renders', help='output directory')
+    parser.add_argument('--quiet', action='store_true', help='only print warnings and errors')
+    args = parser.parse_args(argv)
+    if args.fur_count != 0 and args.fur_density != '0':
+        parser.error('--fur-density is only used by the vertex based fur, set --fur-count 0')
+
+    level = logging.WARNING if args.quiet else logging.INFO
+    setup_logging(level)
+
+    jobs = build_jobs(args)
+    workers = max(1, min(args.workers, len(jobs)))
+    logger.info('Rendering %d jobs of %d frames with %d workers', len(jobs),
+                len(parse_range(args.elevation)) * args.frames, workers)
+
+    start = time.perf_counter()
+    statistics = {}
+    initargs = (level, args.size[0], args.size[1], args.fur_count, args.technique, parse_range(args.elevation),
+                args.frames, args.distance, args.output, args.format, args.overdraw, args.depth_prepass)
+    with multiprocessing.Pool(workers, initializer=initialise_worker, initargs=initargs) as pool:
+        for name, (frames, seconds, pid, overdraw) in pool.imap_unordered(render_job, jobs):
+            if overdraw is None:
+                logger.info('%s: %d frames in %.2fs', name, frames, seconds)
+            else:
+                logger.info('%s: %d frames in %.2fs, overdraw %.2f', name, frames, seconds, overdraw)
+            total = statistics.setdefault(pid, [0, 0.])
+            total[0] += frames
+            total[1] += seconds
+
+        # the workers are stopped with their task queue: SDL catches the signal sent by terminate()
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+
+    # throughput of each worker while rendering, then of the whole pool including the start up
+    for pid, (frames, seconds) in sorted(statistics.items()):
+        logger.info('worker %d: %d frames, %.1f fps', pid, frames, frames / max(seconds, 1e-9))
+    frames = sum(total[0] for total in statistics.values())
+    logger.info('%d frames in %.2fs: %.1f fps, %.1f fps per worker', frames, elapsed, frames / elapsed,
+                frames / elapsed / workers)
+    return statistics
+
+
+if __name__ == '__main__':
+    main()
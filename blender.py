@@ -1,8 +1,13 @@
+import logging
+import os
+
 import numpy as np
 
-from material import Material, MaterialLibrary
+from material import Material, MaterialLibrary, material_registry
 from mesh import Mesh
 
+logger = logging.getLogger(__name__)
+
 '''
 Functions for reading models from blender. 
 Source: 
@@ -27,19 +32,19 @@ def process_line(line):
     elif fields[0] == 'v':
         label = 'vertex'
         if len(fields) != 4:
-            print('(E) Error, 3 entries expected for vertex')
+            logger.error('3 entries expected for vertex')
             return None
 
     elif fields[0] == 'vt':
         label = 'vertex texture'
         if len(fields) != 3:
-            print('(E) Error, 2 entries expected for vertex texture')
+            logger.error('2 entries expected for vertex texture')
             return None
 
     elif fields[0] == 'mtllib':
         label = 'material library'
         if len(fields) != 2:
-            print('(E) Error, material library file name missing')
+            logger.error('material library file name missing')
             return None
         else:
             return (label, fields[1])
@@ -47,7 +52,7 @@ def process_line(line):
     elif fields[0] == 'usemtl':
         label = 'material'
         if len(fields) != 2:
-            print('(E) Error, material file name missing')
+            logger.error('material file name missing')
             return None
         else:
             return (label, fields[1])
@@ -60,7 +65,7 @@ def process_line(line):
     elif fields[0] == 'f':
         label = 'face'
         if len(fields) != 4 and len(fields) != 5:
-            print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(line))
+            logger.error('3 or 4 entries expected for faces\n%s', line)
             return None
 
         # multiple formats for faces lines, eg
@@ -72,17 +77,20 @@ def process_line(line):
         return (label, [[np.uint32(i) for i in v.split('/')] for v in fields[1:]])
 
     else:
-        print('(E) Unknown line: {}'.format(fields))
+        logger.debug('Unknown line: %s', fields)
         return None
 
     return (label, [float(token) for token in fields[1:]])
 
 
 def load_material_library(file_name):
+    '''
+    Parses a material library (.mtl) file. Use material_registry.library() to parse each file once.
+    '''
     library = MaterialLibrary()
     material = None
 
-    print('-- Loading material library {}'.format(file_name))
+    logger.debug('-- Loading material library %s', file_name)
 
     mtlfile = open(file_name)
     for line in mtlfile:
@@ -93,7 +101,7 @@ def load_material_library(file_name):
                     library.add_material(material)
 
                 material = Material(fields[1])
-                print('Found material definition: {}'.format(material.name))
+                logger.debug('Found material definition: %s', material.name)
             elif fields[0] == 'Ka':
                 material.Ka = np.array(fields[1:], 'f')
             elif fields[0] == 'Kd':
@@ -109,11 +117,12 @@ def load_material_library(file_name):
             elif fields[0] == 'illum':
                 material.illumination = int(fields[1])
             elif fields[0] == 'map_Kd':
-                material.texture = fields[1]
+                # the path of the map is relative to the material library
+                material.texture = os.path.normpath(os.path.join(os.path.dirname(file_name), fields[1]))
 
     library.add_material(material)
 
-    print('- Done, loaded {} materials'.format(len(library.materials)))
+    logger.debug('- Done, loaded %d materials', len(library.materials))
 
     return library
 
@@ -123,7 +132,7 @@ def load_obj_file(file_name):
     Function for loading a Blender3D object file. minimalistic, and partial,
     but sufficient for this course. You do not really need to worry about it.
     '''
-    print('Loading mesh(es) from Blender file: {}'.format(file_name))
+    logger.info('Loading mesh(es) from Blender file: %s', file_name)
 
     vlist = []
     tlist = []
@@ -136,8 +145,9 @@ def load_obj_file(file_name):
     # list of meshes, indexed by the material name
     meshes = []
 
-    # current material object
+    # id of the current material in the material registry, and the library its name is looked up in
     material = None
+    library = None
 
     with open(file_name) as objfile:
         line_nb = 0  # count line number for easier error locating
@@ -167,61 +177,73 @@ def load_obj_file(file_name):
                 mlist.append(material)
 
             elif data[0] == 'material library':
-                library = load_material_library('models/{}'.format(data[1]))
+                # the path of the library is relative to the object file
+                library = material_registry.library(
+                    os.path.join(os.path.dirname(file_name), data[1]), load_material_library)
 
             # material indicate a new mesh in the file, so we store the previous one if not empty and start
             # a new one.
             elif data[0] == 'material':
-                material = library.names[data[1]]
-                print('[l.{}] Loading mesh with material: {}'.format(
-                    line_nb, data[1]))
+                material = library.materials[library.names[data[1]]].id
+                logger.debug('[l.%d] Loading mesh with material: %s', line_nb, data[1])
 
-    print('File read. Found {} vertices and {} faces.'.format(
-        len(vlist), len(flist)))
-    return create_meshes_from_blender(vlist, flist, mlist, library)
+    logger.info('File read. Found %d vertices and %d faces.', len(vlist), len(flist))
+    return create_meshes_from_blender(vlist, flist, mlist)
 
 
-def create_meshes_from_blender(vlist, flist, mlist, library):
-    fstart = 0
-    material = None
-    meshes = []
+def mesh_material(material):
+    '''
+    Returns the material of a registry id, or a default material for the faces declared before any usemtl.
+    '''
+    return Material() if material is None else material_registry.material(material)
 
-    # we start by putting all vertices in one array
-    varray = np.array(vlist, dtype='f')
 
-    for f in range(len(flist)):
-        if material is None:
-            material = mlist[f]
+def create_meshes_from_blender(vlist, flist, mlist):
+    '''
+    Splits the faces of an object file into one mesh per material, in the order of the material ids.
+    The faces are sorted by material once, and the vertices used by each material are numbered from 0 in a
+    single np.unique pass, so that the materials may share vertices and come in any order in the file.
+    The meshes are views into one vertex array and one index array.
+    :param mlist: The material registry id of each face
+    '''
+    if len(flist) == 0:
+        logger.debug('--- Created 0 mesh(es) from Blender file.')
+        return []
+
+    varray = np.array(vlist, dtype='f')
 
-        elif material != mlist[f]:  # new mesh is denoted by change in material
-            farray = np.array(flist[fstart:f], dtype=np.uint32)[:, :, 0]
-            vmax = np.max(farray.flatten())
-            vmin = np.min(farray.flatten())-1
+    # vertex index of each corner of each face, from 0, and the material of each face (-1 for none)
+    corners = np.array(flist, dtype=np.uint32)[:, :, 0].astype(np.int64) - 1
+    materials = np.array([-1 if m is None else m for m in mlist], dtype=np.int64)
 
-            #print('+++ vertices ID in range [{},{}] and vstart={} / vmax={}'.format(np.min(farray.flatten()), np.max(farray.flatten()), vstart, vmax))
+    order = np.argsort(materials, kind='stable')
+    corners = corners[order]
+    materials = materials[order]
 
-            meshes.append(
-                Mesh(
-                    vertices=varray[vmin:vmax, :],
-                    faces=farray - vmin - 1,
-                    material=library.materials[material]
-                )
-            )
+    # (material, vertex) keys, sorted by material then vertex: the vertices of each material are consecutive
+    keys = (materials[:, None] + 1) * varray.shape[0] + corners
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.reshape(corners.shape)
+    vertices = varray[unique_keys % varray.shape[0]]
 
-            # start the next mesh
-            fstart = f
+    # first face and first vertex of each material
+    face_starts = np.flatnonzero(np.r_[True, materials[1:] != materials[:-1]])
+    face_ends = np.r_[face_starts[1:], materials.shape[0]]
+    vertex_starts = np.searchsorted(unique_keys, (materials[face_starts] + 1) * varray.shape[0])
+    vertex_ends = np.r_[vertex_starts[1:], vertices.shape[0]]
 
-    farray = np.array(flist[fstart:], dtype=np.uint32)[:, :, 0]
-    vmax = np.max(farray.flatten())
-    vmin = np.min(farray.flatten())-1
+    # indices relative to the first vertex of the material of the face
+    indices = (inverse - np.repeat(vertex_starts, face_ends - face_starts)[:, None]).astype(np.uint32)
 
-    meshes.append(
-        Mesh(
-            vertices=varray[vmin:vmax, :],
-            faces=farray - vmin - 1,
-            material=library.materials[material]
+    meshes = []
+    for m, f0, f1, v0, v1 in zip(materials[face_starts], face_starts, face_ends, vertex_starts, vertex_ends):
+        meshes.append(
+            Mesh(
+                vertices=vertices[v0:v1],
+                faces=indices[f0:f1],
+                material=mesh_material(None if m < 0 else int(m))
+            )
         )
-    )
 
-    print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
+    logger.debug('--- Created %d mesh(es) from Blender file.', len(meshes))
     return meshes
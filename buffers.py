@@ -0,0 +1,154 @@
+import logging
+import ctypes
+
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+'''
+Vertex buffers for geometry that changes every frame.
+'''
+
+
+class StreamingBuffer:
+    '''
+    A vertex buffer written by the CPU every frame.
+    Where ARB_buffer_storage is available, the buffer holds a ring of regions persistently mapped in memory:
+    each frame is written in place through a numpy view of the next region, and a fence makes sure the GPU
+    has finished reading a region before it is written again. Otherwise, the buffer is orphaned before each
+    upload so that the driver never has to wait for the GPU.
+    '''
+
+    def __init__(self, data, regions=3):
+        '''
+        Creates the buffer and uploads the initial data.
+        :param data: The initial float32 array. Every frame must have the same shape.
+        :param regions: The number of frames in the ring
+        '''
+        data = np.ascontiguousarray(data, dtype='f')
+        self.shape = data.shape
+        self.frame_bytes = data.nbytes
+        self.regions = regions
+
+        # statistics
+        self.bytes_streamed = 0
+        self.frame_bytes_streamed = 0
+        self.last_frame_bytes = 0
+
+        self.buffer = gl.glGenBuffers(1)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+
+        self.persistent = gl.available('glBufferStorage') and gl.available('glFenceSync')
+        if self.persistent:
+            try:
+                flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+                gl.glBufferStorage(GL_ARRAY_BUFFER, self.frame_bytes * regions, None, flags)
+                address = gl.glMapBufferRange(GL_ARRAY_BUFFER, 0, self.frame_bytes * regions, flags)
+                memory = (ctypes.c_float * (data.size * regions)).from_address(
+                    ctypes.cast(address, ctypes.c_void_p).value)
+                self.mapped = np.ctypeslib.as_array(memory).reshape((regions,) + self.shape)
+            except Exception as error:
+                logger.warning('StreamingBuffer: persistent mapping failed, using orphaning: %s', error)
+                gl.glDeleteBuffers(1, [self.buffer])
+                self.buffer = gl.glGenBuffers(1)
+                gl.glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+                self.persistent = False
+
+        if self.persistent:
+            self.fences = [None] * regions
+            self.mapped[:] = data
+            self.current = 0
+        else:
+            # the data is written here by the CPU then uploaded
+            self.staging = data.copy()
+            gl.glBufferData(GL_ARRAY_BUFFER, self.frame_bytes, self.staging, GL_STREAM_DRAW)
+
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    @property
+    def offset(self):
+        '''
+        The byte offset of the region to draw from.
+        '''
+        return self.current * self.frame_bytes if self.persistent else 0
+
+    def map(self):
+        '''
+        Returns a numpy view of the memory to write the next frame into.
+        '''
+        if not self.persistent:
+            return self.staging
+
+        # the GPU may still read the current region, so fence it and move on to the next one
+        if self.fences[self.current] is not None:
+            gl.glDeleteSync(self.fences[self.current])
+        self.fences[self.current] = gl.glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.current = (self.current + 1) % self.regions
+
+        fence = self.fences[self.current]
+        if fence is not None:
+            # wait for the GPU to be done with the frame that last used this region (1s at most)
+            gl.glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000)
+            gl.glDeleteSync(fence)
+            self.fences[self.current] = None
+
+        return self.mapped[self.current]
+
+    def commit(self, index, vao):
+        '''
+        Makes the frame written through map() visible to the GPU, and points the attribute at it.
+        :param index: The attribute location
+        :param vao: The vertex array object the attribute belongs to
+        '''
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+
+        if not self.persistent:
+            # orphan the previous storage, then fill a fresh one
+            gl.glBufferData(GL_ARRAY_BUFFER, self.frame_bytes, None, GL_STREAM_DRAW)
+            gl.glBufferSubData(GL_ARRAY_BUFFER, 0, self.frame_bytes, self.staging)
+
+        self.bind_attribute(index, vao)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.bytes_streamed += self.frame_bytes
+        self.frame_bytes_streamed += self.frame_bytes
+
+    def write(self, data):
+        '''
+        Copies a whole frame into the buffer. Prefer writing into map() directly to avoid the copy.
+        '''
+        view = self.map()
+        view[...] = data
+        return view
+
+    def bind_attribute(self, index, vao):
+        gl.glBindVertexArray(vao)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        gl.glEnableVertexAttribArray(index)
+        gl.glVertexAttribPointer(index=index, size=self.shape[1], type=GL_FLOAT, normalized=False,
+                                 stride=0, pointer=ctypes.c_void_p(self.offset))
+        gl.glBindVertexArray(0)
+
+    def end_frame(self):
+        '''
+        Records the number of bytes streamed during the frame that ends.
+        :return: The number of bytes
+        '''
+        self.last_frame_bytes = self.frame_bytes_streamed
+        self.frame_bytes_streamed = 0
+        return self.last_frame_bytes
+
+    def delete(self):
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        if self.persistent:
+            self.mapped = None
+            gl.glUnmapBuffer(GL_ARRAY_BUFFER)
+            for fence in self.fences:
+                if fence is not None:
+                    gl.glDeleteSync(fence)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+        gl.glDeleteBuffers(1, [self.buffer])
@@ -0,0 +1,352 @@
+import numpy as np
+
+from simplify import triangulate
+
+'''
+Bounding volume hierarchy (BVH) over the triangles of a mesh, to answer ray casts, nearest surface
+and box queries in logarithmic time instead of testing every triangle.
+The tree is stored in flat arrays: node i has the bounding box [bmin[i], bmax[i]], and is either a
+leaf holding the triangles order[first[i]:first[i]+count[i]], or an inner node (count[i] == 0) whose
+children are the nodes first[i] and first[i]+1.
+'''
+
+
+def box_area(bmin, bmax):
+    '''
+    Returns the surface area of one or many boxes (half of it, which is enough to compare costs).
+    '''
+    d = bmax - bmin
+    return d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0]
+
+
+def closest_points_on_triangles(p, a, b, c):
+    '''
+    Vectorised closest point from p to each triangle (a, b, c), following Ericson, Real-Time Collision Detection.
+    :param p: The query point
+    :param a, b, c: (N, 3) arrays of triangle corners
+    :return: An (N, 3) array of closest points
+    '''
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+
+    d1 = np.sum(ab * ap, axis=1)
+    d2 = np.sum(ac * ap, axis=1)
+    d3 = np.sum(ab * bp, axis=1)
+    d4 = np.sum(ac * bp, axis=1)
+    d5 = np.sum(ab * cp, axis=1)
+    d6 = np.sum(ac * cp, axis=1)
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # inside the face
+        denom = 1. / (va + vb + vc)
+        result = a + ab * (vb * denom)[:, None] + ac * (vc * denom)[:, None]
+
+        # the Voronoi regions are tested from the last to the first, so that the first match wins
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        mask = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        result[mask] = (b + (c - b) * w[:, None])[mask]
+
+        w = d2 / (d2 - d6)
+        mask = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+        result[mask] = (a + ac * w[:, None])[mask]
+
+        mask = (d6 >= 0) & (d5 <= d6)
+        result[mask] = c[mask]
+
+        v = d1 / (d1 - d3)
+        mask = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+        result[mask] = (a + ab * v[:, None])[mask]
+
+    mask = (d3 >= 0) & (d4 <= d3)
+    result[mask] = b[mask]
+
+    mask = (d1 <= 0) & (d2 <= 0)
+    result[mask] = a[mask]
+
+    return result
+
+
+class BVH:
+    '''
+    Array backed BVH built with the binned surface area heuristic (SAH).
+    '''
+
+    def __init__(self, vertices, faces, leaf_size=4, bins=16):
+        '''
+        Builds the hierarchy.
+        :param vertices: The (N, 3) vertex array of the mesh
+        :param faces: The (F, 3) or (F, 4) face index array of the mesh. Quads are split into two triangles.
+        :param leaf_size: The maximum number of triangles in a leaf
+        :param bins: The number of bins used to evaluate the SAH along each axis
+        '''
+        self.leaf_size = leaf_size
+        self.bins = bins
+
+        triangles = np.asarray(triangulate(np.asarray(faces)), dtype=np.int64)
+
+        # maps each triangle back to the face it comes from
+        self.face_ids = np.arange(triangles.shape[0]) % faces.shape[0]
+
+        # corners of all triangles
+        v = np.asarray(vertices, dtype=np.float64)
+        self.a = v[triangles[:, 0]]
+        self.b = v[triangles[:, 1]]
+        self.c = v[triangles[:, 2]]
+
+        self.build()
+
+    @property
+    def empty(self):
+        return self.a.shape[0] == 0
+
+    def build(self):
+        tmin = np.minimum(np.minimum(self.a, self.b), self.c)
+        tmax = np.maximum(np.maximum(self.a, self.b), self.c)
+        centroids = (self.a + self.b + self.c) / 3.
+
+        n = self.a.shape[0]
+        order = np.arange(n)
+
+        # a binary tree with leaves of at least one triangle has at most 2n-1 nodes
+        bmin = np.empty((max(2 * n - 1, 1), 3))
+        bmax = np.empty((max(2 * n - 1, 1), 3))
+        first = np.zeros(max(2 * n - 1, 1), dtype=np.int64)
+        count = np.zeros(max(2 * n - 1, 1), dtype=np.int64)
+
+        n_nodes = 1
+        stack = [(0, 0, n)]
+        while stack:
+            node, start, end = stack.pop()
+            idx = order[start:end]
+
+            bmin[node] = np.min(tmin[idx], axis=0) if end > start else 0.
+            bmax[node] = np.max(tmax[idx], axis=0) if end > start else 0.
+
+            split = None
+            if end - start > self.leaf_size:
+                split = self.find_split(idx, tmin, tmax, centroids, bmin[node], bmax[node])
+
+            if split is None:
+                first[node] = start
+                count[node] = end - start
+                continue
+
+            # partition the triangles of the node in place
+            order[start:end] = np.concatenate((idx[split], idx[~split]))
+            mid = start + np.count_nonzero(split)
+
+            first[node] = n_nodes
+            stack.append((n_nodes, start, mid))
+            stack.append((n_nodes + 1, mid, end))
+            n_nodes += 2
+
+        self.order = order
+        self.bmin = bmin[:n_nodes]
+        self.bmax = bmax[:n_nodes]
+        self.first = first[:n_nodes]
+        self.count = count[:n_nodes]
+
+    def find_split(self, idx, tmin, tmax, centroids, node_min, node_max):
+        '''
+        Evaluates the SAH cost of splitting between each pair of bins along each axis at once.
+        :return: A boolean mask selecting the triangles of the left child, or None if a leaf is cheaper.
+        '''
+        c = centroids[idx]
+        cmin = np.min(c, axis=0)
+        extent = np.max(c, axis=0) - cmin
+
+        best_cost = len(idx) * box_area(node_min, node_max)
+        best = None
+
+        for axis in range(3):
+            if extent[axis] <= 0.:
+                continue
+
+            b = ((c[:, axis] - cmin[axis]) / extent[axis] * self.bins).astype(np.int64)
+            b = np.minimum(b, self.bins - 1)
+
+            # bounds and number of triangles in each bin
+            counts = np.bincount(b, minlength=self.bins)
+            lo = np.full((self.bins, 3), np.inf)
+            hi = np.full((self.bins, 3), -np.inf)
+            sort = np.argsort(b, kind='stable')
+            used = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts[used])[:-1]))
+            lo[used] = np.minimum.reduceat(tmin[idx[sort]], starts)
+            hi[used] = np.maximum.reduceat(tmax[idx[sort]], starts)
+
+            # bounds of the left and right sides of the split after bin k
+            left_count = np.cumsum(counts)[:-1]
+            left_area = box_area(np.minimum.accumulate(lo)[:-1], np.maximum.accumulate(hi)[:-1])
+            right_count = np.cumsum(counts[::-1])[::-1][1:]
+            right_area = box_area(np.minimum.accumulate(lo[::-1])[::-1][1:],
+                                  np.maximum.accumulate(hi[::-1])[::-1][1:])
+
+            with np.errstate(invalid='ignore'):
+                cost = left_count * left_area + right_count * right_area
+            cost[(left_count == 0) | (right_count == 0)] = np.inf
+
+            k = np.argmin(cost)
+            if cost[k] < best_cost:
+                best_cost = cost[k]
+                best = b <= k
+
+        # too many triangles for a leaf but no useful split: split in the middle
+        if best is None and len(idx) > 2 * self.leaf_size:
+            axis = np.argmax(extent)
+            best = np.zeros(len(idx), dtype=bool)
+            best[np.argsort(c[:, axis], kind='stable')[:len(idx) // 2]] = True
+
+        return best
+
+    def ray_box(self, nodes, origin, inv_direction, t_max):
+        '''
+        Slab test of a ray against the boxes of several nodes.
+        :return: The entry distance along the ray for each node, or inf if it is missed.
+        '''
+        with np.errstate(invalid='ignore'):
+            t0 = (self.bmin[nodes] - origin) * inv_direction
+            t1 = (self.bmax[nodes] - origin) * inv_direction
+        t_near = np.nanmax(np.minimum(t0, t1), axis=1)
+        t_far = np.nanmin(np.maximum(t0, t1), axis=1)
+        t_near = np.maximum(t_near, 0.)
+        return np.where((t_near <= t_far) & (t_near <= t_max), t_near, np.inf)
+
+    def intersect_triangles(self, tris, origin, direction):
+        '''
+        Vectorised Moller-Trumbore ray / triangle intersection.
+        :return: The distances along the ray (inf when missed) and the barycentric coordinates (u, v)
+        '''
+        e1 = self.b[tris] - self.a[tris]
+        e2 = self.c[tris] - self.a[tris]
+        p = np.cross(direction, e2)
+        det = np.sum(e1 * p, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1. / det
+            s = origin - self.a[tris]
+            u = np.sum(s * p, axis=1) * inv_det
+            q = np.cross(s, e1)
+            v = np.sum(direction * q, axis=1) * inv_det
+            t = np.sum(e2 * q, axis=1) * inv_det
+
+        hit = (np.abs(det) > 1e-12) & (u >= 0.) & (v >= 0.) & (u + v <= 1.) & (t >= 0.)
+        return np.where(hit, t, np.inf), u, v
+
+    def ray_cast(self, origin, direction, t_max=np.inf):
+        '''
+        Finds the first triangle hit by a ray.
+        :param origin: The origin of the ray
+        :param direction: The direction of the ray, distances are returned in multiples of its length
+        :param t_max: [optional] Only hits closer than this are reported
+        :return: (t, face, (u, v)) for the closest hit, or None
+        '''
+        # the root of an empty mesh holds no triangles, and has no children either
+        if self.empty:
+            return None
+
+        origin = np.asarray(origin, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            inv_direction = 1. / direction
+
+        best = None
+        stack = [0]
+        while stack:
+            node = stack.pop()
+
+            if self.count[node] > 0:
+                tris = self.order[self.first[node]:self.first[node] + self.count[node]]
+                t, u, v = self.intersect_triangles(tris, origin, direction)
+                i = np.argmin(t)
+                if t[i] < t_max:
+                    t_max = t[i]
+                    best = (t[i], self.face_ids[tris[i]], (u[i], v[i]))
+                continue
+
+            # visit the nearest child first so that the far one can be pruned more often
+            children = self.first[node] + np.arange(2)
+            t = self.ray_box(children, origin, inv_direction, t_max)
+            for i in np.argsort(t)[::-1]:
+                if t[i] < np.inf:
+                    stack.append(children[i])
+
+        return best
+
+    def nearest(self, point, d_max=np.inf):
+        '''
+        Finds the closest point on the surface.
+        :param point: The query point
+        :param d_max: [optional] Only points closer than this are reported
+        :return: (distance, face, closest point), or None
+        '''
+        if self.empty:
+            return None
+
+        point = np.asarray(point, dtype=np.float64)
+
+        best = None
+        d2_max = d_max ** 2
+        stack = [0]
+        while stack:
+            node = stack.pop()
+
+            if self.count[node] > 0:
+                tris = self.order[self.first[node]:self.first[node] + self.count[node]]
+                q = closest_points_on_triangles(point, self.a[tris], self.b[tris], self.c[tris])
+                d2 = np.sum((q - point) ** 2, axis=1)
+                i = np.argmin(d2)
+                if d2[i] < d2_max:
+                    d2_max = d2[i]
+                    best = (np.sqrt(d2[i]), self.face_ids[tris[i]], q[i])
+                continue
+
+            # squared distance from the point to the boxes of the children
+            children = self.first[node] + np.arange(2)
+            d = np.maximum(np.maximum(self.bmin[children] - point, point - self.bmax[children]), 0.)
+            d2 = np.sum(d * d, axis=1)
+            for i in np.argsort(d2)[::-1]:
+                if d2[i] < d2_max:
+                    stack.append(children[i])
+
+        return best
+
+    def box_query(self, bmin, bmax):
+        '''
+        Finds the faces whose bounding box overlaps the given box.
+        :param bmin: The minimum corner of the box
+        :param bmax: The maximum corner of the box
+        :return: A sorted array of face indices
+        '''
+        if self.empty:
+            return np.zeros(0, dtype=np.int64)
+
+        bmin = np.asarray(bmin, dtype=np.float64)
+        bmax = np.asarray(bmax, dtype=np.float64)
+
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if np.any(self.bmin[node] > bmax) or np.any(self.bmax[node] < bmin):
+                continue
+
+            if self.count[node] > 0:
+                tris = self.order[self.first[node]:self.first[node] + self.count[node]]
+                tmin = np.minimum(np.minimum(self.a[tris], self.b[tris]), self.c[tris])
+                tmax = np.maximum(np.maximum(self.a[tris], self.b[tris]), self.c[tris])
+                overlap = np.all(tmin <= bmax, axis=1) & np.all(tmax >= bmin, axis=1)
+                found.append(self.face_ids[tris[overlap]])
+            else:
+                stack.extend((self.first[node], self.first[node] + 1))
+
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
@@ -1,10 +1,3 @@
-# pygame is just used to create a window with the operating system on which to draw.
-import pygame
-
-# imports all openGL functions
-from OpenGL.GL import *
-from OpenGL.GLU import *
-
 # we will use numpy to store data in arrays
 import numpy as np
 
@@ -18,7 +11,7 @@ class Camera:
     '''
 
 
-    def __init__(self, size):
+    def __init__(self, size, P=None):
         self.size = size
         self.V = np.identity(4)
         self.V[2,3] = -5.0 # we translate the camera five units back, looking at the origin
@@ -27,8 +20,73 @@ class Camera:
         self.distance = 5.
         self.center = [0.,0.,0.]
 
+        # the projection, and the matrices derived from P and V. They are only computed again when
+        # the camera moves (see update()).
+        self.P = np.identity(4) if P is None else P
+        self.PV = None
+        self.PV_inverse = None
+        self.frustum_planes = None
+
+        # the parameters V was last computed from, None to force an update
+        self.state = None
+
+        # preallocated matrices for the update
+        self.T0 = np.identity(4)
+        self.Rx = np.identity(4)
+        self.Ry = np.identity(4)
+        self.T = np.identity(4)
+
+    def set_projection(self, P):
+        self.P = P
+        self.state = None
+
     def update(self):
-        T0 = translationMatrix(self.center)
-        R = np.matmul(rotationMatrixX(self.psi), rotationMatrixY(self.phi))
-        T = translationMatrix([0., 0., -self.distance])
-        self.V = np.matmul(np.matmul(T, R), T0)
\ No newline at end of file
+        '''
+        Computes the view matrix and the matrices derived from it, if the camera moved since the last call.
+        :return: True if the matrices changed
+        '''
+        # the center may be modified in place, so it is copied into the state
+        state = (self.phi, self.psi, self.distance, *self.center)
+        if state == self.state:
+            return False
+        self.state = state
+
+        translationMatrix(self.center, self.T0)
+        rotationMatrixX(self.psi, self.Rx)
+        rotationMatrixY(self.phi, self.Ry)
+        translationMatrix([0., 0., -self.distance], self.T)
+        self.V = matmul([self.T, self.Rx, self.Ry, self.T0])
+
+        self.PV = np.matmul(self.P, self.V)
+        self.PV_inverse = np.linalg.inv(self.PV)
+        self.frustum_planes = frustumPlanes(self.PV)
+        return True
+
+    def projected_size(self, M, center, radius):
+        '''
+        Returns the radius on screen of a bounding sphere, in pixels.
+        :param M: The model matrix
+        :param center: The center of the sphere, in model space
+        :param radius: The radius of the sphere, in model space
+        :return: The radius in pixels, infinite if the camera is inside the sphere
+        '''
+        VM = np.matmul(self.V, M)
+        depth = -np.dot(VM, homog(center))[2]
+
+        # account for the scale of the model
+        radius = radius * np.max(np.linalg.norm(VM[:3, :3], axis=0))
+
+        if depth <= radius:
+            return np.inf
+
+        return radius / depth * abs(self.P[1, 1]) * 0.5 * self.size[1]
+
+    def sphere_visible(self, center, radius):
+        '''
+        Tests a bounding sphere against the view frustum.
+        :param center: The center of the sphere, in world space
+        :param radius: The radius of the sphere
+        :return: False if the sphere is entirely outside of the frustum
+        '''
+        distances = np.dot(self.frustum_planes[:, :3], center) + self.frustum_planes[:, 3]
+        return bool(np.all(distances >= -radius))
\ No newline at end of file
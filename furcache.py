@@ -0,0 +1,161 @@
+import logging
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+'''
+Cache of generated fur geometry, so that the same fur is never computed twice for the same mesh and parameters.
+Recently used entries are kept in memory, and all entries are stored on disk as .npy files that are memory-mapped
+when loaded back.
+'''
+
+
+def fur_key(vertices, normals, indices, *parameters):
+    '''
+    Returns a key identifying the fur generated from a mesh with the given parameters.
+    :param vertices, normals, indices: The arrays of the mesh the fur grows on
+    :param parameters: The fur parameters, eg length, angle and density
+    '''
+    h = hashlib.sha1()
+    for array in (vertices, normals, indices):
+        array = np.ascontiguousarray(array)
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(array.tobytes())
+    # round the parameters so that eg 0.2 + 0.1 - 0.1 gives the same key as 0.2
+    h.update(repr([round(p, 6) if isinstance(p, float) else p for p in parameters]).encode())
+    return h.hexdigest()
+
+
+class FurCache:
+    '''
+    Two level LRU cache of (vertices, normals) arrays. On disk, each array is stored in its own .npy file.
+    '''
+
+    def __init__(self, directory='cache/fur', max_bytes=256 * 1024 * 1024, max_entries=8):
+        '''
+        :param directory: The directory where the entries are stored, or None to only cache in memory
+        :param max_bytes: The maximum size of the directory. The least recently used files are deleted above it.
+        :param max_entries: The number of entries kept in memory
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self.memory = OrderedDict()
+
+        # the cache is shared with the fur worker thread
+        self.lock = threading.RLock()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def file_names(self, key):
+        return (os.path.join(self.directory, '{}.vertices.npy'.format(key)),
+                os.path.join(self.directory, '{}.normals.npy'.format(key)))
+
+    def get(self, key):
+        '''
+        Looks an entry up, first in memory then on disk.
+        :return: The (vertices, normals) arrays, or None if the key is not cached
+        '''
+        with self.lock:
+            return self.get_locked(key)
+
+    def get_locked(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.directory is not None and all(os.path.exists(name) for name in self.file_names(key)):
+            try:
+                value = tuple(np.load(name, mmap_mode='r') for name in self.file_names(key))
+            except FileNotFoundError:
+                # evicted by another process since the check: a miss
+                logger.debug('fur cache entry %s was evicted', key)
+            except (OSError, ValueError) as error:
+                logger.warning('could not read fur cache entry %s: %s', key, error)
+            else:
+                # mark the files as recently used, unless another process has just evicted them
+                for name in self.file_names(key):
+                    try:
+                        os.utime(name)
+                    except FileNotFoundError:
+                        pass
+                self.hits += 1
+                return self.remember(key, value)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, vertices, normals):
+        '''
+        Stores an entry in memory and on disk.
+        '''
+        with self.lock:
+            self.put_locked(key, vertices, normals)
+
+    def put_locked(self, key, vertices, normals):
+        self.remember(key, (vertices, normals))
+
+        if self.directory is None:
+            return
+
+        for name, array in zip(self.file_names(key), (vertices, normals)):
+            # write to a temporary file first so that a partial file is never read. Its name is unique, as the
+            # directory may be shared by several processes, eg the workers of batch.py
+            descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(descriptor, 'wb') as file:
+                    np.save(file, np.asarray(array, dtype='f'))
+                os.replace(temporary, name)
+            except BaseException:
+                os.remove(temporary)
+                raise
+
+        self.evict()
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return value
+
+    def evict(self):
+        '''
+        Deletes the least recently used files until the directory fits in max_bytes.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # evicted by another process sharing the directory
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+            except OSError:
+                # the file may still be mapped on some platforms, try again next time
+                continue
+            total -= size
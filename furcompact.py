@@ -0,0 +1,91 @@
+import numpy as np
+
+'''
+Compact encoding of fur strands, decoded in the vertex shader of shaders/fur_compact.
+- positions are quantized to 16 bits per coordinate within the bounding box of the fur: the error on each
+  coordinate is at most half a step, ie extent / 65535 / 2.
+- normals are octahedral encoded as two signed 16 bits values, with an angular error below 1e-4 radians.
+- the midpoint of each strand is stored once, and the two line segments are drawn from an index array.
+A strand takes 3 * (6 + 4) + 16 = 46 bytes instead of 4 * (12 + 12) = 96 bytes.
+'''
+
+QUANTIZATION_STEPS = 65535
+SNORM_MAX = 32767
+
+
+def quantize_positions(positions, bmin, extent):
+    '''
+    Quantizes positions to unsigned 16 bits integers within the box [bmin, bmin + extent].
+    '''
+    scaled = (positions - bmin) / extent * QUANTIZATION_STEPS
+    return np.clip(np.rint(scaled), 0, QUANTIZATION_STEPS).astype(np.uint16)
+
+
+def dequantize_positions(quantized, bmin, extent):
+    '''
+    CPU reference of the position decoding done in the vertex shader.
+    '''
+    return (bmin + quantized.astype('f') / QUANTIZATION_STEPS * extent).astype('f')
+
+
+def octahedral_encode(normals):
+    '''
+    Projects unit vectors on the octahedron, unfolded on the square [-1, 1]^2, stored as signed 16 bits integers.
+    :param normals: An (N, 3) array of unit vectors
+    :return: An (N, 2) int16 array
+    '''
+    normals = np.asarray(normals, dtype=np.float64)
+    p = normals[:, :2] / np.maximum(np.sum(np.abs(normals), axis=1, keepdims=True), 1e-12)
+
+    # fold the lower hemisphere over the corners of the square
+    lower = normals[:, 2] < 0
+    sign = np.where(p[lower] >= 0, 1., -1.)
+    p[lower] = (1. - np.abs(p[lower][:, ::-1])) * sign
+
+    return np.rint(np.clip(p, -1., 1.) * SNORM_MAX).astype(np.int16)
+
+
+def octahedral_decode(encoded):
+    '''
+    CPU reference of the normal decoding done in the vertex shader.
+    '''
+    p = np.maximum(encoded.astype('f') / SNORM_MAX, -1.)
+    z = 1. - np.sum(np.abs(p), axis=1)
+
+    # unfold the lower hemisphere
+    lower = z < 0
+    sign = np.where(p[lower] >= 0, 1., -1.)
+    p[lower] = (1. - np.abs(p[lower][:, ::-1])) * sign
+
+    normals = np.hstack((p, z[:, None]))
+    return (normals / np.linalg.norm(normals, axis=1, keepdims=True)).astype('f')
+
+
+def encode_strands(vertices, normals):
+    '''
+    Encodes strands stored as 4 vertices each (root, midpoint, midpoint, endpoint).
+    :param vertices: The (4N, 3) strand vertices
+    :param normals: The (4N, 3) strand normals
+    :return: positions (3N, 3) uint16, normals (3N, 2) int16, indices (N, 4) uint32, bmin and extent of the box
+    '''
+    strands = np.asarray(vertices, dtype='f').reshape(-1, 4, 3)[:, [0, 1, 3]].reshape(-1, 3)
+    strand_normals = np.asarray(normals, dtype='f').reshape(-1, 4, 3)[:, [0, 1, 3]].reshape(-1, 3)
+
+    bmin = np.min(strands, axis=0)
+    extent = np.maximum(np.max(strands, axis=0) - bmin, 1e-6).astype('f')
+
+    # segments root -> midpoint and midpoint -> endpoint
+    first = 3 * np.arange(strands.shape[0] // 3, dtype=np.uint32)
+    indices = np.stack((first, first + 1, first + 1, first + 2), axis=1)
+
+    return (quantize_positions(strands, bmin, extent), octahedral_encode(strand_normals),
+            indices, bmin, extent)
+
+
+def decode_strands(positions, normals, indices, bmin, extent):
+    '''
+    CPU reference decoder, giving back the (4N, 3) vertices and normals drawn with GL_LINES.
+    '''
+    order = indices.flatten()
+    return (dequantize_positions(positions, bmin, extent)[order],
+            octahedral_decode(normals)[order])
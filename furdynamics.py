@@ -0,0 +1,130 @@
+import numpy as np
+
+'''
+Simulation of fur strands under gravity, wind and the motion of the model they grow on.
+Each strand is a root, a midpoint and a tip. The midpoint and tip are moved by their velocity, pulled back
+towards their rest position by a spring, and then projected back to the length of their segment.
+All state is kept as structure-of-arrays float32 buffers of shape (3, N), one row per coordinate, so that a
+step updates every strand at once.
+'''
+
+
+class FurDynamics:
+    '''
+    Position based dynamics of all the strands of a fur model.
+    '''
+
+    # arrays holding the rest pose and the state of the simulation, (3, N) or (N,)
+    STATE = ('root', 'rest_mid', 'rest_tip', 'length_a', 'length_b', 'gust',
+             'mid', 'tip', 'mid_velocity', 'tip_velocity')
+
+    def __init__(self, vertices, stiffness=40.0, damping=4.0, seed=0):
+        '''
+        :param vertices: The (4N, 3) strand vertices of the fur model: root, midpoint, midpoint, endpoint
+        :param stiffness: Strength of the spring pulling the strands back to their rest pose
+        :param damping: Rate at which the strands lose their velocity, per second
+        :param seed: Seed for the random strength of the wind on each strand
+        '''
+        strands = np.asarray(vertices, dtype='f').reshape(-1, 4, 3)
+        self.n = strands.shape[0]
+
+        self.stiffness = stiffness
+        self.damping = damping
+
+        # rest pose
+        self.root = np.ascontiguousarray(strands[:, 0].T)
+        self.rest_mid = np.ascontiguousarray(strands[:, 1].T)
+        self.rest_tip = np.ascontiguousarray(strands[:, 3].T)
+
+        # segment lengths
+        self.length_a = np.linalg.norm(self.rest_mid - self.root, axis=0)
+        self.length_b = np.linalg.norm(self.rest_tip - self.rest_mid, axis=0)
+
+        # simulated state
+        self.mid = self.rest_mid.copy()
+        self.tip = self.rest_tip.copy()
+        self.mid_velocity = np.zeros_like(self.mid)
+        self.tip_velocity = np.zeros_like(self.tip)
+
+        # some strands catch more wind than others
+        self.gust = np.random.default_rng(seed).uniform(0.5, 1.5, self.n).astype('f')
+
+        self.allocate_work_buffers()
+
+    @classmethod
+    def attach(cls, arrays, stiffness=40.0, damping=4.0):
+        '''
+        Creates a simulation working directly on existing state arrays, eg a range of strands in shared memory.
+        :param arrays: A dict holding an array for each name in STATE
+        '''
+        dynamics = cls.__new__(cls)
+        for name in cls.STATE:
+            setattr(dynamics, name, arrays[name])
+        dynamics.n = dynamics.mid.shape[1]
+        dynamics.stiffness = stiffness
+        dynamics.damping = damping
+        dynamics.allocate_work_buffers()
+        return dynamics
+
+    def allocate_work_buffers(self):
+        # work buffers, to avoid allocating arrays at every step
+        self.previous = np.empty_like(self.mid)
+        self.delta = np.empty_like(self.mid)
+        self.norm = np.empty(self.n, dtype='f')
+
+    def integrate(self, x, v, rest, acceleration, wind, dt):
+        # v += dt * (a + wind * gust + k * (rest - x)), then damping
+        np.subtract(rest, x, out=self.delta)
+        self.delta *= self.stiffness
+        self.delta += acceleration[:, None]
+        self.delta += wind[:, None] * self.gust
+        self.delta *= dt
+        v += self.delta
+        v *= np.float32(np.exp(-self.damping * dt))
+
+        # x += dt * v
+        np.multiply(v, dt, out=self.delta)
+        x += self.delta
+
+    def constrain(self, x, anchor, length):
+        '''
+        Moves the points x along the segment from their anchor so that the segment has the given length.
+        '''
+        np.subtract(x, anchor, out=self.delta)
+        np.sqrt(np.einsum('ij,ij->j', self.delta, self.delta), out=self.norm)
+        np.maximum(self.norm, 1e-8, out=self.norm)
+        np.divide(length, self.norm, out=self.norm)
+        self.delta *= self.norm
+        np.add(anchor, self.delta, out=x)
+
+    def step(self, dt, acceleration, wind=np.zeros(3, 'f')):
+        '''
+        Advances the simulation.
+        :param dt: The time step, in seconds. Clamped to 1/30s to keep the simulation stable.
+        :param acceleration: The acceleration applied to all strands in model space, eg gravity and inertia of the model
+        :param wind: The wind acceleration in model space, scaled by the gust factor of each strand
+        '''
+        dt = np.float32(min(dt, 1 / 30))
+        acceleration = np.asarray(acceleration, dtype='f')
+        wind = np.asarray(wind, dtype='f')
+
+        for x, v, rest, anchor, length in (
+                (self.mid, self.mid_velocity, self.rest_mid, self.root, self.length_a),
+                (self.tip, self.tip_velocity, self.rest_tip, self.mid, self.length_b)):
+            self.previous[...] = x
+            self.integrate(x, v, rest, acceleration, wind, dt)
+            self.constrain(x, anchor, length)
+
+            # the velocity is what the point actually moved, constraints included
+            np.subtract(x, self.previous, out=v)
+            v /= dt
+
+    def write(self, vertices):
+        '''
+        Writes the simulated positions into the strand vertex array of the fur model.
+        :param vertices: The (4N, 3) vertex array to update
+        '''
+        strands = vertices.reshape(-1, 4, 3)
+        strands[:, 1] = self.mid.T
+        strands[:, 2] = self.mid.T
+        strands[:, 3] = self.tip.T
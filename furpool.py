@@ -0,0 +1,214 @@
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from furdynamics import FurDynamics
+
+'''
+Fur simulation spread over several processes. The state of all strands lives in shared memory, and each
+worker process steps its own range of strands. The strand vertices are double buffered: the render thread
+uploads the front buffer of frame N while the workers write frame N+1 into the back buffer.
+'''
+
+# the workers are spawned rather than forked: the viewer runs threads (fur worker, shader watcher, texture
+# decoders, frame writer) and holds an OpenGL context, and a lock held by one of them would be copied, held
+# forever, into a forked child. The workers only need numpy and the names of the shared memory blocks.
+START_METHOD = 'spawn'
+
+
+def attach_arrays(specs):
+    '''
+    Maps the shared memory blocks described by specs into numpy arrays.
+    :param specs: A dict of name -> (shared memory name, shape, dtype)
+    :return: The dict of blocks and the dict of arrays
+    '''
+    blocks = {}
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+    return blocks, arrays
+
+
+def worker_main(specs, start, end, stiffness, damping, commands, done):
+    '''
+    Main loop of a worker process, stepping the strands [start, end) for each command received.
+    '''
+    blocks, arrays = attach_arrays(specs)
+
+    dynamics = FurDynamics.attach(
+        {name: arrays[name][..., start:end] for name in FurDynamics.STATE}, stiffness, damping)
+    outputs = [arrays['output0'][4 * start:4 * end], arrays['output1'][4 * start:4 * end]]
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        dt, acceleration, wind, steps, output = command
+        for _ in range(steps):
+            dynamics.step(dt, acceleration, wind)
+        dynamics.write(outputs[output])
+        done.put(start)
+
+    # release the views before closing the blocks
+    del dynamics, outputs, arrays
+    for block in blocks.values():
+        block.close()
+
+
+class FurSimulationPool:
+    '''
+    Pool of worker processes sharing the simulation of a fur model.
+    '''
+
+    def __init__(self, dynamics, vertices, workers=None):
+        '''
+        Copies the simulation state into shared memory and starts the workers.
+        :param dynamics: The FurDynamics holding the initial state
+        :param vertices: The (4N, 3) strand vertices, used to initialise both output buffers
+        :param workers: [optional] The number of worker processes, all cores by default
+        '''
+        self.workers = workers or os.cpu_count() or 1
+        self.n = dynamics.n
+
+        self.blocks = {}
+        self.arrays = {}
+        self.specs = {}
+        for name in FurDynamics.STATE:
+            self.share(name, getattr(dynamics, name))
+        self.share('output0', vertices)
+        self.share('output1', vertices)
+
+        # the render thread reads the front buffer, the workers write the other one
+        self.front = 0
+        self.pending = False
+
+        # copy of the last vertices, returned by vertices once the shared memory is freed
+        self.closed = None
+
+        # split the strands into one contiguous range per worker
+        bounds = np.linspace(0, self.n, self.workers + 1).astype(int)
+
+        context = multiprocessing.get_context(START_METHOD)
+        self.done = context.Queue()
+        self.commands = []
+        self.processes = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            commands = context.Queue()
+            process = context.Process(
+                target=worker_main,
+                args=(self.specs, start, end, dynamics.stiffness, dynamics.damping, commands, self.done),
+                daemon=True,
+            )
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+
+    def share(self, name, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks[name] = block
+        self.arrays[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        self.arrays[name][...] = array
+        self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    @property
+    def vertices(self):
+        '''
+        The strand vertices of the last finished step. The array is a view of the shared memory, only valid
+        until close(): copy it to keep it.
+        '''
+        if self.closed is not None:
+            return self.closed
+        return self.arrays['output{}'.format(self.front)]
+
+    def submit(self, dt, acceleration, wind, steps=1):
+        '''
+        Starts the next step in the background, writing into the back buffer.
+        :param steps: The number of steps of dt to simulate
+        '''
+        if self.pending:
+            self.wait()
+
+        command = (float(dt), np.asarray(acceleration, 'f'), np.asarray(wind, 'f'), int(steps), 1 - self.front)
+        for commands in self.commands:
+            commands.put(command)
+        self.pending = True
+
+    def wait(self):
+        '''
+        Waits for the step in progress and swaps the buffers.
+        :return: True if a new step is available in vertices
+        '''
+        if not self.pending:
+            return False
+
+        for _ in self.processes:
+            self.done.get()
+        self.front = 1 - self.front
+        self.pending = False
+        return True
+
+    def close(self):
+        '''
+        Stops the workers and frees the shared memory. The views returned by vertices before must not be used
+        anymore, vertices now returns a copy of the last step.
+        '''
+        if self.closed is not None:
+            return
+
+        for commands in self.commands:
+            commands.put(None)
+        for process in self.processes:
+            process.join()
+
+        self.closed = np.array(self.vertices)
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+def benchmark(strands=200000, steps=100):
+    '''
+    Measures the simulation rate with 1 up to all cores.
+    :param strands: The number of simulated strands
+    :param steps: The number of steps timed for each worker count
+    '''
+    rng = np.random.default_rng(0)
+    roots = rng.normal(size=(strands, 3)).astype('f')
+    normals = roots / np.linalg.norm(roots, axis=1, keepdims=True)
+    mid = roots + 0.07 * normals
+    vertices = np.stack((roots, mid, mid, mid + [0.13, 0., 0.]), axis=1).reshape(-1, 3).astype('f')
+
+    acceleration = np.array([0., -2., 0.], 'f')
+    wind = np.array([1.5, 0., 0.5], 'f')
+
+    # reference: the single threaded simulation in this process
+    dynamics = FurDynamics(vertices)
+    t = time.perf_counter()
+    for _ in range(steps):
+        dynamics.step(1 / 60, acceleration, wind)
+        dynamics.write(vertices)
+    elapsed = time.perf_counter() - t
+    print('{} strands, in process: {:.2f} ms/step'.format(strands, 1000 * elapsed / steps))
+
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        pool = FurSimulationPool(FurDynamics(vertices), vertices, workers)
+        t = time.perf_counter()
+        for _ in range(steps):
+            pool.submit(1 / 60, acceleration, wind)
+        pool.wait()
+        elapsed = time.perf_counter() - t
+        pool.close()
+        print('{} strands, {} worker(s): {:.2f} ms/step'.format(strands, workers, 1000 * elapsed / steps))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:]])
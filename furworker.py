@@ -0,0 +1,76 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from FurModel import FurModel
+
+logger = logging.getLogger(__name__)
+
+'''
+Background regeneration of fur models, so that the render loop keeps drawing while new fur is computed.
+'''
+
+
+class FurWorker:
+    '''
+    Builds fur models on a background thread. Requests are identified by the slot of the fur model they
+    replace, and only the latest request of each slot is built. The new models are handed back without
+    their OpenGL buffers, which must be created on the thread that owns the OpenGL context.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+
+        # latest requested parameters for each slot, in request order
+        self.pending = OrderedDict()
+
+        # models built since the last call to collect(), by slot
+        self.finished = OrderedDict()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='FurWorker', daemon=True)
+        self.thread.start()
+
+    def submit(self, slot, **parameters):
+        '''
+        Requests a new fur model. Replaces any request for the same slot that has not started yet.
+        :param slot: The slot of the fur model to replace
+        :param parameters: The arguments of the FurModel constructor
+        '''
+        with self.condition:
+            self.pending[slot] = parameters
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                slot, parameters = self.pending.popitem(last=False)
+
+            try:
+                model = FurModel(upload=False, slot=slot, **parameters)
+            except Exception as error:
+                logger.exception('FurWorker.run(): could not build fur model: %s', error)
+                continue
+
+            with self.condition:
+                self.finished[slot] = model
+
+    def collect(self):
+        '''
+        Returns the models finished since the last call, at most one per slot.
+        :return: A list of (slot, model)
+        '''
+        with self.condition:
+            finished = list(self.finished.items())
+            self.finished.clear()
+        return finished
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,252 @@
+import logging
+from collections import Counter
+
+import numpy as np
+
+import OpenGL.GL
+
+logger = logging.getLogger(__name__)
+
+'''
+Dispatch layer between the models, shaders and buffers and PyOpenGL, to measure what a frame costs:
+
+    from gldispatch import gl
+    gl.glBindBuffer(GL_ARRAY_BUFFER, buffer)
+
+The functions are looked up on the gl object, in one of these modes:
+- 'direct': the PyOpenGL functions themselves, bound on first use, so that this costs no more than a global lookup.
+- 'count': each call is counted per function, with the bytes it uploads or reads back, until end_frame() closes
+  the frame.
+- 'record': also keeps the list of the calls and their arguments.
+The backend can be replaced by a MockGL, which runs the same code without any OpenGL context, eg to check that
+a change does not add GL calls to a frame:
+
+    gl.set_backend(MockGL())
+    gl.set_mode('count')
+    model.draw(poseMatrix(), shaders)
+    frame = gl.end_frame()
+'''
+
+MODES = ('direct', 'count', 'record')
+
+# components per pixel, and bytes per component, of the pixels read back by glReadPixels
+PIXEL_COMPONENTS = {
+    OpenGL.GL.GL_RED: 1, OpenGL.GL.GL_DEPTH_COMPONENT: 1, OpenGL.GL.GL_RG: 2,
+    OpenGL.GL.GL_RGB: 3, OpenGL.GL.GL_BGR: 3, OpenGL.GL.GL_RGBA: 4, OpenGL.GL.GL_BGRA: 4,
+}
+COMPONENT_BYTES = {
+    OpenGL.GL.GL_UNSIGNED_BYTE: 1, OpenGL.GL.GL_BYTE: 1, OpenGL.GL.GL_UNSIGNED_SHORT: 2, OpenGL.GL.GL_SHORT: 2,
+    OpenGL.GL.GL_UNSIGNED_INT: 4, OpenGL.GL.GL_INT: 4, OpenGL.GL.GL_FLOAT: 4,
+}
+
+
+def upload_size(name, args, kwargs):
+    '''
+    Returns the number of bytes sent to the GPU by a call: the arrays and byte strings it is given, and the
+    values of the uniforms (4 bytes each). Sizes given as integers, eg to allocate a buffer, are not uploads.
+    '''
+    uniform = name.startswith('glUniform')
+    nbytes = 0
+    for value in (*args, *kwargs.values()):
+        if isinstance(value, np.ndarray):
+            # the uniform values are converted to 32 bit floats or integers
+            nbytes += 4 * value.size if uniform else value.nbytes
+        elif isinstance(value, (bytes, bytearray)):
+            nbytes += len(value)
+
+    # glUniform1f(location, x), ..., glUniform4i(location, x, y, z, w)
+    if uniform and len(name) == 11 and name[9] in '1234':
+        nbytes += 4 * (len(args) - 1)
+    return nbytes
+
+
+def read_size(name, args, kwargs):
+    '''
+    Returns the number of bytes read back from the GPU by a call to glReadPixels(x, y, width, height, format, type),
+    into memory or into a pixel buffer object.
+    '''
+    if name != 'glReadPixels' or len(args) < 6:
+        return 0
+    width, height, pixel_format, pixel_type = args[2:6]
+    return width * height * PIXEL_COMPONENTS.get(pixel_format, 4) * COMPONENT_BYTES.get(pixel_type, 1)
+
+
+class MockGL:
+    '''
+    Stand-in for the OpenGL.GL module, which draws nothing: the objects created get increasing ids, queries
+    and status checks succeed, and every other function returns None.
+    '''
+
+    # functions reported as unavailable, so that their fallbacks are used, eg no persistently mapped buffers
+    UNSUPPORTED = ('glBufferStorage', 'glFenceSync')
+
+    # glGenQueries is the only generator called on its own returning an array, even for one query
+    ARRAY_GENERATORS = ('glGenQueries',)
+
+    def __init__(self):
+        self.next_id = 1
+
+    def new_ids(self, n, as_array=False):
+        ids = np.arange(self.next_id, self.next_id + n, dtype=np.uint32)
+        self.next_id += n
+        return ids if n > 1 or as_array else int(ids[0])
+
+    def __getattr__(self, name):
+        if not name.startswith('gl'):
+            raise AttributeError(name)
+
+        if name in self.UNSUPPORTED:
+            function = None
+        elif name.startswith('glGen'):
+            as_array = name in self.ARRAY_GENERATORS
+
+            def function(n, *args, **kwargs):
+                return self.new_ids(n, as_array)
+        elif name.startswith('glCreate') or name.endswith('Location'):
+            def function(*args, **kwargs):
+                return self.new_ids(1)
+        elif name == 'glCheckFramebufferStatus':
+            def function(*args, **kwargs):
+                return OpenGL.GL.GL_FRAMEBUFFER_COMPLETE
+        elif name.startswith('glGet') or name.startswith('glIs'):
+            # link status, query results and availability
+            def function(*args, **kwargs):
+                return 1
+        else:
+            def function(*args, **kwargs):
+                return None
+
+        setattr(self, name, function)
+        return function
+
+
+class GLDispatch:
+    '''
+    Looks up the OpenGL functions in a backend, counting or recording the calls depending on the mode.
+    '''
+
+    def __init__(self, backend=OpenGL.GL, mode='direct'):
+        self.backend = backend
+        self.mode = mode
+
+        # calls, bytes uploaded and bytes read back per function during the current frame, and the recorded calls
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.reads = Counter()
+        self.log = []
+
+        # number of frames ended, and the statistics of the last one, see end_frame()
+        self.frames = 0
+        self.last_frame = None
+
+    def set_mode(self, mode):
+        '''
+        Switches to the 'direct', 'count' or 'record' mode, and starts a new frame.
+        '''
+        if mode not in MODES:
+            raise ValueError('GLDispatch: unknown mode {}, expected one of {}'.format(mode, ', '.join(MODES)))
+        self.mode = mode
+        self.unbind()
+        self.reset()
+
+    def set_backend(self, backend):
+        '''
+        Sends the calls to another module, eg a MockGL. The objects created before keep their ids in the previous one.
+        '''
+        self.backend = backend
+        self.unbind()
+
+    def unbind(self):
+        # the functions bound for the previous mode or backend are looked up again on their next use
+        for name in [name for name in self.__dict__ if name.startswith('gl')]:
+            del self.__dict__[name]
+
+    def __getattr__(self, name):
+        # only called for the functions not bound yet
+        if not name.startswith('gl'):
+            raise AttributeError(name)
+
+        function = getattr(self.backend, name)
+        if self.mode != 'direct' and function is not None:
+            function = self.traced(name, function)
+        self.__dict__[name] = function
+        return function
+
+    def traced(self, name, function):
+        '''
+        Wraps a function to count its calls and uploads, and record them in the 'record' mode.
+        '''
+        record = self.mode == 'record'
+
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            nbytes = upload_size(name, args, kwargs)
+            if nbytes:
+                self.bytes[name] += nbytes
+            nbytes = read_size(name, args, kwargs)
+            if nbytes:
+                self.reads[name] += nbytes
+            if record:
+                # the arrays are copied: the matrices and streamed vertices are rewritten by the next frame
+                self.log.append((name, tuple(np.copy(value) if isinstance(value, np.ndarray) else value
+                                             for value in args), kwargs))
+            return function(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def available(self, name):
+        '''
+        Returns whether the backend provides a function, eg an extension.
+        '''
+        return bool(getattr(self.backend, name, None))
+
+    def reset(self):
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.reads = Counter()
+        self.log = []
+
+    def end_frame(self):
+        '''
+        Closes the statistics of a frame, and starts the next one.
+        :return: A dict with the number of calls per function ('calls'), the bytes uploaded per function
+        ('uploads') and in total ('bytes'), the bytes read back per function ('reads') and in total ('read_bytes'),
+        and the recorded calls ('log'), also kept in last_frame
+        '''
+        self.frames += 1
+        if self.mode == 'direct':
+            return self.last_frame
+
+        self.last_frame = {
+            'calls': self.calls,
+            'uploads': self.bytes,
+            'bytes': sum(self.bytes.values()),
+            'reads': self.reads,
+            'read_bytes': sum(self.reads.values()),
+            'log': self.log,
+        }
+        self.reset()
+        return self.last_frame
+
+    def report(self, frame=None, top=10):
+        '''
+        Formats the statistics of a frame, the most called functions first.
+        :param frame: A dict returned by end_frame(), the last frame by default
+        :param top: The number of functions listed
+        '''
+        frame = frame if frame is not None else self.last_frame
+        if frame is None:
+            return 'no GL calls counted'
+
+        lines = ['{} GL calls, {} bytes uploaded, {} bytes read back'.format(
+            sum(frame['calls'].values()), frame['bytes'], frame['read_bytes'])]
+        for name, count in frame['calls'].most_common(top):
+            transferred = frame['uploads'].get(name) or frame['reads'].get(name)
+            lines.append('  {:<28} {:>6}{}'.format(name, count,
+                                                    ' ({} bytes)'.format(transferred) if transferred else ''))
+        return '\n'.join(lines)
+
+
+# used by all the modules drawing the scene
+gl = GLDispatch()
@@ -5,7 +5,7 @@ class LightSource:
     Base class for maintaining a light source in the scene. Inheriting from Sphere allows to visualize the light
     source position easily.
     '''
-    def __init__(self, scene, position=[2.,2.,0.], Ia=[1.0,1.0,1.0], Id=[1.0,1.0,1.0], Is=[1.0,1.0,1.0]):
+    def __init__(self, scene, position=[2.,2.,0.], Ia=[1.0,1.0,1.0], Id=[1.0,1.0,1.0], Is=[1.0,1.0,1.0], radius=None):
         '''
         :param scene: The scene in which the light source exists.
         :param position: the position of the light source
@@ -13,12 +13,14 @@ class LightSource:
         :param Id: The diffuse illumination
         :param Is: The specular illumination
         :param visible: Whether the light should be represented as a sphere in the scene (default: False)
+        :param radius: [optional] The distance beyond which the light has no effect, unlimited by default
         '''
 
         self.position = np.array(position,'f')
         self.Ia = Ia
         self.Id = Id
         self.Is = Is
+        self.radius = radius
 
     def update(self, position=None):
         '''
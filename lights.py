@@ -0,0 +1,181 @@
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+import numpy as np
+
+'''
+Many-light support: the lights of the scene are packed in texture buffers, and assigned on the CPU to
+clusters of the view frustum so that each fragment only evaluates the lights that can reach it.
+'''
+
+# radius used for the lights that reach the whole scene
+UNLIMITED_RADIUS = 1e30
+
+
+class LightManager:
+    '''
+    Holds the point lights of a scene. The view frustum is split into a grid of clusters: tiles on screen,
+    and slices in depth spaced exponentially between the near and far planes. Once per frame, each cluster
+    is given the list of lights whose sphere of influence intersects it.
+    The results are stored in three texture buffers read by the fur_clustered shaders:
+    - light_data: 3 RGBA texels per light, the view space position and radius, the diffuse and the specular colours
+    - cluster_ranges: the (offset, count) of the lights of each cluster in light_indices
+    - light_indices: the light indices of all clusters, one after the other
+    '''
+
+    # texture units of the three buffers, unit 0 is left for the textures of the models
+    TEXTURE_UNITS = (1, 2, 3)
+
+    def __init__(self, lights=None, grid=(16, 9, 24)):
+        '''
+        :param lights: [optional] The initial list of LightSource
+        :param grid: The number of clusters along the screen x and y axes and in depth
+        '''
+        self.lights = list(lights or [])
+        self.grid = grid
+
+        # bounding boxes of the clusters in view space, computed from the projection
+        self.x_range = None
+        self.y_range = None
+        self.z_range = None
+
+        # results of the last assignment
+        self.packed = None
+        self.ranges = None
+        self.indices = None
+
+        # OpenGL buffers and textures, created on the first upload
+        self.buffers = None
+        self.textures = None
+
+    def __len__(self):
+        return len(self.lights)
+
+    def add(self, light):
+        self.lights.append(light)
+
+    def remove(self, light):
+        self.lights.remove(light)
+
+    def set_projection(self, P, window_size):
+        '''
+        Computes the bounding boxes of the clusters for a perspective projection.
+        :param P: The projection matrix, as built by frustumMatrix
+        :param window_size: The size of the viewport in pixels
+        '''
+        gx, gy, gz = self.grid
+
+        # near and far distances, from the depth terms of the projection
+        self.near = P[2, 3] / (P[2, 2] - 1.)
+        self.far = P[2, 3] / (P[2, 2] + 1.)
+        self.depth_scale = gz / np.log(self.far / self.near)
+        self.tile_size = np.array([window_size[0] / gx, window_size[1] / gy], 'f')
+
+        # the edges of the tiles in normalised device coordinates, and of the slices in depth
+        ndc_x = np.linspace(-1., 1., gx + 1)
+        ndc_y = np.linspace(-1., 1., gy + 1)
+        depths = self.near * (self.far / self.near) ** (np.arange(gz + 1) / gz)
+
+        # a point at depth d (z = -d) is seen at ndc_x = (P00 x - P02 d) / d
+        x = depths[:, None] * (ndc_x[None, :] + P[0, 2]) / P[0, 0]
+        y = depths[:, None] * (ndc_y[None, :] + P[1, 2]) / P[1, 1]
+
+        # each cluster spans two consecutive depths, x and y edges: its box holds the 8 corners.
+        # the boxes are separable: the x range only depends on the slice and tile_x, y on the slice and tile_y
+        def span(values):
+            corners = np.stack((values[:-1, :-1], values[:-1, 1:], values[1:, :-1], values[1:, 1:]))
+            return np.min(corners, axis=0), np.max(corners, axis=0)
+
+        self.x_range = span(x)
+        self.y_range = span(y)
+        self.z_range = (-depths[1:], -depths[:-1])
+
+    def assign(self, V):
+        '''
+        Packs the lights in view space and assigns them to the clusters.
+        :param V: The view matrix
+        :return: The packed lights (3L, 4), the cluster ranges (C, 2) and the light indices
+        '''
+        n = len(self.lights)
+        positions = np.array([light.position for light in self.lights], 'f').reshape(n, 3)
+        radii = np.array([UNLIMITED_RADIUS if light.radius is None else light.radius
+                          for light in self.lights], 'f')
+        view_positions = np.dot(positions, V[:3, :3].T) + V[:3, 3]
+
+        self.packed = np.zeros((n, 3, 4), 'f')
+        self.packed[:, 0, :3] = view_positions
+        self.packed[:, 0, 3] = radii
+        self.packed[:, 1, :3] = [light.Id for light in self.lights]
+        self.packed[:, 2, :3] = [light.Is for light in self.lights]
+        self.packed = self.packed.reshape(-1, 4)
+
+        # sphere / box test: squared distance from each light to the closest point of each cluster, summed
+        # over the three axes
+        def axis_distance(bounds, coordinates):
+            low, high = bounds
+            return np.square(np.maximum(low[..., None] - coordinates, 0.) +
+                             np.maximum(coordinates - high[..., None], 0.))
+
+        dx = axis_distance(self.x_range, view_positions[:, 0])
+        dy = axis_distance(self.y_range, view_positions[:, 1])
+        dz = axis_distance(self.z_range, view_positions[:, 2])
+        distances = dz[:, None, None, :] + dy[:, :, None, :] + dx[:, None, :, :]
+        hits = distances.reshape(-1, n) <= np.square(radii.astype(np.float64))
+
+        # the lights of each cluster are listed one cluster after the other
+        clusters, lights = np.nonzero(hits)
+        counts = np.bincount(clusters, minlength=hits.shape[0])
+        self.ranges = np.stack((np.cumsum(counts) - counts, counts), axis=1).astype(np.uint32)
+        self.indices = lights.astype(np.uint32)
+
+        return self.packed, self.ranges, self.indices
+
+    def upload(self):
+        '''
+        Copies the results of the last assignment to the texture buffers.
+        '''
+        if self.buffers is None:
+            self.buffers = gl.glGenBuffers(3)
+            self.textures = gl.glGenTextures(3)
+
+        # texture buffers cannot be empty
+        arrays = (
+            self.packed if self.packed.size else np.zeros((1, 4), 'f'),
+            self.ranges,
+            self.indices if self.indices.size else np.zeros(1, np.uint32),
+        )
+        for buffer, texture, array, texture_format in zip(
+                self.buffers, self.textures, arrays, (GL_RGBA32F, GL_RG32UI, GL_R32UI)):
+            gl.glBindBuffer(GL_TEXTURE_BUFFER, buffer)
+            # a new storage each frame, so that the driver does not wait for the previous frame
+            gl.glBufferData(GL_TEXTURE_BUFFER, array.nbytes, array, GL_STREAM_DRAW)
+            gl.glBindTexture(GL_TEXTURE_BUFFER, texture)
+            gl.glTexBuffer(GL_TEXTURE_BUFFER, texture_format, buffer)
+        gl.glBindTexture(GL_TEXTURE_BUFFER, 0)
+        gl.glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    def update(self, V):
+        '''
+        Assigns the lights for the current view and uploads the results. Call this once per frame.
+        '''
+        self.assign(V)
+        self.upload()
+
+    def bind(self, shaders):
+        '''
+        Binds the texture buffers and sets the cluster uniforms of a ClusteredFurShader.
+        '''
+        for unit, texture in zip(self.TEXTURE_UNITS, self.textures):
+            gl.glActiveTexture(GL_TEXTURE0 + unit)
+            gl.glBindTexture(GL_TEXTURE_BUFFER, texture)
+        gl.glActiveTexture(GL_TEXTURE0)
+
+        shaders.set_clusters(self)
+
+    def delete(self):
+        if self.buffers is not None:
+            gl.glDeleteBuffers(3, self.buffers)
+            gl.glDeleteTextures(self.textures)
+            self.buffers = None
+            self.textures = None
@@ -0,0 +1,68 @@
+import logging
+import time
+
+'''
+Logging set up and startup time profile.
+The modules log through logging.getLogger(__name__): progress and user feedback use INFO, internal details
+(buffers, shader sources, file parsing) use DEBUG, so that they cost nothing unless requested.
+'''
+
+
+class MessageFormatter(logging.Formatter):
+    '''
+    Prints INFO messages as they are, and other levels with a one letter prefix, eg (W) for warnings.
+    '''
+
+    def format(self, record):
+        message = super().format(record)
+        if record.levelno == logging.INFO:
+            return message
+        return '({}) {}'.format(record.levelname[0], message)
+
+
+def setup_logging(level=logging.INFO):
+    '''
+    Sends the log messages to the console.
+    :param level: The lowest level printed: logging.WARNING for a quiet run, logging.DEBUG for all details
+    '''
+    handler = logging.StreamHandler()
+    handler.setFormatter(MessageFormatter('%(message)s'))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+class StartupProfile:
+    '''
+    Records the time taken by each phase of the start up, until the first frame is displayed.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = []
+        self.enabled = False
+
+    def mark(self, phase):
+        '''
+        Ends a phase, started by the previous mark (or when this module was imported).
+        :param phase: The name of the phase
+        '''
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        '''
+        Prints the time of each phase, if profiling is enabled.
+        '''
+        if not self.enabled:
+            return
+        for phase, elapsed in self.phases:
+            print('{:<12} {:8.1f} ms'.format(phase, 1000 * elapsed))
+        print('{:<12} {:8.1f} ms'.format('total', 1000 * (self.last - self.start)))
+
+
+# import this first for the profile to include the other imports
+startup = StartupProfile()
@@ -1,3 +1,8 @@
+import argparse
+import logging
+
+# imported first so that the start up profile includes all other imports
+from log import setup_logging, startup
 
 # import the scene class
 from scene import Scene
@@ -6,19 +11,31 @@ from blender import load_obj_file, Mesh
 
 from BaseModel import *
 
+from material import material_registry
+
 from models2D import *
 
 from FurModel import FurModel
 
+from simplify import build_lod_chain, lod_cache_file
+
+startup.mark('imports')
+
+logger = logging.getLogger(__name__)
+
 
 class DrawModelFromMesh(BaseModel):
     '''
     Base class for all models, inherit from this to create new models
     '''
 
-    def __init__(self, scene, M, mesh):
+    # the level of detail i+1 is used when the model covers less than LOD_SCREEN_SIZES[i] pixels on screen
+    LOD_SCREEN_SIZES = (400, 200, 80)
+
+    def __init__(self, scene, M, mesh, lods=None):
         '''
         Initialises the model data
+        :param lods: [optional] A list of simplified meshes, from finest to coarsest, drawn when the model is small on screen
         '''
 
         BaseModel.__init__(self, scene=scene, M=M),
@@ -40,7 +57,7 @@ class DrawModelFromMesh(BaseModel):
             self.primitive = GL_QUADS
 
         else:
-            print('(E) Error: Mesh should have 3 or 4 vertices per face!')
+            logger.error('Mesh should have 3 or 4 vertices per face!')
 
         # initialise the normals per vertex
         self.normals = mesh.normals
@@ -56,6 +73,16 @@ class DrawModelFromMesh(BaseModel):
         # we force a bit of specularity to make it more visible
         self.material.Ns = 15.0
 
+        # but keep the diffuse map of the mesh, loaded in the background
+        self.material.texture = mesh.material.texture
+
+        # models with the same material share it, and its id
+        self.material = material_registry.register(self.material)
+
+        textures = getattr(scene, 'textures', None)
+        if textures is not None:
+            textures.load_material(self.material)
+
         # and we check which primitives we need to use for drawing
         if self.indices.shape[1] == 3:
             self.primitive = GL_TRIANGLES
@@ -64,35 +91,149 @@ class DrawModelFromMesh(BaseModel):
             self.primitive = GL_QUADS
 
         else:
-            print('(E) Error in DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found {}!'.format(
-                self.indices.shape[1]))
+            logger.error('DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found %d!',
+                         self.indices.shape[1])
             raise
 
         # default vertex colors to one (white)
         self.vertex_colors = np.ones((self.vertices.shape[0], 3), dtype='f')
 
         if self.normals is None:
-            print('(W) No normal array was provided.')
-            print('--> setting to zero.')
+            logger.warning('No normal array was provided, setting to zero.')
             self.normals = np.zeros(self.vertices.shape, dtype='f')
 
         # and bind the data to a vertex array
         self.bind()
 
+        # spatial index used for picking, built on first use, see bvh
+        self._bvh = None
+
+        # bounding sphere used to estimate the size of the model on screen
+        self.center = 0.5 * (np.max(self.vertices, axis=0) + np.min(self.vertices, axis=0))
+        self.radius = np.max(np.linalg.norm(self.vertices - self.center, axis=1))
+        self.box = (np.min(self.vertices, axis=0), np.max(self.vertices, axis=0))
+
+        # each level stores everything needed to draw it, level 0 being the full resolution mesh
+        self.lod_levels = [self.get_lod_level()]
+        if lods is not None:
+            for lod in lods:
+                self.lod_levels.append(self.bind_lod(lod))
+            self.set_lod(0)
+
+        # number of frames each level was drawn, for profiling
+        self.lod = 0
+        self.lod_counts = [0] * len(self.lod_levels)
+
+    @property
+    def bvh(self):
+        '''
+        Returns the spatial index over the full resolution triangles. It is only needed for picking, so it is
+        built the first time the model is picked rather than before the first frame.
+        '''
+        if self._bvh is None:
+            from bvh import BVH
+
+            level = self.lod_levels[0]
+            self._bvh = BVH(level['vertices'], level['indices'])
+        return self._bvh
+
+    def get_lod_level(self):
+        return {
+            'vao': self.vao,
+            'vbos': dict(self.vbos),
+            'vertices': self.vertices,
+            'indices': self.indices,
+            'normals': self.normals,
+            'primitive': self.primitive,
+        }
+
+    def set_lod(self, level):
+        '''
+        Switches the arrays and VAO used for drawing to the given level of detail.
+        '''
+        data = self.lod_levels[level]
+        self.vao = data['vao']
+        self.vbos = data['vbos']
+        self.vertices = data['vertices']
+        self.indices = data['indices']
+        self.normals = data['normals']
+        self.primitive = data['primitive']
+
+    def bind_lod(self, mesh):
+        '''
+        Uploads a simplified mesh to its own VAO.
+        :param mesh: The simplified triangle Mesh
+        :return: The level of detail data
+        '''
+        self.vertices = mesh.vertices
+        self.indices = mesh.faces
+        self.normals = mesh.normals
+        self.primitive = GL_TRIANGLES
+        self.vertex_colors = np.ones((self.vertices.shape[0], 3), dtype='f')
+        self.vbos = {}
+        self.bind()
+        return self.get_lod_level()
+
+    def select_lod(self, Mp):
+        '''
+        Selects the level of detail from the projected radius of the bounding sphere, in pixels.
+        :param Mp: The matrix of the parent model
+        :return: The selected level
+        '''
+        size = self.scene.camera.projected_size(np.matmul(Mp, self.M), self.center, self.radius)
+
+        level = 0
+        for threshold in self.LOD_SCREEN_SIZES[:len(self.lod_levels) - 1]:
+            if size < threshold:
+                level += 1
+        return level
+
+    def draw_depth(self, Mp, shaders):
+        if len(self.lod_levels) > 1:
+            self.set_lod(self.select_lod(Mp))
+
+        BaseModel.draw_depth(self, Mp, shaders)
+
+    def draw(self, Mp, shaders):
+        if len(self.lod_levels) > 1:
+            self.lod = self.select_lod(Mp)
+            self.set_lod(self.lod)
+        self.lod_counts[self.lod] += 1
+
+        BaseModel.draw(self, Mp, shaders)
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fur rendering demo')
+    parser.add_argument('--quiet', action='store_true', help='only print warnings and errors')
+    parser.add_argument('--verbose', action='store_true', help='print debugging details')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time taken by each phase until the first frame')
+    parser.add_argument('--max-fps', type=float, default=60, help='maximum frame rate, 0 for no limit')
+    parser.add_argument('--continuous', action='store_true',
+                        help='draw every frame, even when nothing changes')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the session to a raw video file (.rgb) or a directory of images')
+    args = parser.parse_args()
+
+    setup_logging(logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO)
+    startup.enabled = args.profile_startup
+
     # initialises the scene object
     # scene = Scene(shaders='gouraud')
-    scene = Scene()
+    scene = Scene(max_fps=args.max_fps or None, idle=not args.continuous)
+    startup.mark('scene')
     # BUNNY START
     bunny_meshes = load_obj_file('models/bunny_world.obj')
+    bunny_lods = build_lod_chain(
+        bunny_meshes[0], cache_file=lod_cache_file('models/bunny_world.obj'))
     bunny = DrawModelFromMesh(
-        scene=scene, M=poseMatrix(), mesh=bunny_meshes[0])
+        scene=scene, M=poseMatrix(), mesh=bunny_meshes[0], lods=bunny_lods)
 
     scene.add_model(bunny)
 
     bunny_fur_model = FurModel(scene=scene, vertices=bunny.vertices, normals=bunny.normals,
-                               indices=bunny.indices, M=bunny.M, material=bunny.material)
+                               indices=bunny.indices, M=bunny.M, material=bunny.material, fur_count=8192)
 
     scene.add_model(bunny_fur_model)
     # BUNNY END - TORUS START
@@ -103,8 +244,13 @@ if __name__ == '__main__':
     # scene.add_model(torus)
 
     # torus_fur_model = FurModel(scene=scene, vertices=torus.vertices, normals=torus.normals,
-    #                            indices=torus.indices, M=torus.M, material=torus.material)
+    #                            indices=torus.indices, M=torus.M, material=torus.material, fur_count=4096)
     # scene.add_model(torus_fur_model)
     # TORUS END
+    startup.mark('models')
+
+    if args.record:
+        scene.start_capture(args.record)
+
     # starts drawing the scene
     scene.run()
@@ -1,3 +1,9 @@
+import os
+import threading
+
+import numpy as np
+
+
 class Material:
     def __init__(self, name=None, Ka=[1.,1.,1.], Kd=[1.,1.,1.], Ks=[1.,1.,1.], Ns=10.0):
         self.name = name
@@ -6,6 +12,24 @@ class Material:
         self.Ks = Ks
         self.Ns = Ns
 
+        # file of the diffuse map (map_Kd), and its Texture once loaded by a TextureManager
+        self.texture = None
+        self.texture_map = None
+
+        # integer identifier of the material in the MaterialRegistry, None until registered
+        self.id = None
+
+    def key(self):
+        '''
+        Returns the properties identifying the material: two materials with the same key look the same,
+        whatever their names.
+        '''
+        def values(v):
+            return tuple(np.round(np.asarray(v, dtype=float).reshape(-1), 6))
+
+        return (values(self.Ka), values(self.Kd), values(self.Ks), round(float(self.Ns), 6),
+                round(float(getattr(self, 'd', 1.0)), 6), getattr(self, 'illumination', None), self.texture)
+
 
 class MaterialLibrary:
     def __init__(self):
@@ -13,6 +37,69 @@ class MaterialLibrary:
         self.names = {}
 
     def add_material(self,material):
-        self.names[material.name] = len(self.materials)
+        '''
+        Adds a material to the library, as its registered equivalent: see MaterialRegistry.register().
+        '''
+        name = material.name
+        material = material_registry.register(material)
+        self.names[name] = len(self.materials)
         self.materials.append(material)
 
+
+class MaterialRegistry:
+    '''
+    Process-wide registry of materials. Each material library (.mtl file) is parsed once, and identical
+    materials are shared, under a single integer id, by all the meshes and models using them. The ids are
+    small consecutive integers, to sort draws or index per material data cheaply.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # registered materials, indexed by their id, and the id of each material key
+        self.materials = []
+        self.ids = {}
+
+        # parsed libraries, by absolute path: (modification time, MaterialLibrary)
+        self.libraries = {}
+
+    def __len__(self):
+        return len(self.materials)
+
+    def register(self, material):
+        '''
+        Registers a material, once its properties are set.
+        :return: The registered material with the same properties: the first one registered
+        '''
+        key = material.key()
+        with self.lock:
+            if key not in self.ids:
+                self.ids[key] = len(self.materials)
+                self.materials.append(material)
+            material.id = self.ids[key]
+            return self.materials[material.id]
+
+    def material(self, id):
+        return self.materials[id]
+
+    def library(self, file_name, parse):
+        '''
+        Returns a material library, parsed the first time or when its file changed.
+        :param file_name: The path of the .mtl file
+        :param parse: The function parsing the file into a MaterialLibrary
+        '''
+        path = os.path.abspath(file_name)
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            cached = self.libraries.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        library = parse(file_name)
+        with self.lock:
+            self.libraries[path] = (mtime, library)
+        return library
+
+
+# shared by all the loaded models
+material_registry = MaterialRegistry()
@@ -1,39 +1,51 @@
 import numpy as np
 
-def scaleMatrix(s):
-    s.append(1)
-    return np.diag(s)
-
-def translationMatrix(t):
+# The functions below take an optional out argument: a preallocated 4x4 array (float32 for OpenGL) the
+# matrix is written into, so that matrices updated every frame do not allocate new arrays.
+# The batched variants (eg poseMatrices) build N matrices at once from arrays of parameters, as a (N,4,4) array.
+
+def identityInto(out):
+    out[...] = 0.
+    out[..., 0, 0] = out[..., 1, 1] = out[..., 2, 2] = out[..., 3, 3] = 1.
+    return out
+
+def scaleMatrix(s, out=None):
+    if out is None:
+        return np.diag(list(s) + [1])
+    identityInto(out)
+    out[0,0], out[1,1], out[2,2] = s
+    return out
+
+def translationMatrix(t, out=None):
     n = len(t)
-    T = np.identity(n+1,dtype='f')
+    T = np.identity(n+1,dtype='f') if out is None else identityInto(out)
     T[:n,-1] = t
     return T
 
-def rotationMatrixZ(angle):
+def rotationMatrixZ(angle, out=None):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4) if out is None else identityInto(out)
     R[0,0] = c
     R[0,1] = s
     R[1,0] = -s
     R[1,1] = c
     return R
 
-def rotationMatrixX(angle):
+def rotationMatrixX(angle, out=None):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4) if out is None else identityInto(out)
     R[1,1] = c
     R[1,2] = s
     R[2,1] = -s
     R[2,2] = c
     return R
 
-def rotationMatrixY(angle):
+def rotationMatrixY(angle, out=None):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4) if out is None else identityInto(out)
     R[0,0] = c
     R[0,2] = s
     R[2,0] = -s
@@ -41,24 +53,89 @@ def rotationMatrixY(angle):
     return R
 
 
-def poseMatrix(position=[0,0,0], orientation=0, scale=1):
+def poseMatrix(position=[0,0,0], orientation=0, scale=1, out=None):
     '''
     Returns a combined TRS matrix for the pose of a model.
     :param position: the position of the model
     :param orientation: the model orientation (for now assuming a rotation around the Z axis)
     :param scale: the model scale, either a scalar for isotropic scaling, or vector of scale factors
+    :param out: [optional] the 4x4 array to write the matrix into
     :return: the 4x4 TRS matrix
     '''
-    # apply the position and orientation of the object
-    R = rotationMatrixZ(orientation)
-    T = translationMatrix(position)
+    if out is None:
+        # apply the position and orientation of the object
+        R = rotationMatrixZ(orientation)
+        T = translationMatrix(position)
+
+        # ... and the scale factor
+        if np.isscalar(scale):
+            scale = [scale, scale, scale]
+
+        S = scaleMatrix(scale)
+        return np.matmul(np.matmul(T,R),S)
+
+    # T.R.S written directly: the columns of the rotation are multiplied by the scale factors
+    rotationMatrixZ(orientation, out)
+    out[:3,:3] *= scale
+    out[:3,3] = position
+    return out
+
+
+def rotationMatrices(axis, angles, out=None):
+    '''
+    Returns the rotation matrices around one of the coordinate axes for an array of angles.
+    :param axis: 0, 1 or 2 for a rotation around X, Y or Z, with the same convention as rotationMatrixX/Y/Z
+    :param angles: an array of N angles
+    :param out: [optional] the (N,4,4) array to write the matrices into
+    :return: a (N,4,4) float32 array
+    '''
+    angles = np.asarray(angles)
+    R = np.empty((angles.shape[0], 4, 4), dtype='f') if out is None else out
+    identityInto(R)
+
+    # the two axes of the plane of rotation
+    i, j = [(1, 2), (0, 2), (0, 1)][axis]
+    c = np.cos(angles)
+    s = np.sin(angles)
+    R[:,i,i] = c
+    R[:,i,j] = s
+    R[:,j,i] = -s
+    R[:,j,j] = c
+    return R
+
+def translationMatrices(positions, out=None):
+    '''
+    Returns the translation matrices for an (N,3) array of positions, as a (N,4,4) float32 array.
+    '''
+    positions = np.asarray(positions)
+    T = np.empty((positions.shape[0], 4, 4), dtype='f') if out is None else out
+    identityInto(T)
+    T[:,:3,3] = positions
+    return T
+
+def poseMatrices(positions, orientations=0, scales=1, out=None):
+    '''
+    Returns the TRS matrices of N models at once, eg for instancing.
+    :param positions: an (N,3) array of positions
+    :param orientations: an array of N rotation angles around the Z axis, or a single angle
+    :param scales: an array of N scalars or an (N,3) array of scale factors, or a single scale
+    :param out: [optional] the (N,4,4) array to write the matrices into
+    :return: a (N,4,4) float32 array, equal to poseMatrix() applied to each model
+    '''
+    positions = np.asarray(positions)
+    n = positions.shape[0]
+    M = rotationMatrices(2, np.broadcast_to(orientations, (n,)), out)
+
+    scales = np.asarray(scales, dtype='f')
+    if scales.ndim == 1:
+        # one isotropic scale per model
+        scales = scales[:, None]
 
-    # ... and the scale factor
-    if np.isscalar(scale):
-        scale = [scale, scale, scale]
+    # the columns of each rotation are multiplied by the scale factors
+    M[:,:3,:3] *= scales[:, None, :] if scales.ndim == 2 else scales
 
-    S = scaleMatrix(scale)
-    return np.matmul(np.matmul(T,R),S)
+    M[:,:3,3] = positions
+    return M
 
 
 def orthoMatrix(l,r,t,b,n,f):
@@ -91,6 +168,23 @@ def frustumMatrix(l,r,t,b,n,f):
             ]
     )
 
+def frustumPlanes(PV):
+    '''
+    Extracts the planes of the view frustum from a projection-view matrix (Gribb & Hartmann).
+    :param PV: the 4x4 projection-view matrix
+    :return: a (6,4) array of planes (a,b,c,d) with unit normals pointing inside the frustum, so that
+    a.x + b.y + c.z + d is the signed distance of the world space point (x,y,z) to the plane
+    '''
+    planes = np.array([
+        PV[3] + PV[0],  # left
+        PV[3] - PV[0],  # right
+        PV[3] + PV[1],  # bottom
+        PV[3] - PV[1],  # top
+        PV[3] + PV[2],  # near
+        PV[3] - PV[2],  # far
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
 
 # Homogeneous coordinates helpers
 def homog(v):
@@ -104,3 +198,36 @@ def matmul(L):
     for M in L[1:]:
         R = np.matmul(R,M)
     return R
+
+
+def benchmark(n=1000, repeat=2000):
+    '''
+    Compares the allocating float64 functions with the float32 variants writing into preallocated arrays,
+    and the batched poseMatrices with n calls to poseMatrix.
+    '''
+    import timeit
+
+    out = np.empty((4, 4), dtype='f')
+    tests = [
+        ('rotationMatrixZ', lambda: rotationMatrixZ(0.3), lambda: rotationMatrixZ(0.3, out)),
+        ('translationMatrix', lambda: translationMatrix([1., 2., 3.]), lambda: translationMatrix([1., 2., 3.], out)),
+        ('poseMatrix', lambda: poseMatrix([1., 2., 3.], 0.3, 2.), lambda: poseMatrix([1., 2., 3.], 0.3, 2., out)),
+    ]
+    for name, allocating, preallocated in tests:
+        t0 = timeit.timeit(allocating, number=repeat) / repeat
+        t1 = timeit.timeit(preallocated, number=repeat) / repeat
+        print('{:<20} {:7.2f} us   out=: {:7.2f} us'.format(name, 1e6 * t0, 1e6 * t1))
+
+    rng = np.random.default_rng(0)
+    positions = rng.normal(size=(n, 3))
+    orientations = rng.uniform(0, 2 * np.pi, n)
+    scales = rng.uniform(0.5, 2., n)
+    batch = np.empty((n, 4, 4), dtype='f')
+
+    t0 = timeit.timeit(lambda: [poseMatrix(positions[i], orientations[i], scales[i]) for i in range(n)], number=10) / 10
+    t1 = timeit.timeit(lambda: poseMatrices(positions, orientations, scales, batch), number=10) / 10
+    print('{} x poseMatrix      {:7.2f} ms   poseMatrices: {:7.2f} ms'.format(n, 1e3 * t0, 1e3 * t1))
+
+
+if __name__ == '__main__':
+    benchmark()
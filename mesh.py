@@ -1,6 +1,10 @@
+import logging
+
 from material import Material
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 class Mesh:
     '''
     Simple class to hold a mesh data. For now we will only focus on vertices, faces (indices of vertices for each face)
@@ -18,14 +22,15 @@ class Mesh:
         self.faces = faces
         self.material = material
 
-        print('Creating mesh')
-        print('- {} vertices, {} faces'.format(self.vertices.shape[0], self.faces.shape[0]))
-        print('- {} vertices per face'.format(self.faces.shape[1]))
-        print('- vertices ID in range [{},{}]'.format(np.min(self.faces.flatten()), np.max(self.faces.flatten())))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Creating mesh')
+            logger.debug('- %d vertices, %d faces', self.vertices.shape[0], self.faces.shape[0])
+            logger.debug('- %d vertices per face', self.faces.shape[1])
+            logger.debug('- vertices ID in range [%d,%d]', np.min(self.faces), np.max(self.faces))
 
         if normals is None:
             if faces is None:
-                print('(W) Warning: the current code only calculates normals using the face vector of indices, which was not provided here.')
+                logger.warning('the current code only calculates normals using the face vector of indices, which was not provided here.')
             else:
                 self.calculate_normals()
         else:
@@ -41,16 +46,14 @@ class Mesh:
 
         self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
 
-        # seen in WS4
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
+        # seen in WS4, for all the faces at once: this runs before the first frame
+        # first calculate the face normals using the cross product of the triangles' sides
+        corners = self.vertices[self.faces]
+        face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
 
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
+        # blend each normal on the 3 vertices of its face, adding up the faces sharing a vertex
+        for j in range(3):
+            np.add.at(self.normals, self.faces[:, j], face_normals)
 
         # finally we need to normalise the vectors
         self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
\ No newline at end of file
@@ -0,0 +1,203 @@
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+import numpy as np
+
+from matutils import *
+
+'''
+Occlusion culling with hardware queries: before a model (or a part of a model) is drawn, its bounding box is
+rasterized against the depth buffer with colour and depth writes turned off, counting the samples that pass.
+- the count is read one frame later, only if the GPU has already finished it, so that the CPU never waits.
+  A box found hidden is not drawn at all, but its box is still tested so that it reappears once uncovered.
+- the draw that follows the box is wrapped in conditional rendering: the GPU skips it by itself if the
+  query of this frame is already finished and found no samples, without any round trip to the CPU.
+Objects are only hidden by what is drawn before them, so this works best with the models drawn front to back.
+'''
+
+# corners of the unit cube and its 12 triangles
+BOX_VERTICES = np.array([[x, y, z] for x in (0., 1.) for y in (0., 1.) for z in (0., 1.)], 'f')
+BOX_INDICES = np.array([
+    0, 1, 3, 0, 3, 2,  # x = 0
+    4, 6, 7, 4, 7, 5,  # x = 1
+    0, 4, 5, 0, 5, 1,  # y = 0
+    2, 3, 7, 2, 7, 6,  # y = 1
+    0, 2, 6, 0, 6, 4,  # z = 0
+    1, 5, 7, 1, 7, 3,  # z = 1
+], np.uint32)
+
+
+class OcclusionCuller:
+    '''
+    Keeps one occlusion query per tested object, identified by any hashable key.
+    Call begin_frame() before drawing, then for each object:
+
+        if culler.test(key, M, box_min, box_max):
+            culler.begin_conditional(key)
+            ... draw the object ...
+            culler.end_conditional(key)
+    '''
+
+    def __init__(self, scene):
+        self.scene = scene
+
+        # key -> query object, and the keys whose query was sent but not read back yet
+        self.queries = {}
+        self.pending = set()
+
+        # keys found hidden by their last finished query
+        self.hidden = set()
+
+        # keys whose box was tested during this frame, whose draw can be conditioned on the query
+        self.issued = set()
+
+        # statistics of the current frame: tested boxes, objects not drawn, and hidden objects whose
+        # query was still running (their visibility may be out of date)
+        self.tested = 0
+        self.culled = 0
+        self.waiting = 0
+
+        # unit cube, created with the first query
+        self.vao = None
+        self.vbos = None
+
+        # any sample passing is enough, when the OpenGL version allows to stop counting at the first one
+        self.target = None
+
+    def initialise(self):
+        self.vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vao)
+        self.vbos = gl.glGenBuffers(2)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, self.vbos[0])
+        gl.glBufferData(GL_ARRAY_BUFFER, BOX_VERTICES, GL_STATIC_DRAW)
+        # the DepthShader reads the positions at location 0
+        gl.glEnableVertexAttribArray(0)
+        gl.glVertexAttribPointer(index=0, size=3, type=GL_FLOAT, normalized=False, stride=0, pointer=None)
+        gl.glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.vbos[1])
+        gl.glBufferData(GL_ELEMENT_ARRAY_BUFFER, BOX_INDICES, GL_STATIC_DRAW)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        version = (gl.glGetIntegerv(GL_MAJOR_VERSION), gl.glGetIntegerv(GL_MINOR_VERSION))
+        self.target = GL_ANY_SAMPLES_PASSED if version >= (3, 3) else GL_SAMPLES_PASSED
+
+    def begin_frame(self):
+        self.issued.clear()
+        self.tested = 0
+        self.culled = 0
+        self.waiting = 0
+
+    def test(self, key, M, box_min, box_max):
+        '''
+        Tests the bounding box of an object against the depth buffer, if the previous test is finished.
+        :param key: Identifies the object from one frame to the next
+        :param M: The model matrix, including the parent transforms
+        :param box_min, box_max: The corners of the bounding box in model space
+        :return: False if the object should not be drawn: its box was hidden the last time it was tested
+        '''
+        if self.vao is None:
+            self.initialise()
+
+        query = self.queries.get(key)
+        if query is None:
+            query = gl.glGenQueries(1)[0]
+            self.queries[key] = query
+
+        elif key in self.pending:
+            if not gl.glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE):
+                # still running: keep the last answer rather than waiting for the GPU
+                if key in self.hidden:
+                    self.waiting += 1
+                    self.culled += 1
+                    return False
+                return True
+
+            self.pending.discard(key)
+            if gl.glGetQueryObjectuiv(query, GL_QUERY_RESULT):
+                self.hidden.discard(key)
+            else:
+                self.hidden.add(key)
+
+        box = np.matmul(M, np.matmul(translationMatrix(box_min), scaleMatrix(np.subtract(box_max, box_min))))
+
+        # a box cut by the near plane would lose the faces in front of the camera, and could look hidden
+        if self.crosses_near_plane(box):
+            self.hidden.discard(key)
+            return True
+
+        self.draw_box(query, box)
+        self.pending.add(key)
+        self.issued.add(key)
+        self.tested += 1
+
+        if key in self.hidden:
+            self.culled += 1
+            return False
+        return True
+
+    def crosses_near_plane(self, box):
+        '''
+        Returns whether a corner of the unit cube transformed by box is closer than the near plane.
+        '''
+        VM = np.matmul(self.scene.camera.V, box)
+        depths = -(np.dot(BOX_VERTICES, VM[2, :3]) + VM[2, 3])
+        # near distance, from the depth terms of the projection
+        P = self.scene.P
+        return np.min(depths) <= P[2, 3] / (P[2, 2] - 1.)
+
+    def draw_box(self, query, box):
+        '''
+        Counts the samples of the box passing the depth test, without changing the colour or depth buffers.
+        '''
+        self.scene.shaders_list['Depth'].bind(P=self.scene.P, V=self.scene.camera.V, M=box,
+                                             PV=self.scene.camera.PV)
+
+        gl.glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        gl.glDepthMask(GL_FALSE)
+        # the inside of the box is seen if the front faces are clipped by the far plane
+        gl.glDisable(GL_CULL_FACE)
+
+        gl.glBindVertexArray(self.vao)
+        gl.glBeginQuery(self.target, query)
+        gl.glDrawElements(GL_TRIANGLES, BOX_INDICES.size, GL_UNSIGNED_INT, None)
+        gl.glEndQuery(self.target)
+        gl.glBindVertexArray(0)
+
+        gl.glEnable(GL_CULL_FACE)
+        gl.glDepthMask(GL_TRUE)
+        gl.glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+
+    def begin_conditional(self, key):
+        '''
+        Starts drawing an object that passed test(): the GPU discards the draw calls by itself if the query
+        sent this frame is finished and found the box hidden.
+        '''
+        if key in self.issued:
+            gl.glBeginConditionalRender(self.queries[key], GL_QUERY_NO_WAIT)
+
+    def end_conditional(self, key):
+        if key in self.issued:
+            gl.glEndConditionalRender()
+
+    def release(self, key):
+        '''
+        Deletes the query of an object that will not be drawn again.
+        '''
+        query = self.queries.pop(key, None)
+        if query is not None:
+            gl.glDeleteQueries(1, [query])
+        self.pending.discard(key)
+        self.hidden.discard(key)
+        self.issued.discard(key)
+
+    def delete(self):
+        if self.queries:
+            gl.glDeleteQueries(len(self.queries), list(self.queries.values()))
+        self.queries = {}
+        self.pending.clear()
+        self.hidden.clear()
+        if self.vao is not None:
+            gl.glDeleteBuffers(2, self.vbos)
+            gl.glDeleteVertexArrays(1, [self.vao])
+            self.vao = None
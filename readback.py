@@ -0,0 +1,251 @@
+import ctypes
+import logging
+import os
+import queue
+import threading
+
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+'''
+Reading rendered frames back to the CPU without stalling the render loop. glReadPixels into a pixel buffer
+object returns immediately: the copy happens on the GPU once the frame is finished. The buffer is only
+mapped a few frames later, when the copy is done, and the frames are written to disk on another thread, as
+image files or raw video.
+'''
+
+
+class AsyncReadback:
+    '''
+    Ring of pixel buffer objects. Each call to read() starts copying the current frame into the next buffer
+    of the ring, and returns the frame copied latency frames before, if any.
+    '''
+
+    def __init__(self, width, height, latency=2):
+        '''
+        :param width, height: The size of the frames, in pixels
+        :param latency: The number of frames between the start of a copy and the mapping of its buffer
+        '''
+        self.width = width
+        self.height = height
+        self.latency = latency
+
+        # RGBA rows are always aligned, and match the layout of the framebuffer on most drivers
+        self.nbytes = width * height * 4
+
+        self.pbos = gl.glGenBuffers(latency + 1)
+        for pbo in self.pbos:
+            gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            gl.glBufferData(GL_PIXEL_PACK_BUFFER, self.nbytes, None, GL_STREAM_READ)
+        gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        # tag of the frame held by each buffer, None if the buffer is free
+        self.tags = [None] * len(self.pbos)
+        self.index = 0
+
+    def read(self, tag):
+        '''
+        Starts reading the current framebuffer.
+        :param tag: Any value identifying the frame, returned with its pixels
+        :return: A list of the (tag, pixels) finished, pixels being a (height, width, 4) uint8 array, bottom row first
+        '''
+        gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[self.index])
+        gl.glPixelStorei(GL_PACK_ALIGNMENT, 4)
+        gl.glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.tags[self.index] = tag
+        self.index = (self.index + 1) % len(self.pbos)
+
+        # the oldest buffer of the ring is the one started latency frames ago
+        finished = self.map(self.index)
+        return [] if finished is None else [finished]
+
+    def map(self, index):
+        '''
+        Copies the content of a buffer of the ring, and frees it.
+        :return: (tag, pixels), or None if the buffer is free
+        '''
+        tag = self.tags[index]
+        if tag is None:
+            return None
+
+        gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[index])
+        address = gl.glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.nbytes, GL_MAP_READ_BIT)
+        pixels = np.frombuffer((ctypes.c_ubyte * self.nbytes).from_address(address), np.uint8).copy()
+        gl.glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        gl.glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+        self.tags[index] = None
+        return tag, pixels.reshape(self.height, self.width, 4)
+
+    def flush(self):
+        '''
+        Waits for all the frames being read.
+        :return: The list of (tag, pixels) not returned yet, oldest first
+        '''
+        finished = []
+        for i in range(len(self.pbos)):
+            frame = self.map((self.index + i) % len(self.pbos))
+            if frame is not None:
+                finished.append(frame)
+        return finished
+
+    def delete(self):
+        gl.glDeleteBuffers(len(self.pbos), self.pbos)
+
+
+def save_image(file_name, pixels):
+    '''
+    Saves RGBA pixels read from OpenGL (bottom row first) to an image file, in the format of its extension.
+    The alpha channel is dropped: the shaders only write colours.
+    '''
+    # pygame is slow to import, and only needed to encode images
+    import pygame
+
+    pixels = np.ascontiguousarray(pixels[::-1, :, :3])
+    surface = pygame.image.frombuffer(pixels.tobytes(), (pixels.shape[1], pixels.shape[0]), 'RGB')
+    pygame.image.save(surface, file_name)
+
+
+class FrameWriter:
+    '''
+    Writes frames on a background thread, in the order they are given. The queue is bounded, so that a slow
+    disk slows down the rendering instead of filling the memory.
+    '''
+
+    def __init__(self, max_queued=16):
+        self.queue = queue.Queue(max_queued)
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, name=self.__class__.__name__, daemon=True)
+        self.thread.start()
+
+    def write(self, tag, pixels):
+        '''
+        Queues a frame.
+        :param tag: The tag of the frame given to AsyncReadback.read()
+        :param pixels: The RGBA pixels, bottom row first
+        '''
+        self.queue.put((tag, pixels))
+
+    def encode(self, tag, pixels):
+        '''
+        Writes a frame, on the writer thread.
+        '''
+        raise NotImplementedError
+
+    def finish(self):
+        '''
+        Called on the writer thread after the last frame.
+        '''
+        pass
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.finish()
+                self.queue.task_done()
+                return
+            try:
+                self.encode(*item)
+                self.written += 1
+            except Exception as error:
+                logger.error('%s: cannot write frame %s: %s', self.__class__.__name__, item[0], error)
+            self.queue.task_done()
+
+    def wait(self):
+        '''
+        Waits until all the queued frames are written.
+        '''
+        self.queue.join()
+
+    def close(self):
+        '''
+        Writes the queued frames and stops the thread.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ImageWriter(FrameWriter):
+    '''
+    Writes each frame to its own image file, the tag of the frame being the file name.
+    '''
+
+    def encode(self, file_name, pixels):
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        save_image(file_name, pixels)
+
+
+class RawVideoWriter(FrameWriter):
+    '''
+    Appends the frames to a raw RGB video file, top row first, which costs no encoding at all. Convert it with eg
+    ffmpeg -f rawvideo -pixel_format rgb24 -video_size WIDTHxHEIGHT -framerate FPS -i capture.rgb capture.mp4
+    '''
+
+    def __init__(self, file_name, max_queued=16):
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(file_name, 'wb')
+        FrameWriter.__init__(self, max_queued)
+
+    def encode(self, tag, pixels):
+        self.file.write(np.ascontiguousarray(pixels[::-1, :, :3]).tobytes())
+
+    def finish(self):
+        self.file.close()
+
+
+class FrameCapture:
+    '''
+    Records the frames drawn in the window: each frame is read back asynchronously, and written by a
+    FrameWriter thread, so that recording costs little frame time.
+    '''
+
+    # files with these extensions are written as raw video, other paths are directories of images
+    RAW_EXTENSIONS = ('.rgb', '.raw')
+
+    def __init__(self, width, height, path, image_format='png'):
+        '''
+        :param width, height: The size of the window
+        :param path: A raw video file, or the directory of the images
+        :param image_format: The extension of the images
+        '''
+        self.path = path
+        self.readback = AsyncReadback(width, height)
+        if os.path.splitext(path)[1] in self.RAW_EXTENSIONS:
+            self.writer = RawVideoWriter(path)
+            self.pattern = None
+        else:
+            self.writer = ImageWriter()
+            self.pattern = os.path.join(path, 'frame_{:06d}.' + image_format)
+
+        self.frames = 0
+
+    def capture(self):
+        '''
+        Starts reading the frame drawn in the back buffer. Call this before swapping the buffers.
+        '''
+        tag = self.frames if self.pattern is None else self.pattern.format(self.frames)
+        self.frames += 1
+        for tag, pixels in self.readback.read(tag):
+            self.writer.write(tag, pixels)
+
+    def close(self):
+        '''
+        Writes the frames still being read, and stops the writer.
+        :return: The number of frames recorded
+        '''
+        for tag, pixels in self.readback.flush():
+            self.writer.write(tag, pixels)
+        self.writer.close()
+        self.readback.delete()
+        return self.frames
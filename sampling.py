@@ -0,0 +1,59 @@
+import numpy as np
+
+from simplify import triangulate
+
+'''
+Area uniform sampling of points on the surface of a mesh, used to place fur roots independently of
+the tessellation of the model.
+'''
+
+
+class SurfaceSampler:
+    '''
+    Draws random points uniformly over the area of a mesh. The cumulative area table is built once,
+    then any number of samples can be drawn in a single vectorised pass.
+    '''
+
+    def __init__(self, vertices, normals, indices):
+        '''
+        Builds the cumulative distribution of the triangle areas.
+        :param vertices: The (N, 3) vertex array of the mesh
+        :param normals: The (N, 3) per vertex normals, interpolated at the sampled points
+        :param indices: The (F, 3) or (F, 4) face index array. Quads are split into two triangles.
+        '''
+        self.vertices = np.asarray(vertices, dtype='f')
+        self.normals = np.asarray(normals, dtype='f')
+        self.triangles = np.asarray(triangulate(np.asarray(indices)), dtype=np.int64)
+
+        corners = self.vertices[self.triangles]
+        areas = 0.5 * np.linalg.norm(
+            np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+
+        self.area = float(np.sum(areas))
+        self.cdf = np.cumsum(areas, dtype=np.float64) / self.area
+
+    def sample(self, n, seed=None):
+        '''
+        Draws n stratified samples: the unit interval is split in n strata, each of which picks one
+        triangle from the area table, so that the samples cover the surface evenly.
+        :param n: The number of points to draw
+        :param seed: [optional] Seed of the random generator, for reproducible results
+        :return: The (n, 3) positions and (n, 3) unit normals of the samples
+        '''
+        rng = np.random.default_rng(seed)
+
+        # one uniform number per stratum selects the triangle
+        u = (np.arange(n) + rng.random(n)) / n
+        faces = np.minimum(np.searchsorted(self.cdf, u, side='right'), len(self.cdf) - 1)
+        triangles = self.triangles[faces]
+
+        # uniform barycentric coordinates over each triangle
+        r1 = np.sqrt(rng.random(n))
+        r2 = rng.random(n)
+        weights = np.stack((1. - r1, r1 * (1. - r2), r1 * r2), axis=1).astype('f')
+
+        positions = np.einsum('ij,ijk->ik', weights, self.vertices[triangles])
+        normals = np.einsum('ij,ijk->ik', weights, self.normals[triangles])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+        return positions, normals
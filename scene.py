@@ -3,9 +3,10 @@ import pygame
 
 # imports all openGL functions
 from OpenGL.GL import *
+from gldispatch import gl
 
 # import the shader class
-from shaders import Shaders, Uniform
+from shaders import Shaders, Uniform, CompactFurShader, ClusteredFurShader, ShellFurShader, DepthShader, ShaderRegistry
 
 # import the camera class
 from camera import Camera
@@ -15,19 +16,46 @@ from matutils import *
 
 from lightSource import LightSource
 
+from lights import LightManager
+
+from occlusion import OcclusionCuller
+
+from textures import TextureManager
+
+from readback import FrameCapture
+
 import random
 
+import time
+
+import os
+
+import logging
+
 from FurModel import FurModel
 
+from furcache import FurCache
+
+from furworker import FurWorker
+
+from shadercache import ShaderWatcher
+
+from log import startup
+
+logger = logging.getLogger(__name__)
+
 
 class Scene:
     """
     This is the main class for adrawing an OpenGL scene using the PyGame library
     """
 
-    def __init__(self, width=1920, height=1080, shaders=None):
+    def __init__(self, width=1920, height=1080, shaders=None, max_fps=60, idle=True, visible=True):
         """
         Initialises the scene
+        :param max_fps: The maximum number of frames drawn per second, None for no limit
+        :param idle: Whether to wait for input when nothing changes, instead of drawing continuously
+        :param visible: Whether to show the window, set to False to render off screen
         """
 
         self.window_size = (width, height)
@@ -38,43 +66,65 @@ class Scene:
         # the first two lines initialise the pygame window. You could use another library for this,
         # for example GLut or Qt
         pygame.init()
+        flags = pygame.OPENGL | pygame.DOUBLEBUF
+        if not visible:
+            flags |= pygame.HIDDEN
         screen = pygame.display.set_mode(
-            self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24
+            self.window_size, flags, 24
         )
 
         # Here we start initialising the window from the OpenGL side
-        glViewport(0, 0, self.window_size[0], self.window_size[1])
+        gl.glViewport(0, 0, self.window_size[0], self.window_size[1])
 
         # this selects the background color
-        glClearColor(0.7, 0.7, 1.0, 1.0)
+        gl.glClearColor(0.7, 0.7, 1.0, 1.0)
 
         # enable back face culling (see lecture on clipping and visibility
-        glEnable(GL_CULL_FACE)
+        gl.glEnable(GL_CULL_FACE)
         # depending on your model, or your projection matrix, the winding order may be inverted,
         # Typically, you see the far side of the model instead of the front one
         # uncommenting the following line should provide an easy fix.
         # glCullFace(GL_FRONT)
 
         # enable the vertex array capability
-        glEnableClientState(GL_VERTEX_ARRAY)
+        gl.glEnableClientState(GL_VERTEX_ARRAY)
 
         # enable depth test for clean output (see lecture on clipping & visibility for an explanation
-        glEnable(GL_DEPTH_TEST)
-
-        # dictionary of shaders used in this scene
-        self.shaders_list = {
-            # 'Phong': Shaders('phong'),# WS7
-            # 'Gouraud': Shaders('gouraud'),# WS6
-            # 'Flat': Shaders('flat'),# WS6
-            # 'Blinn': Shaders('blinn'), # WS7
-            "Fur": Shaders("fur")
-        }
+        gl.glEnable(GL_DEPTH_TEST)
+
+        # dictionary of shaders used in this scene, each is compiled when first used
+        self.shaders_list = ShaderRegistry({
+            # 'Phong': lambda: Shaders('phong'),# WS7
+            # 'Gouraud': lambda: Shaders('gouraud'),# WS6
+            # 'Flat': lambda: Shaders('flat'),# WS6
+            # 'Blinn': lambda: Shaders('blinn'), # WS7
+            "Fur": lambda: Shaders("fur"),
+            "FurCompact": CompactFurShader,
+            "FurClustered": ClusteredFurShader,
+            "FurShells": ShellFurShader,
+            "Depth": DepthShader,
+        })
+
+        # only the shader needed for the first frame is compiled now
+        self.shaders = self.shaders_list["Fur"]
 
-        # compile all shaders
-        for shader in self.shaders_list.values():
-            shader.compile()
+        # number of frames drawn so far
+        self.frame = 0
 
-        self.shaders = self.shaders_list["Fur"]
+        # the scene is only drawn again when something changed since the last frame
+        self.redraw = True
+        self.skipped_frames = 0
+
+        # frame pacing: see run()
+        self.idle = idle
+        self.max_fps = max_fps
+        self.next_frame_time = None
+
+        # while idle, the loop still wakes up regularly for the background work (fur, shader reloads)
+        self.idle_wake_interval = 0.1
+
+        # recompile shaders when their files are edited
+        self.shader_watcher = ShaderWatcher(self.shaders_list)
 
         # initialise the projective transform
         near = 1.5
@@ -88,17 +138,78 @@ class Scene:
         self.P = frustumMatrix(left, right, top, bottom, near, far)
 
         # initialises the camera object
-        self.camera = Camera(self.window_size)
+        self.camera = Camera(self.window_size, self.P)
 
         # initialise the light source
         self.light = LightSource(self, position=[5.0, 5.0, 5.0])
 
+        # all the lights of the scene. With more than one, the fur is drawn with clustered shading.
+        self.lights = LightManager([self.light])
+        self.lights.set_projection(self.P, self.window_size)
+
         # rendering mode for the shaders
         self.mode = 6  # initialise to full interpolated shading
 
         # This class will maintain a list of models to draw in the scene,
         self.models = []
 
+        # generated fur geometry, shared by all fur models
+        self.fur_cache = FurCache()
+
+        # image textures of the materials, decoded in the background
+        self.textures = TextureManager()
+
+        # fur models are rebuilt in the background when their parameters change
+        self.fur_worker = FurWorker()
+
+        # forces applied to the fur strands when dynamics are enabled, in world space
+        self.gravity = np.array([0.0, -2.0, 0.0], "f")
+        self.wind = np.array([1.5, 0.0, 0.5], "f")
+        self.wind_enabled = False
+
+        # processes simulating each fur model, leaving one core for rendering
+        self.fur_simulation_workers = max(1, (os.cpu_count() or 1) - 1)
+
+        # time of the last frame, for animations
+        self.last_time = time.perf_counter()
+
+        # the simulations advance by fixed steps, whatever the frame rate. The time not simulated yet
+        # is carried over to the next frame, and at most max_simulation_steps are run per frame so
+        # that a slow frame does not make the next one even slower.
+        self.simulation_timestep = 1.0 / 120.0
+        self.max_simulation_steps = 8
+        self.simulation_time = 0.0
+
+        # bytes of dynamic geometry sent to the GPU during the last frame
+        self.streamed_bytes = 0
+
+        # the last (model, face, point) picked with the mouse
+        self.picked = None
+
+        # the opaque models are drawn front to back, after filling the depth buffer if depth_prepass is set,
+        # so that hidden fragments are rejected before shading
+        self.depth_prepass = False
+        self.sort_models = True
+
+        # when set, the models whose bounding sphere is outside of the view frustum are not drawn at all
+        self.frustum_culling = True
+        self.frustum_culled = 0
+
+        # set to count the fragments shaded during the next frame, see measure_overdraw()
+        self.count_fragments = False
+        self.fragment_query = None
+        self.overdraw = None
+
+        # when set, models and clusters of fur strands hidden behind the models drawn before them are skipped.
+        # The visibility found by the occlusion queries of a frame is used by the next one: after a frame where
+        # something was culled, one more frame is drawn so that uncovered models reappear even when idle.
+        self.occlusion_culling = False
+        self.occlusion = OcclusionCuller(self)
+        self.occlusion_follow_up = False
+
+        # the FrameCapture recording the window, see start_capture()
+        self.capture = None
+
     def add_model(self, model):
         """
         This method just adds a model to the scene.
@@ -117,23 +228,301 @@ class Scene:
 
     def draw(self):
         """
-        Draw all models in the scene
-        :return: None
+        Draw all models in the scene, unless nothing changed since the last frame
+        :return: True if a new frame was drawn
         """
 
-        # first we need to clear the scene, we also clear the depth buffer to handle occlusions
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        if self.camera.update():
+            self.redraw = True
 
-        self.camera.update()
+        # swap in any shader edited since the last frame
+        if self.shader_watcher.apply():
+            self.redraw = True
+
+        # swap in any fur rebuilt in the background
+        self.update_fur_models()
+
+        # and upload the textures decoded since the last frame
+        if self.textures.update():
+            self.redraw = True
+
+        now = time.perf_counter()
+        dt = now - self.last_time
+        self.last_time = now
+
+        animated = self.animated()
+        if not animated:
+            self.simulation_time = 0.0
+
+        # whether this frame is only drawn to use the occlusion queries of the previous one
+        follow_up = self.occlusion_follow_up and not (self.redraw or animated or not self.idle)
+        self.occlusion_follow_up = False
+
+        if not (self.redraw or animated or not self.idle or follow_up):
+            # the last frame is still displayed
+            self.skipped_frames += 1
+            self.streamed_bytes = 0
+            if self.frame > 0:
+                self.shaders_list.precompile_next()
+            return False
+        self.redraw = False
+
+        # first we need to clear the scene, we also clear the depth buffer to handle occlusions
+        gl.glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        # assign the lights to the clusters of the view
+        if len(self.lights) > 1:
+            self.shaders = self.shaders_list["FurClustered"]
+            self.lights.update(self.camera.V)
+            self.lights.bind(self.shaders)
+        else:
+            self.shaders = self.shaders_list["Fur"]
+
+        # animate the fur
+        self.simulation_time += dt
+        steps = int(self.simulation_time / self.simulation_timestep)
+        self.simulation_time -= steps * self.simulation_timestep
+        steps = min(steps, self.max_simulation_steps)
+
+        wind = self.wind if self.wind_enabled else np.zeros(3, "f")
+        for model in self.fur_models():
+            model.step(self.simulation_timestep, self.gravity, wind, steps)
 
         # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw(Mp=poseMatrix(), shaders=self.shaders)
+        Mp = poseMatrix()
+        models = self.draw_order(Mp)
+
+        if self.depth_prepass:
+            # fill the depth buffer with the opaque models first
+            depth_shaders = self.shaders_list["Depth"]
+            gl.glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+            for model in models:
+                if model.opaque:
+                    model.draw_depth(Mp, depth_shaders)
+            gl.glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+
+            # then only the visible fragments pass the depth test
+            gl.glDepthFunc(GL_LEQUAL)
+
+        if self.count_fragments:
+            if self.fragment_query is None:
+                self.fragment_query = gl.glGenQueries(1)[0]
+            gl.glBeginQuery(GL_SAMPLES_PASSED, self.fragment_query)
+
+        # the box queries cannot be counted at the same time as the fragments of the frame
+        culler = self.occlusion if self.occlusion_culling and not self.count_fragments else None
+        if culler is not None:
+            culler.begin_frame()
+
+        for model in models:
+            if culler is None:
+                model.draw(Mp=Mp, shaders=self.shaders)
+            else:
+                model.draw_culled(Mp, self.shaders, culler)
+
+        if culler is not None:
+            # a frame drawn for a change is followed by one using its queries, and by more while they are running
+            self.occlusion_follow_up = culler.culled > 0 and (not follow_up or culler.waiting > 0)
+
+        if self.count_fragments:
+            gl.glEndQuery(GL_SAMPLES_PASSED)
+            self.overdraw = self.overdraw_statistics()
+            self.count_fragments = False
+
+        gl.glDepthFunc(GL_LESS)
+
+        self.streamed_bytes = sum(
+            stream.end_frame() for model in self.models for stream in model.streams.values()
+        )
+        # the frame is read from the back buffer before it is displayed
+        if self.capture is not None:
+            self.capture.capture()
+
         # once we are done drawing, we display the scene
         # Note that here we use double buffering to avoid artefacts:
         # we draw on a different buffer than the one we display,
         # and flip the two buffers once we are done drawing.
         pygame.display.flip()
+        self.frame += 1
+
+        # closes the GL call statistics of the frame, when the dispatch layer counts them
+        gl.end_frame()
+
+        if self.frame == 1:
+            startup.mark('first frame')
+            startup.report()
+
+        # once the first frame is shown, compile the other shaders one per frame
+        if self.frame > 1:
+            self.shaders_list.precompile_next()
+
+        return True
+
+    def add_random_lights(self, number):
+        """
+        Adds point lights of random colours around the origin.
+        :param number: The number of lights to add
+        """
+        for _ in range(number):
+            direction = np.random.normal(size=3)
+            position = direction / np.linalg.norm(direction) * np.random.uniform(1.0, 3.0)
+            color = np.random.uniform(0.2, 1.0, 3)
+            self.lights.add(LightSource(self, position=position, Ia=[0.0, 0.0, 0.0], Id=color,
+                                        Is=color, radius=np.random.uniform(1.0, 3.0)))
+
+    def draw_order(self, Mp):
+        """
+        Returns the models drawn this frame, in the order they are drawn: the opaque models first, then the others,
+        each sorted front to back by the depth of their bounding sphere so that the closest surfaces hide the others
+        early. With frustum_culling set, the models whose bounding sphere is outside of the view are left out.
+        :param Mp: The matrix of the parent of the models
+        """
+        V = self.camera.V
+        self.frustum_culled = 0
+
+        entries = []
+        for model in self.models:
+            center, radius = model.bounding_sphere()
+            if center is None:
+                entries.append((model, 0.0))
+                continue
+
+            M = np.matmul(Mp, model.M)
+            world_center = np.dot(M, homog(center))[:3]
+
+            # tested against the planes cached by the camera, the radius growing with the largest scale of the model
+            if self.frustum_culling and not self.camera.sphere_visible(
+                    world_center, radius * np.max(np.linalg.norm(M[:3, :3], axis=0))):
+                self.frustum_culled += 1
+                continue
+
+            # the depth only needs the third row of V
+            entries.append((model, -(np.dot(V[2, :3], world_center) + V[2, 3])))
+
+        if self.sort_models:
+            entries.sort(key=lambda entry: (not entry[0].opaque, entry[1]))
+        return [model for model, _ in entries]
+
+    def overdraw_statistics(self):
+        """
+        Reads the number of fragments shaded during the frame, and the number of pixels covered by the models.
+        :return: A dict with the fragments, the pixels and their ratio, the average number of times each pixel was shaded
+        """
+        fragments = gl.glGetQueryObjectuiv(self.fragment_query, GL_QUERY_RESULT)
+
+        depth = gl.glReadPixels(0, 0, self.window_size[0], self.window_size[1], GL_DEPTH_COMPONENT, GL_FLOAT)
+        pixels = int(np.count_nonzero(np.asarray(depth) < 1.0))
+
+        return {
+            "fragments": int(fragments),
+            "pixels": pixels,
+            "overdraw": float(fragments) / max(pixels, 1),
+        }
+
+    def measure_overdraw(self):
+        """
+        Draws a frame and returns its overdraw statistics, see overdraw_statistics().
+        """
+        self.count_fragments = True
+        self.redraw = True
+        self.draw()
+        return self.overdraw
+
+    def measure_gl_calls(self, mode='count'):
+        """
+        Draws a frame with the GL calls counted, see gldispatch.GLDispatch.end_frame().
+        :param mode: 'count', or 'record' to also keep the calls and their arguments
+        :return: The statistics of the frame
+        """
+        previous = gl.mode
+        gl.set_mode(mode)
+        try:
+            self.redraw = True
+            self.draw()
+        finally:
+            gl.set_mode(previous)
+        return gl.last_frame
+
+    def animated(self):
+        """
+        Returns whether some models are animated, and must be drawn every frame.
+        """
+        # a recording has one frame per frame interval, even when nothing moves
+        if self.capture is not None:
+            return True
+        return any(model.dynamics is not None for model in self.fur_models())
+
+    def start_capture(self, path=None):
+        """
+        Starts recording the frames drawn, see readback.FrameCapture.
+        :param path: [optional] A raw video file (.rgb) or a directory of images, by default a raw video file
+                     named after the current time in captures/
+        """
+        if self.capture is not None:
+            self.stop_capture()
+
+        if path is None:
+            path = os.path.join('captures', time.strftime('capture_%Y%m%d_%H%M%S.rgb'))
+        self.capture = FrameCapture(self.window_size[0], self.window_size[1], path)
+        logger.info("Recording to %s", path)
+
+    def stop_capture(self):
+        """
+        Stops recording, once the frames being read are written.
+        """
+        if self.capture is None:
+            return
+
+        capture = self.capture
+        self.capture = None
+        frames = capture.close()
+        if capture.pattern is None:
+            logger.info("Recorded %d frames to %s. Convert them with: ffmpeg -f rawvideo -pixel_format rgb24 "
+                        "-video_size %dx%d -framerate %g -i %s capture.mp4", frames, capture.path,
+                        self.window_size[0], self.window_size[1], self.max_fps or 60, capture.path)
+        else:
+            logger.info("Recorded %d frames to %s", frames, capture.path)
+
+    def fur_models(self):
+        """
+        Returns a copy of the list of fur models, so that they can be replaced while iterating.
+        """
+        # Only apply fur transformations if it is a fur model
+        return [model for model in self.models if type(model) is FurModel]
+
+    def replace_fur_model(self, model):
+        """
+        Requests a fur model to be re-created with its current parameters, so that it re-calculates vertices.
+        This happens in the background: the model keeps being drawn until the new one is ready.
+        :param model: The fur model whose parameters were changed
+        """
+        self.fur_worker.submit(model.slot, **model.parameters())
+
+    def update_fur_models(self):
+        """
+        Swaps in the fur models finished by the worker. Their buffers are uploaded here, in the OpenGL thread.
+        """
+        for slot, new_fur_model in self.fur_worker.collect():
+            for i, model in enumerate(self.models):
+                if getattr(model, "slot", None) is slot:
+                    # the displayed model holds the latest parameters, which may already be newer
+                    # than the ones of the finished model if another request is on its way.
+                    new_fur_model.fur_length = model.fur_length
+                    new_fur_model.fur_angle = model.fur_angle
+                    new_fur_model.fur_density = model.fur_density
+                    new_fur_model.fur_count = model.fur_count
+                    new_fur_model.compact = model.compact
+                    new_fur_model.technique = model.technique
+
+                    new_fur_model.bind()
+                    if model.dynamics is not None:
+                        model.disable_dynamics(reset=False)
+                        new_fur_model.enable_dynamics(self.fur_simulation_workers)
+                    self.models[i] = new_fur_model
+                    # release the buffers, streams and shells of the replaced model
+                    model.delete()
+                    self.redraw = True
+                    break
 
     def keyboard(self, event):
         if event.key == pygame.K_q:
@@ -154,133 +543,167 @@ class Scene:
 
         # Fur changes
         elif event.key == pygame.K_l:
-            for model in self.models:
-                # Only apply fur transformations if it is a fur model
-                if type(model) is FurModel:
-                    # Change the parameter in the existing fur model
-                    model.fur_length += 0.1
-                    # Create a copy so that it re-calculates vertices
-                    new_fur_model = FurModel(
-                        self,
-                        model.initial_vertices,
-                        model.initial_normals,
-                        model.initial_indices,
-                        model.fur_length,
-                        model.fur_angle,
-                        model.fur_density,
-                        model.M,
-                        model.material,
-                        model.primitive,
-                        model.visible,
-                    )
-                    # Add new fur model, remove old one.
-                    self.models.append(new_fur_model)
-                    self.models.remove(model)
-                    print(
-                        f"Increasing fur length to {new_fur_model.fur_length:.2f}")
+            for model in self.fur_models():
+                # Change the parameter in the existing fur model
+                model.fur_length += 0.1
+                # Create a copy so that it re-calculates vertices
+                self.replace_fur_model(model)
+                logger.info("Increasing fur length to %.2f", model.fur_length)
 
         elif event.key == pygame.K_k:
-            for model in self.models:
-                if type(model) is FurModel:
-                    model.fur_length -= 0.1
-                    new_fur_model = FurModel(
-                        self,
-                        model.initial_vertices,
-                        model.initial_normals,
-                        model.initial_indices,
-                        model.fur_length,
-                        model.fur_angle,
-                        model.fur_density,
-                        model.M,
-                        model.material,
-                        model.primitive,
-                        model.visible,
-                    )
-                    self.models.append(new_fur_model)
-                    self.models.remove(model)
-                    print(f"Decreasing fur length to {model.fur_length:.2f}")
+            for model in self.fur_models():
+                model.fur_length -= 0.1
+                self.replace_fur_model(model)
+                logger.info("Decreasing fur length to %.2f", model.fur_length)
 
         elif event.key == pygame.K_b:
-            for model in self.models:
-                if type(model) is FurModel:
-                    model.fur_angle = random.randrange(0, 30)
-                    new_fur_model = FurModel(
-                        self,
-                        model.initial_vertices,
-                        model.initial_normals,
-                        model.initial_indices,
-                        model.fur_length,
-                        model.fur_angle,
-                        model.fur_density,
-                        model.M,
-                        model.material,
-                        model.primitive,
-                        model.visible,
-                    )
-                    self.models.append(new_fur_model)
-                    self.models.remove(model)
-                    print(f"Randomising fur angle to {model.fur_angle}")
+            for model in self.fur_models():
+                model.fur_angle = random.randrange(0, 30)
+                self.replace_fur_model(model)
+                logger.info("Randomising fur angle to %s", model.fur_angle)
 
         elif event.key == pygame.K_m:
-            for model in self.models:
-                # if model.fur_density == 1:
-                #     print("Cannot increase fur density any further")
-                # else:
-                if type(model) is FurModel:
+            for model in self.fur_models():
+                # sampled fur can take any number of strands
+                if model.fur_count is not None:
+                    model.fur_count *= 2
+                    self.replace_fur_model(model)
+                    logger.info("Increasing fur count to %d", model.fur_count)
+                else:
                     model.fur_density += 1
-                    new_fur_model = FurModel(
-                        self,
-                        model.initial_vertices,
-                        model.initial_normals,
-                        model.initial_indices,
-                        model.fur_length,
-                        model.fur_angle,
-                        model.fur_density,
-                        model.M,
-                        model.material,
-                        model.primitive,
-                        model.visible,
-                    )
-                    self.models.append(new_fur_model)
-                    self.models.remove(model)
-                    print(f"Increasing fur density to {model.fur_density}")
+                    self.replace_fur_model(model)
+                    logger.info("Increasing fur density to %d", model.fur_density)
         elif event.key == pygame.K_n:
-            for model in self.models:
-                if type(model) is FurModel:
-                    if model.fur_density > 0:
-                        model.fur_density -= 1
-                        new_fur_model = FurModel(
-                            self,
-                            model.initial_vertices,
-                            model.initial_normals,
-                            model.initial_indices,
-                            model.fur_length,
-                            model.fur_angle,
-                            model.fur_density,
-                            model.M,
-                            model.material,
-                            model.primitive,
-                            model.visible,
-                        )
-                        self.models.append(new_fur_model)
-                        self.models.remove(model)
-                        print(f"Decreasing fur density to {model.fur_density}")
+            for model in self.fur_models():
+                if model.fur_count is not None:
+                    if model.fur_count > 1:
+                        model.fur_count = max(1, model.fur_count // 2)
+                        self.replace_fur_model(model)
+                        logger.info("Decreasing fur count to %d", model.fur_count)
                     else:
-                        print("Cannot decrease fur density any further.")
+                        logger.info("Cannot decrease fur count any further.")
+                elif model.fur_density > 0:
+                    model.fur_density -= 1
+                    self.replace_fur_model(model)
+                    logger.info("Decreasing fur density to %d", model.fur_density)
+                else:
+                    logger.info("Cannot decrease fur density any further.")
+        elif event.key == pygame.K_c:
+            for model in self.fur_models():
+                model.compact = not model.compact
+                self.replace_fur_model(model)
+                logger.info("Compact fur storage %s", 'on' if model.compact else 'off')
+
+        elif event.key == pygame.K_f:
+            for model in self.fur_models():
+                techniques = FurModel.TECHNIQUES
+                model.technique = techniques[(techniques.index(model.technique) + 1) % len(techniques)]
+                logger.info("Fur technique: %s", model.technique)
+
+        # Rendering statistics
+        elif event.key == pygame.K_z:
+            self.depth_prepass = not self.depth_prepass
+            logger.info("Depth pre-pass %s", 'on' if self.depth_prepass else 'off')
+
+        elif event.key == pygame.K_x:
+            self.occlusion_culling = not self.occlusion_culling
+            logger.info("Occlusion culling %s", 'on' if self.occlusion_culling else 'off')
+
+        elif event.key == pygame.K_r:
+            if self.capture is None:
+                self.start_capture()
+            else:
+                self.stop_capture()
+
+        elif event.key == pygame.K_v:
+            stats = self.measure_overdraw()
+            logger.info("%d fragments shaded for %d pixels: overdraw %.2f",
+                        stats["fragments"], stats["pixels"], stats["overdraw"])
+
+        elif event.key == pygame.K_g:
+            logger.info("%s", gl.report(self.measure_gl_calls()))
+
+        # Fur dynamics
+        elif event.key == pygame.K_d:
+            for model in self.fur_models():
+                if model.dynamics is None:
+                    model.enable_dynamics(self.fur_simulation_workers)
+                    logger.info("Enabling fur dynamics")
+                else:
+                    model.disable_dynamics()
+                    logger.info("Disabling fur dynamics")
+
+        # Point lights
+        elif event.key == pygame.K_p:
+            self.add_random_lights(8)
+            logger.info("%d lights", len(self.lights))
+
+        elif event.key == pygame.K_o:
+            self.lights.lights = [self.light]
+            logger.info("Removed the point lights")
+
+        elif event.key == pygame.K_w:
+            self.wind_enabled = not self.wind_enabled
+            logger.info("Wind %s", 'on' if self.wind_enabled else 'off')
+
         # flag to switch wireframe rendering
         elif event.key == pygame.K_0:
             if self.wireframe:
-                print("--> Rendering using colour fill")
-                glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+                logger.info("--> Rendering using colour fill")
+                gl.glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
                 self.wireframe = False
             else:
-                print("--> Rendering using colour wireframe")
-                glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
+                logger.info("--> Rendering using colour wireframe")
+                gl.glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
                 self.wireframe = True
 
-    def pygameEvents(self):
+    def pick(self, x, y):
+        """
+        Casts a ray through a pixel against all models that have a BVH.
+        :param x: The horizontal pixel coordinate
+        :param y: The vertical pixel coordinate
+        :return: (model, face, point) for the closest hit, or None
+        """
+        # the ray goes from the near to the far clip plane, in normalised device coordinates
+        ndc_x = 2.0 * x / self.window_size[0] - 1.0
+        ndc_y = 1.0 - 2.0 * y / self.window_size[1]
+        near = np.array([ndc_x, ndc_y, -1.0, 1.0])
+        far = np.array([ndc_x, ndc_y, 1.0, 1.0])
+
+        # the camera may have moved since the last frame
+        self.camera.update()
+
+        best = None
+        t_max = np.inf
+        for model in self.models:
+            if getattr(model, "bvh", None) is None or not model.visible:
+                continue
+
+            # express the ray in model space, so that the distance t is the same for all models
+            inverse = np.matmul(np.linalg.inv(model.M), self.camera.PV_inverse)
+            origin = unhomog(np.dot(inverse, near))
+            direction = unhomog(np.dot(inverse, far)) - origin
+
+            hit = model.bvh.ray_cast(origin, direction, t_max)
+            if hit is not None:
+                t_max = hit[0]
+                best = (model, hit[1], origin + hit[0] * direction)
+
+        return best
+
+    def pygameEvents(self, events=None):
+        """
+        Handles the input events.
+        :param events: [optional] The events to handle, all pending events by default
+        """
+        if events is None:
+            events = pygame.event.get()
+
         # check whether the window has been closed
-        for event in pygame.event.get():
+        for event in events:
+            # any input may change the scene, and the window may need to be repainted
+            self.redraw = True
+
             if event.type == pygame.QUIT:
                 self.running = False
 
@@ -306,6 +729,14 @@ class Scene:
                     else:
                         self.camera.distance += 1
 
+                # middle click picks the model under the mouse
+                elif event.button == 2:
+                    self.picked = self.pick(*event.pos)
+                    if self.picked is None:
+                        logger.info("Nothing picked")
+                    else:
+                        logger.info("Picked face %d of %s", self.picked[1], self.picked[0].__class__.__name__)
+
             elif event.type == pygame.MOUSEMOTION:
                 if pygame.mouse.get_pressed()[0]:
                     if self.mouse_mvt is not None:
@@ -333,6 +764,30 @@ class Scene:
                 else:
                     self.mouse_mvt = None
 
+    def wait_next_frame(self):
+        """
+        Waits until it is time to draw the next frame, so that at most max_fps frames are drawn per second.
+        """
+        if not self.max_fps:
+            return
+
+        now = time.perf_counter()
+        period = 1.0 / self.max_fps
+        if self.next_frame_time is None or now - self.next_frame_time > period:
+            # first frame, or too late (eg after being idle): start the schedule again from now
+            self.next_frame_time = now + period
+            return
+
+        # time.sleep() may oversleep by a millisecond or more, so the end of the wait is spent polling
+        remaining = self.next_frame_time - now
+        if remaining > 0.002:
+            time.sleep(remaining - 0.002)
+        while time.perf_counter() < self.next_frame_time:
+            pass
+
+        # the frames follow a fixed schedule, so that the errors do not add up
+        self.next_frame_time += period
+
     def run(self):
         """
         Draws the scene in a loop until exit.
@@ -342,7 +797,21 @@ class Scene:
         self.running = True
         while self.running:
 
-            self.pygameEvents()
+            if self.idle and not (self.redraw or self.occlusion_follow_up or self.animated()):
+                # nothing to draw: sleep until the next input event
+                event = pygame.event.wait(int(1000 * self.idle_wake_interval))
+                events = [] if event.type == pygame.NOEVENT else [event] + pygame.event.get()
+                self.pygameEvents(events)
+            else:
+                self.pygameEvents()
 
             # otherwise, continue drawing
-            self.draw()
+            if self.draw():
+                self.wait_next_frame()
+
+        self.fur_worker.stop()
+        self.shader_watcher.stop()
+        self.textures.stop()
+        self.stop_capture()
+        for model in self.fur_models():
+            model.disable_dynamics(reset=False)
@@ -0,0 +1,176 @@
+import logging
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+# imports all openGL functions
+from OpenGL.GL import *
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+'''
+Cache of linked GLSL program binaries, and a watcher recompiling shader programs when their files change.
+'''
+
+
+class ProgramCache:
+    '''
+    Stores linked program binaries (glGetProgramBinary) on disk, keyed by the hash of the sources and
+    of the driver. Drivers may reject an old binary (eg after an update), in which case the program is
+    compiled again.
+    '''
+
+    def __init__(self, directory='cache/shaders'):
+        self.directory = directory
+        self.driver = None
+
+    def available(self):
+        try:
+            return bool(glGetProgramBinary) and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+        except Exception:
+            return False
+
+    def key(self, sources):
+        '''
+        Returns the cache key for a program.
+        :param sources: The list of GLSL sources of the program
+        '''
+        if self.driver is None:
+            self.driver = b'|'.join(glGetString(name) or b'' for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+
+        h = hashlib.sha1(self.driver)
+        for source in sources:
+            h.update(b'\0')
+            h.update(source.encode())
+        return h.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.directory, '{}.bin'.format(key))
+
+    def load(self, key):
+        '''
+        Creates a program from a cached binary.
+        :return: The program, or None if there is no usable binary
+        '''
+        if not os.path.exists(self.file_name(key)) or not self.available():
+            return None
+
+        with open(self.file_name(key), 'rb') as file:
+            data = file.read()
+
+        # the first 4 bytes hold the binary format
+        binary_format = int(np.frombuffer(data[:4], dtype=np.uint32)[0])
+        binary = np.frombuffer(data[4:], dtype=np.uint8)
+
+        program = glCreateProgram()
+        glProgramBinary(program, binary_format, binary, binary.size)
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            logger.warning('cached program binary %s was rejected by the driver', key)
+            glDeleteProgram(program)
+            return None
+
+        return program
+
+    def save(self, key, program):
+        '''
+        Stores the binary of a linked program.
+        '''
+        if not self.available():
+            return
+
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if length <= 0:
+            return
+
+        binary_length = GLsizei(0)
+        binary_format = GLenum(0)
+        binary = np.zeros(length, dtype=np.uint8)
+        glGetProgramBinary(program, length, binary_length, binary_format, binary)
+
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first so that a partial file is never read. Its name is unique, as the
+        # directory may be shared by several processes, eg the workers of batch.py
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(np.array([binary_format.value], dtype=np.uint32).tobytes())
+                file.write(binary[:binary_length.value].tobytes())
+            os.replace(temporary, self.file_name(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+class ShaderWatcher:
+    '''
+    Polls the files of a set of Shaders in a background thread. Changed files are read there, and the
+    programs are recompiled in the OpenGL thread when apply() is called.
+    '''
+
+    def __init__(self, shaders_list, interval=0.5):
+        '''
+        :param shaders_list: The dict of Shaders to watch
+        :param interval: Time between two checks, in seconds
+        '''
+        self.shaders_list = shaders_list
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.changed = {}
+
+        self.mtimes = {}
+        for shaders in self.shaders_list.values():
+            self.mtimes[shaders] = self.modification_times(shaders)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='ShaderWatcher', daemon=True)
+        self.thread.start()
+
+    def modification_times(self, shaders):
+        times = {}
+        for file_name in shaders.files.values():
+            if file_name is not None and os.path.exists(file_name):
+                times[file_name] = os.path.getmtime(file_name)
+        return times
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            for shaders in list(self.shaders_list.values()):
+                mtimes = self.modification_times(shaders)
+                if shaders not in self.mtimes:
+                    # added since the watcher started
+                    self.mtimes[shaders] = mtimes
+                    continue
+                if mtimes == self.mtimes[shaders]:
+                    continue
+                self.mtimes[shaders] = mtimes
+
+                try:
+                    sources = shaders.read_sources()
+                except OSError as error:
+                    logger.warning('ShaderWatcher: could not read %s shader: %s', shaders.name, error)
+                    continue
+
+                with self.lock:
+                    self.changed[shaders] = sources
+
+    def apply(self):
+        '''
+        Recompiles the programs whose files changed. Call this from the OpenGL thread.
+        :return: True if any program was reloaded
+        '''
+        with self.lock:
+            changed, self.changed = self.changed, {}
+
+        for shaders, sources in changed.items():
+            logger.info('Reloading %s shader', shaders.name)
+            shaders.reload(sources)
+        return len(changed) > 0
+
+    def stop(self):
+        self.running = False
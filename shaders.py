@@ -1,11 +1,21 @@
+import logging
+import threading
+
 # imports all openGL functions
 from OpenGL.GL import *
-from OpenGL.GLU import *
 from OpenGL.GL import shaders
+from gldispatch import gl
 from matutils import *
 # we will use numpy to store data in arrays
 import numpy as np
 
+from shadercache import ProgramCache
+
+logger = logging.getLogger(__name__)
+
+# linked programs are cached on disk, shared by all Shaders
+program_cache = ProgramCache()
+
 class Uniform:
     '''
     We create a simple class to handle uniforms, this is not necessary,
@@ -26,9 +36,9 @@ class Uniform:
         in the program from its name
         :param program: the GLSL program where the uniform is used
         '''
-        self.location = glGetUniformLocation(program=program, name=self.name)
+        self.location = gl.glGetUniformLocation(program=program, name=self.name)
         if self.location == -1:
-            print('(E) Warning, no uniform {}'.format(self.name))
+            logger.warning('no uniform %s', self.name)
 
     def bind_matrix(self, M=None, number=1, transpose=True):
         '''
@@ -41,18 +51,18 @@ class Uniform:
         if M is not None:
             self.value = M
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
-            glUniformMatrix4fv(self.location, number, transpose, self.value)
+            gl.glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
-            glUniformMatrix3fv(self.location, number, transpose, self.value)
+            gl.glUniformMatrix3fv(self.location, number, transpose, self.value)
         else:
-            print('(E) Error: Trying to bind as uniform a matrix of shape {}'.format(self.value.shape))
+            logger.error('Trying to bind as uniform a matrix of shape %s', self.value.shape)
 
     def bind(self, value=None):
         if value is not None:
             self.value = value
 
         if self.value is None:
-            print('(E) Error in Uniform.bind(): Invalid value: None')
+            logger.error('Uniform.bind(): Invalid value: None')
 
         if isinstance(self.value, int):
             self.bind_int()
@@ -66,39 +76,45 @@ class Uniform:
             else:
                 self.bind_matrix()
         else:
-            print('(E) Error in Uniform.bind() (Uniform: {}): Invalid value type {}'.format(self.name, type(value)))
+            logger.error('Uniform.bind() (Uniform: %s): Invalid value type %s', self.name, type(value))
             raise
 
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
 
-        glUniform1i(self.location, self.value)
+        gl.glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
 
-        glUniform1f(self.location, self.value)
+        gl.glUniform1f(self.location, self.value)
 
-    def bind_texture(self):
-        glUniform1i(self.location, 0)
+    def bind_texture(self, unit=None):
+        '''
+        Sets a sampler uniform to the texture unit its texture is bound to.
+        :param unit: [optional] The texture unit, the current value of the uniform by default
+        '''
+        if unit is not None:
+            self.value = unit
+        gl.glUniform1i(self.location, self.value if self.value is not None else 0)
 
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
 
         if self.value.shape[0] == 2:
-            glUniform2fv(self.location, 1, self.value)
+            gl.glUniform2fv(self.location, 1, self.value)
 
         elif self.value.shape[0] == 3:
-            glUniform3fv(self.location, 1, self.value)
+            gl.glUniform3fv(self.location, 1, self.value)
 
         elif self.value.shape[0] == 4:
-            glUniform4fv(self.location, 1, self.value)
+            gl.glUniform4fv(self.location, 1, self.value)
 
         else:
-            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(self.value.shape[0]))
+            logger.error('Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found %d', self.value.shape[0])
 
     def set(self, value):
         '''
@@ -111,6 +127,9 @@ class Shaders:
     '''
     This is the base class for loading and compiling the GLSL shaders.
     '''
+    # texture unit of the diffuse map, the others are used by the LightManager
+    TEXTURE_UNIT = 0
+
     def __init__(self, name=None, vertex_shader = None, fragment_shader = None, geometry_shader=None):
         '''
         Initialises the shaders
@@ -139,6 +158,19 @@ class Shaders:
             vertex_shader = 'shaders/{}/vertex_shader.glsl'.format(name)
             fragment_shader = 'shaders/{}/fragment_shader.glsl'.format(name)
             geometry_shader = f'shaders/{name}/geometry_shader.glsl'
+
+        # files the sources are read from, watched for hot reloading
+        self.files = {
+            'vertex': vertex_shader,
+            'fragment': fragment_shader,
+            'geometry': geometry_shader,
+        }
+
+        # attribute locations bound before linking, eg {'position': 0}
+        self.attribute_locations = {}
+
+        self.geometry_shader_source = ''
+
         # load the vertex shader GLSL code
         if vertex_shader is None:
             self.vertex_shader_source = '''
@@ -171,10 +203,10 @@ class Shaders:
                 }
             '''
         else:
-            print('Load vertex shader from file: {}'.format(vertex_shader))
+            logger.debug('Load vertex shader from file: %s', vertex_shader)
             with open(vertex_shader, 'r') as file:
                 self.vertex_shader_source = file.read()
-            print(self.vertex_shader_source)
+            logger.debug('%s', self.vertex_shader_source)
 
         # load the fragment shader GLSL code
         if fragment_shader is None:
@@ -189,67 +221,154 @@ class Shaders:
                 }
             '''
         else:
-            print('Load fragment shader from file: {}'.format(fragment_shader))
+            logger.debug('Load fragment shader from file: %s', fragment_shader)
             with open(fragment_shader, 'r') as file:
                 self.fragment_shader_source = file.read()
-            print(self.fragment_shader_source)
+            logger.debug('%s', self.fragment_shader_source)
         
         if geometry_shader is not None:
-            print(f'Load geometry shader from file: {geometry_shader}')
+            logger.debug('Load geometry shader from file: %s', geometry_shader)
             with open(geometry_shader, 'r') as file:
                 self.geometry_shader_source = file.read()
-            print(self.geometry_shader_source)
+            logger.debug('%s', self.geometry_shader_source)
             
 
     def add_uniform(self,name):
         self.uniforms[name] = Uniform(name)
 
+    def read_sources(self):
+        '''
+        Reads the GLSL code of all stages loaded from files.
+        :return: A dict of stage name -> source
+        '''
+        sources = {}
+        for stage, file_name in self.files.items():
+            if file_name is not None:
+                with open(file_name, 'r') as file:
+                    sources[stage] = file.read()
+        return sources
+
+    def link_program(self):
+        '''
+        Compiles and links the GLSL codes into a new program, whose binary can be retrieved for caching.
+        '''
+        stages = [
+            (self.vertex_shader_source, shaders.GL_VERTEX_SHADER),
+            (self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER),
+        ]
+        if self.geometry_shader_source != '':
+            stages.append((self.geometry_shader_source, shaders.GL_GEOMETRY_SHADER))
+
+        compiled = [shaders.compileShader(source, stage) for source, stage in stages]
+
+        program = gl.glCreateProgram()
+        if program_cache.available():
+            gl.glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+        for shader in compiled:
+            gl.glAttachShader(program, shader)
+        for name, location in self.attribute_locations.items():
+            gl.glBindAttribLocation(program, location, name)
+        gl.glLinkProgram(program)
+
+        for shader in compiled:
+            gl.glDetachShader(program, shader)
+            gl.glDeleteShader(shader)
+
+        if gl.glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            log = gl.glGetProgramInfoLog(program)
+            gl.glDeleteProgram(program)
+            raise RuntimeError('Link failure: {}'.format(log))
+
+        return program
+
+    def build_program(self):
+        '''
+        Returns a linked program, from the binary cache if the sources were already compiled with this driver.
+        '''
+        key = program_cache.key([
+            self.vertex_shader_source,
+            self.fragment_shader_source,
+            self.geometry_shader_source,
+            repr(sorted(self.attribute_locations.items())),
+        ])
+
+        program = program_cache.load(key)
+        if program is None:
+            program = self.link_program()
+            program_cache.save(key, program)
+        else:
+            logger.debug('Loaded %s program from the binary cache', self.name)
+        return program
+
     def compile(self):
         '''
         Call this function to compile the GLSL codes for both shaders.
         :return:
         '''
-        print('Compiling GLSL shaders...')
+        logger.debug('Compiling %s GLSL shaders...', self.name)
         try:
-            if self.geometry_shader_source is not '':
-                self.program = shaders.compileProgram(
-                    shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER),
-                    shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER),
-                    shaders.compileShader(self.geometry_shader_source, shaders.GL_GEOMETRY_SHADER)
-                )
-            else:
-                self.program = shaders.compileProgram(
-                    shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER),
-                    shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER),
-                )
+            self.program = self.build_program()
         except RuntimeError as error:
-            print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name, error)),
+            logger.error('An error occured while compiling %s shader:\n %s\n... forwarding exception...', self.name, error)
             raise error
 
-
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        gl.glUseProgram(self.program)
 
         # link all uniforms
         for uniform in self.uniforms:
             self.uniforms[uniform].link(self.program)
 
-    def bind(self, P, V, M, mode, light, material):
+    def reload(self, sources):
+        '''
+        Recompiles the program from new sources. If they do not compile, the current program is kept.
+        :param sources: A dict of stage name -> source, as returned by read_sources()
+        :return: True if the new program is in use
+        '''
+        previous = (self.vertex_shader_source, self.fragment_shader_source, self.geometry_shader_source)
+
+        self.vertex_shader_source = sources.get('vertex', self.vertex_shader_source)
+        self.fragment_shader_source = sources.get('fragment', self.fragment_shader_source)
+        self.geometry_shader_source = sources.get('geometry', self.geometry_shader_source)
+
+        try:
+            program = self.build_program()
+        except RuntimeError as error:
+            logger.error('Error while reloading %s shader, keeping the previous program:\n %s', self.name, error)
+            self.vertex_shader_source, self.fragment_shader_source, self.geometry_shader_source = previous
+            return False
+
+        gl.glDeleteProgram(self.program)
+        self.program = program
+
+        gl.glUseProgram(self.program)
+        for uniform in self.uniforms:
+            self.uniforms[uniform].link(self.program)
+        return True
+
+    def bind(self, P, V, M, mode, light, material, PV=None):
         '''
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
+        :param PV: [optional] The product of P and V, as cached by the camera
         '''
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        gl.glUseProgram(self.program)
+
+        if PV is None:
+            PV = np.matmul(P,V)
+
+        VM = np.matmul(V,M)
 
         # set the PVM matrix uniform
-        self.uniforms['PVM'].set(np.matmul(P,np.matmul(V,M)))
+        self.uniforms['PVM'].set(np.matmul(PV,M))
 
         # set the VM matrix uniform
-        self.uniforms['VM'].set(np.matmul(V,M))
+        self.uniforms['VM'].set(VM)
 
         # set the VMiT matrix uniform
-        self.uniforms['VMiT'].set(np.linalg.inv(np.matmul(V,M))[:3,:3].transpose())
+        # (VM is affine, so the upper 3x3 block of its inverse is the inverse of its upper 3x3 block)
+        self.uniforms['VMiT'].set(np.linalg.inv(VM[:3,:3]).transpose())
 
         # set the mode to the program
         self.uniforms['mode'].set(mode)
@@ -277,8 +396,15 @@ class Shaders:
         self.uniforms['Ks'].set(np.array(material.Ks, 'f'))
         self.uniforms['Ns'].set(material.Ns)
 
+        # shaders sampling the diffuse map declare a texture_map uniform
+        if 'texture_map' in self.uniforms:
+            texture_map = getattr(material, 'texture_map', None)
+            if texture_map is not None:
+                texture_map.bind(self.TEXTURE_UNIT)
+            self.uniforms['texture_map'].set(self.TEXTURE_UNIT)
+
     def unbind(self):
-        glUseProgram(0)
+        gl.glUseProgram(0)
 
     def set_mode(self, mode):
         self.uniforms['mode'].set(mode)
@@ -301,4 +427,145 @@ class BlinnShader(Shaders):
 
 class FurShader(Shaders):
     def __init__(self):
-        Shaders.__init__(self, name='fur')
\ No newline at end of file
+        Shaders.__init__(self, name='fur')
+
+class CompactFurShader(Shaders):
+    '''
+    Shader for fur stored with furcompact: decodes the quantized positions and octahedral normals.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, name='fur_compact')
+        self.add_uniform('bbox_min')
+        self.add_uniform('bbox_extent')
+
+        # the attribute locations must match the order in which BaseModel creates the VBOs
+        self.attribute_locations = {'position': 0, 'normal': 1}
+
+    def set_bounding_box(self, bmin, extent):
+        self.uniforms['bbox_min'].set(np.array(bmin, 'f'))
+        self.uniforms['bbox_extent'].set(np.array(extent, 'f'))
+
+
+class ClusteredFurShader(Shaders):
+    '''
+    Fur shader lit by all the lights of a LightManager: each fragment only evaluates the lights of its cluster.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, name='fur_clustered')
+
+        # the lights come from the texture buffers, only the ambient light is a uniform
+        for name in ('light', 'Id', 'Is'):
+            del self.uniforms[name]
+        for name in ('light_data', 'cluster_ranges', 'light_indices',
+                     'cluster_grid', 'tile_size', 'cluster_near', 'cluster_depth_scale'):
+            self.add_uniform(name)
+
+    def set_light_uniforms(self, light, V):
+        self.uniforms['Ia'].set(np.array(light.Ia, 'f'))
+
+    def set_clusters(self, lights):
+        '''
+        Sets the texture units and the cluster grid of a LightManager.
+        '''
+        for name, unit in zip(('light_data', 'cluster_ranges', 'light_indices'), lights.TEXTURE_UNITS):
+            self.uniforms[name].set(unit)
+        self.uniforms['cluster_grid'].set(np.array(lights.grid, 'f'))
+        self.uniforms['tile_size'].set(lights.tile_size)
+        self.uniforms['cluster_near'].set(float(lights.near))
+        self.uniforms['cluster_depth_scale'].set(float(lights.depth_scale))
+
+
+class ShellFurShader(Shaders):
+    '''
+    Shader for ShellFurModel: offsets each instance of the mesh to its shell, and masks out the space between
+    the strands of the shells and of the fins.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, name='fur_shells')
+        for name in ('fur_length', 'shell_count', 'strand_density', 'fins'):
+            self.add_uniform(name)
+
+        # the attribute locations must match the order of the buffers of ShellFurModel
+        self.attribute_locations = {'position': 0, 'normal': 1, 'fin_coord': 2, 'fin_normal': 3}
+
+    def set_fur(self, fur_length, shell_count, strand_density, fins):
+        self.uniforms['fur_length'].set(float(fur_length))
+        self.uniforms['shell_count'].set(int(shell_count))
+        self.uniforms['strand_density'].set(float(strand_density))
+        self.uniforms['fins'].set(int(fins))
+
+    def set_fins(self, fins):
+        '''
+        Switches between the shells and fins passes, once the program is bound.
+        '''
+        self.uniforms['fins'].bind(int(fins))
+
+
+class DepthShader(Shaders):
+    '''
+    Depth only shader, for the depth pre-pass.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, name='depth')
+        self.uniforms = {'PVM': Uniform('PVM')}
+        self.attribute_locations = {'position': 0}
+
+    def bind(self, P, V, M, mode=None, light=None, material=None, PV=None):
+        gl.glUseProgram(self.program)
+
+        if PV is None:
+            PV = np.matmul(P,V)
+
+        # same product as Shaders.bind, so that both passes compute the same depth
+        self.uniforms['PVM'].bind(np.matmul(PV,M))
+
+
+class ShaderRegistry:
+    '''
+    Dictionary of shader programs, each compiled the first time it is used.
+    '''
+    def __init__(self, factories=None):
+        '''
+        :param factories: [optional] A dict of name -> function returning a new (uncompiled) Shaders
+        '''
+        self.factories = dict(factories or {})
+        self.compiled = {}
+
+        # the programs are compiled in the OpenGL thread, and listed by the ShaderWatcher thread
+        self.lock = threading.Lock()
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+
+    def __getitem__(self, name):
+        if name not in self.compiled:
+            shaders = self.factories[name]()
+            shaders.compile()
+            with self.lock:
+                self.compiled[name] = shaders
+        return self.compiled[name]
+
+    def __contains__(self, name):
+        return name in self.factories
+
+    def values(self):
+        '''
+        Returns the programs compiled so far. Safe to call from another thread.
+        '''
+        with self.lock:
+            return list(self.compiled.values())
+
+    def pending(self):
+        return [name for name in self.factories if name not in self.compiled]
+
+    def precompile_next(self):
+        '''
+        Compiles one of the programs not used yet, so that they are ready before they are needed
+        without delaying the first frame.
+        :return: False once all programs are compiled
+        '''
+        pending = self.pending()
+        if not pending:
+            return False
+        self[pending[0]]
+        return True
@@ -0,0 +1,5 @@
+#version 130		// required to use OpenGL core standard
+
+// depth only pass: nothing to shade, only the depth buffer is written
+void main() {
+}
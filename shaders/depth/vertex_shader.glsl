@@ -0,0 +1,14 @@
+#version 130		// required to use OpenGL core standard
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+
+// the depth must be exactly the same as in the main pass
+invariant gl_Position;
+
+void main() {
+    gl_Position = PVM * vec4(position, 1.0f);
+}
@@ -16,6 +16,9 @@ uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
 uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
 uniform int mode;	// the rendering mode (better to code different shaders!)
 
+// the depth must be exactly the same as in the depth pre-pass
+invariant gl_Position;
+
 
 void main() {
     // 1. first, we transform the position using PVM matrix.
@@ -0,0 +1,70 @@
+#version 140 // required for texture buffers
+
+//=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
+in vec3 fragment_color;        // the fragment colour
+in vec3 position_view_space;   // the position in view coordinates of this fragment
+in vec3 normal_view_space;     // the normal in view coordinates to this fragment
+
+
+//=== 'out' attributes are the output image, usually only one for the colour of each pixel
+out vec3 final_color;
+
+//=== uniforms
+uniform int mode;	// the rendering mode (better to code different shaders!)
+
+// material uniforms
+uniform vec3 Ka;    // ambient reflection properties of the material
+uniform vec3 Kd;    // diffuse reflection propoerties of the material
+uniform vec3 Ks;    // specular properties of the material
+uniform float Ns;   // specular exponent
+
+// ambient light
+uniform vec3 Ia;
+
+// lights, packed by the LightManager
+uniform samplerBuffer light_data;       // 3 texels per light: view space position and radius, diffuse, specular
+uniform usamplerBuffer cluster_ranges;  // offset and count of the lights of each cluster in light_indices
+uniform usamplerBuffer light_indices;   // the lights of all clusters, one cluster after the other
+
+// cluster grid
+uniform vec3 cluster_grid;          // number of clusters along x, y and in depth
+uniform vec2 tile_size;             // size of a cluster on screen, in pixels
+uniform float cluster_near;         // depth of the first slice
+uniform float cluster_depth_scale;  // number of slices per unit of log(depth)
+
+
+///=== main shader code
+void main() {
+    vec3 camera_direction = -normalize(position_view_space);
+
+    // 1. find the cluster of the fragment, slices are spaced exponentially in depth
+    ivec3 grid = ivec3(cluster_grid);
+    ivec2 tile = clamp(ivec2(gl_FragCoord.xy / tile_size), ivec2(0), grid.xy - 1);
+    int slice = clamp(int(log(-position_view_space.z / cluster_near) * cluster_depth_scale), 0, grid.z - 1);
+    int cluster = (slice * grid.y + tile.y) * grid.x + tile.x;
+    uvec2 range = texelFetch(cluster_ranges, cluster).xy;
+
+    // 2. sum the Blinn-Phong shading of the lights of the cluster
+    vec3 color = Ia*Ka;
+    for (uint k = 0u; k < range.y; k++) {
+        int i = int(texelFetch(light_indices, int(range.x + k)).x);
+        vec4 light = texelFetch(light_data, 3*i);
+        vec3 Id = texelFetch(light_data, 3*i + 1).rgb;
+        vec3 Is = texelFetch(light_data, 3*i + 2).rgb;
+
+        vec3 light_direction = normalize(light.xyz - position_view_space);
+        vec3 halfway = normalize(light_direction + camera_direction);
+
+        vec3 diffuse = Id*Kd*max(0.0f, dot(light_direction, normal_view_space));
+        vec3 specular = Is*Ks*pow(max(0.0f, dot(halfway, normal_view_space)), 4*Ns);
+
+        // same attenuation as the fur shader, smoothly brought to zero at the radius of the light
+        float dist = length(light.xyz - position_view_space);
+        float attenuation = min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
+        float window = clamp(1.0 - pow(dist/light.w, 4.0), 0.0, 1.0);
+
+        color += attenuation*window*window*(diffuse + specular);
+    }
+
+    final_color = color;
+}
@@ -0,0 +1,45 @@
+#version 130		// required to use OpenGL core standard
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the quantized position, normalised to [0,1] within the bounding box of the fur
+in vec2 normal;		// the octahedral encoded normal, normalised to [-1,1]
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 fragment_color;        // the output of the shader will be the colour of the vertex
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec3 normal_view_space;     // the normal of the vertex in view coordinates
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
+uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
+uniform int mode;	// the rendering mode (better to code different shaders!)
+
+uniform vec3 bbox_min;      // the corner of the bounding box the positions are quantized in
+uniform vec3 bbox_extent;   // the size of the bounding box
+
+
+// unfolds the octahedral encoding of a unit vector, see furcompact.octahedral_decode()
+vec3 decode_normal(vec2 p) {
+    vec3 n = vec3(p, 1.0f - abs(p.x) - abs(p.y));
+    if (n.z < 0.0f) {
+        n.xy = (1.0f - abs(p.yx)) * vec2(p.x >= 0.0f ? 1.0f : -1.0f, p.y >= 0.0f ? 1.0f : -1.0f);
+    }
+    return normalize(n);
+}
+
+
+void main() {
+    // 1. decode the attributes
+    vec3 decoded_position = bbox_min + position * bbox_extent;
+    vec3 decoded_normal = decode_normal(normal);
+
+    // 2. first, we transform the position using PVM matrix.
+    gl_Position = PVM * vec4(decoded_position, 1.0f);
+
+    // 3. calculate vectors used for shading calculations
+    position_view_space = vec3(VM*vec4(decoded_position,1.0f));
+    normal_view_space = normalize(VMiT*decoded_normal);
+
+    fragment_color = vec3(1.0f);
+}
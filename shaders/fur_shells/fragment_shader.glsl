@@ -0,0 +1,78 @@
+#version 140 // required for gl_InstanceID in the vertex shader
+
+//=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
+in vec3 position_view_space;   // the position in view coordinates of this fragment
+in vec3 normal_view_space;     // the normal in view coordinates to this fragment
+in vec3 root_position;         // the position on the base mesh
+in vec3 root_normal;
+in vec2 strand_coord;          // fins only: position along the edge and height
+in float height;               // height along the strands, in [0, 1]
+in float fin_facing;           // fins only: 1 on the silhouette
+
+
+//=== 'out' attributes are the output image, usually only one for the colour of each pixel
+out vec3 final_color;
+
+//=== uniforms
+uniform float strand_density;  // strands per unit of length
+uniform int fins;
+
+// material uniforms
+uniform vec3 Ka;    // ambient reflection properties of the material
+uniform vec3 Kd;    // diffuse reflection propoerties of the material
+uniform vec3 Ks;    // specular properties of the material
+uniform float Ns;   // specular exponent
+
+// light source
+uniform vec3 light; // light position in view space
+uniform vec3 Ia;    // ambient light properties
+uniform vec3 Id;    // diffuse properties of the light source
+uniform vec3 Is;    // specular properties of the light source
+
+
+// pseudo random number in [0, 1) for each cell of the strand grid
+float hash(vec3 cell) {
+    return fract(sin(dot(cell, vec3(12.9898, 78.233, 37.719))) * 43758.5453);
+}
+
+///=== main shader code
+void main() {
+    // 1. strand mask: each cell of a grid holds one strand of random length, thinning towards its tip
+    float strand_length;
+    float distance_to_strand;
+    if (fins == 1) {
+        // only the fins close to the silhouette are drawn, the shells cover the others
+        if (fin_facing < 0.5) discard;
+
+        float u = strand_coord.x*strand_density;
+        strand_length = 0.5 + 0.5*hash(vec3(floor(u), 0.0, 0.0));
+        distance_to_strand = abs(fract(u) - 0.5);
+    } else {
+        vec3 grid = root_position*strand_density;
+        strand_length = 0.5 + 0.5*hash(floor(grid));
+
+        // distance to the strand in the plane of the surface
+        vec3 offset = fract(grid) - 0.5;
+        distance_to_strand = length(offset - dot(offset, root_normal)*root_normal);
+    }
+
+    float tip = height/strand_length;
+    if (tip > 1.0 || distance_to_strand > 0.45*(1.0 - tip)) discard;
+
+    // 2. Blinn-Phong shading, as for the strands
+    vec3 camera_direction = -normalize(position_view_space);
+    vec3 light_direction = normalize(light - position_view_space);
+    vec3 halfway = normalize(light_direction + camera_direction);
+
+    vec3 ambient = Ia*Ka;
+    vec3 diffuse = Id*Kd*max(0.0f, dot(light_direction, normal_view_space));
+    vec3 specular = Is*Ks*pow(max(0.0f, dot(halfway, normal_view_space)), 4*Ns);
+
+    float dist = length(light - position_view_space);
+    float attenuation = min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
+
+    // 3. the inner shells are shadowed by the fur above them
+    float occlusion = mix(0.4, 1.0, height);
+
+    final_color = occlusion*(ambient + attenuation*(diffuse + specular));
+}
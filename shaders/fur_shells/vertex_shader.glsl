@@ -0,0 +1,47 @@
+#version 140		// required for gl_InstanceID
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position of the vertex on the base mesh
+in vec3 normal;		// the vertex normal, along which the shells are pushed
+in vec2 fin_coord;	// fins only: distance along the edge and height in [0, 1]
+in vec3 fin_normal;	// fins only: the normal of the plane of the fin
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec3 normal_view_space;     // the normal of the vertex in view coordinates
+out vec3 root_position;         // the position on the base mesh, where the strand mask is computed
+out vec3 root_normal;
+out vec2 strand_coord;          // fins only: position along the edge and height
+out float height;               // height of the fragment along the strands, in [0, 1]
+out float fin_facing;           // fins only: 1 when the fin faces the camera, ie on the silhouette
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
+uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
+uniform float fur_length;
+uniform int shell_count;
+uniform int fins;   // 1 while drawing the fins, 0 for the shells
+
+
+void main() {
+    if (fins == 1) {
+        height = fin_coord.y;
+        strand_coord = fin_coord;
+        vec3 view_direction = normalize(vec3(VM*vec4(position, 1.0f)));
+        fin_facing = abs(dot(normalize(VMiT*fin_normal), view_direction));
+    } else {
+        // one instance per shell
+        height = float(gl_InstanceID + 1) / float(shell_count);
+        strand_coord = vec2(0.0f);
+        fin_facing = 0.0f;
+    }
+
+    vec3 shell_position = position + normal*fur_length*height;
+    gl_Position = PVM * vec4(shell_position, 1.0f);
+
+    position_view_space = vec3(VM*vec4(shell_position, 1.0f));
+    normal_view_space = normalize(VMiT*normal);
+    root_position = position;
+    root_normal = normal;
+}
@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import heapq
+import os
+
+import numpy as np
+
+from mesh import Mesh
+
+logger = logging.getLogger(__name__)
+
+'''
+Quadric error mesh simplification (Garland & Heckbert, 1997), used to build a chain of
+level-of-detail (LOD) meshes from any Mesh. Far away models can then be drawn with a fraction
+of the triangles.
+'''
+
+# default fraction of the original triangles kept at each LOD level
+LOD_RATIOS = (0.5, 0.25, 0.1)
+
+
+def triangulate(faces):
+    '''
+    Returns a triangle index array. Quads are split along their first diagonal.
+    :param faces: An int array of 3 or 4 vertex indices per face
+    '''
+    if faces.shape[1] == 3:
+        return faces
+    return np.vstack((faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]))
+
+
+def face_quadrics(vertices, faces):
+    '''
+    Returns the fundamental error quadric of every triangle, weighted by its area.
+    :param vertices: The (N, 3) vertex array
+    :param faces: The (F, 3) triangle index array
+    :return: A (F, 4, 4) array of quadrics
+    '''
+    v0 = vertices[faces[:, 0]].astype(np.float64)
+    v1 = vertices[faces[:, 1]].astype(np.float64)
+    v2 = vertices[faces[:, 2]].astype(np.float64)
+
+    n = np.cross(v1 - v0, v2 - v0)
+    double_area = np.linalg.norm(n, axis=1, keepdims=True)
+    n = n / np.maximum(double_area, 1e-12)
+
+    # plane equation ax + by + cz + d = 0
+    p = np.hstack((n, -np.sum(n * v0, axis=1, keepdims=True)))
+
+    return 0.5 * double_area[:, :, None] * p[:, :, None] * p[:, None, :]
+
+
+def vertex_quadrics(vertices, faces):
+    '''
+    Returns the error quadric of every vertex, the sum over the quadrics of its faces.
+    '''
+    K = face_quadrics(vertices, faces)
+    Q = np.zeros((vertices.shape[0], 4, 4))
+    for j in range(3):
+        np.add.at(Q, faces[:, j], K)
+    return Q
+
+
+def collapse_cost(Q, a, b, positions):
+    '''
+    Finds the optimal position when collapsing the edge (a, b) and its quadric error.
+    Falls back to the best of the two end points and the midpoint if the quadric is singular.
+    :return: (cost, position)
+    '''
+    q = Q[a] + Q[b]
+
+    A = q.copy()
+    A[3] = [0., 0., 0., 1.]
+    if abs(np.linalg.det(A)) > 1e-10:
+        x = np.linalg.solve(A, [0., 0., 0., 1.])
+        return float(x @ q @ x), x[:3]
+
+    best = None
+    for candidate in (positions[a], positions[b], 0.5 * (positions[a] + positions[b])):
+        x = np.append(candidate, 1.)
+        cost = float(x @ q @ x)
+        if best is None or cost < best[0]:
+            best = (cost, candidate.copy())
+    return best
+
+
+def simplify_mesh(mesh, target_faces):
+    '''
+    Decimates a mesh by greedily collapsing the edge of lowest quadric error until at
+    most target_faces triangles remain.
+    :param mesh: The Mesh to simplify. Quads are triangulated first.
+    :param target_faces: The number of triangles to keep
+    :return: A new triangle Mesh sharing the material of the input one
+    '''
+    positions = np.array(mesh.vertices, dtype=np.float64)
+    faces = np.array(triangulate(mesh.faces), dtype=np.int64)
+
+    Q = vertex_quadrics(positions, faces)
+
+    face_alive = np.ones(faces.shape[0], dtype=bool)
+    vertex_alive = np.ones(positions.shape[0], dtype=bool)
+    version = np.zeros(positions.shape[0], dtype=np.int64)
+
+    vertex_faces = [set() for _ in range(positions.shape[0])]
+    for f, face in enumerate(faces):
+        for v in face:
+            vertex_faces[v].add(f)
+
+    def neighbours(v):
+        return {u for f in vertex_faces[v] for u in faces[f]} - {v}
+
+    def flips(v, other, x):
+        # collapsing must not flip the orientation of the faces that survive around v
+        for f in vertex_faces[v]:
+            if other in faces[f]:
+                continue
+            p = positions[faces[f]]
+            n0 = np.cross(p[1] - p[0], p[2] - p[0])
+            p = p.copy()
+            p[list(faces[f]).index(v)] = x
+            n1 = np.cross(p[1] - p[0], p[2] - p[0])
+            if np.dot(n0, n1) <= 0.:
+                return True
+        return False
+
+    # min-heap of candidate collapses, tagged with the vertex versions to discard stale entries
+    heap = []
+
+    def push(a, b):
+        cost, x = collapse_cost(Q, a, b, positions)
+        heapq.heappush(heap, (cost, a, b, version[a], version[b], tuple(x)))
+
+    edges = np.sort(np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+    for a, b in np.unique(edges, axis=0):
+        push(a, b)
+
+    n_faces = faces.shape[0]
+    while n_faces > target_faces and heap:
+        cost, a, b, va, vb, x = heapq.heappop(heap)
+        if not (vertex_alive[a] and vertex_alive[b]) or version[a] != va or version[b] != vb:
+            continue
+
+        x = np.array(x)
+        if flips(a, b, x) or flips(b, a, x):
+            continue
+
+        # merge b into a
+        for f in vertex_faces[b]:
+            if a in faces[f]:
+                # the face degenerates, remove it from all its vertices
+                face_alive[f] = False
+                n_faces -= 1
+                for v in faces[f]:
+                    if v != b:
+                        vertex_faces[v].discard(f)
+            else:
+                faces[f][faces[f] == b] = a
+                vertex_faces[a].add(f)
+
+        vertex_faces[b] = set()
+        vertex_alive[b] = False
+        positions[a] = x
+        Q[a] += Q[b]
+        version[a] += 1
+
+        # only the edges around a have changed
+        for n in neighbours(a):
+            push(min(a, n), max(a, n))
+
+    # compact the surviving vertices and faces
+    faces = faces[face_alive]
+    used, remap = np.unique(faces.flatten(), return_inverse=True)
+
+    return Mesh(
+        vertices=positions[used].astype('f'),
+        faces=remap.reshape(faces.shape).astype(np.uint32),
+        material=mesh.material
+    )
+
+
+def lod_cache_file(file_name):
+    '''
+    Returns the name of the file caching the LOD chain of an OBJ file, stored next to it.
+    '''
+    return os.path.splitext(file_name)[0] + '.lod.npz'
+
+
+def lod_key(vertices, faces, ratios):
+    '''
+    Returns a key identifying the LOD chain of a mesh: the hash of its vertex and face arrays, and the ratios.
+    '''
+    h = hashlib.sha1()
+    for array in (vertices, faces):
+        array = np.ascontiguousarray(array)
+        h.update(str((array.dtype, array.shape)).encode())
+        h.update(array.tobytes())
+    h.update(repr([round(float(ratio), 6) for ratio in ratios]).encode())
+    return h.hexdigest()
+
+
+def build_lod_chain(mesh, ratios=LOD_RATIOS, cache_file=None):
+    '''
+    Builds a chain of simplified meshes. Each level is decimated from the previous one.
+    :param mesh: The full resolution Mesh (level 0, not included in the returned list)
+    :param ratios: The fraction of the original triangles kept at each level
+    :param cache_file: [optional] An .npz file the chain is loaded from, or saved to if missing or outdated
+    :return: The list of LOD meshes, from finest to coarsest
+    '''
+    faces = triangulate(mesh.faces)
+
+    # the cache is only valid for the same source mesh and ratios
+    key = lod_key(mesh.vertices, faces, ratios)
+
+    if cache_file is not None and os.path.exists(cache_file):
+        data = np.load(cache_file)
+        # a cache file whose key differs is rebuilt
+        if str(data['key']) == key:
+            logger.debug('Loading LOD chain from cache file: %s', cache_file)
+            return [
+                Mesh(vertices=data['vertices_{}'.format(i)],
+                     faces=data['faces_{}'.format(i)],
+                     normals=data['normals_{}'.format(i)],
+                     material=mesh.material)
+                for i in range(len(ratios))
+            ]
+
+    lods = []
+    previous = mesh
+    for ratio in ratios:
+        logger.info('Simplifying mesh to %.0f%% of %d triangles', 100 * ratio, faces.shape[0])
+        previous = simplify_mesh(previous, int(ratio * faces.shape[0]))
+        lods.append(previous)
+
+    if cache_file is not None:
+        arrays = {'key': np.array(key)}
+        for i, lod in enumerate(lods):
+            arrays['vertices_{}'.format(i)] = lod.vertices
+            arrays['faces_{}'.format(i)] = lod.faces
+            arrays['normals_{}'.format(i)] = lod.normals
+        np.savez(cache_file, **arrays)
+        logger.debug('Saved LOD chain to cache file: %s', cache_file)
+
+    return lods
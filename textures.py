@@ -0,0 +1,273 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# imports all openGL functions
+from OpenGL.GL import *
+from gldispatch import gl
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+'''
+Image textures, decoded on a pool of threads and uploaded with mipmaps on the OpenGL thread.
+- textures are identified by the hash of their file content, so an image shared by several materials or
+  models, even under different file names, is decoded and uploaded once.
+- the textures are kept within a memory budget: above it, the least recently bound ones are deleted, and
+  loaded again the next time they are bound.
+'''
+
+
+def decode_image(data, name_hint=''):
+    '''
+    Decodes an image file to RGBA pixels, with the first row at the bottom as expected by OpenGL.
+    :param data: The content of the file
+    :param name_hint: The file name, whose extension tells the image format
+    :return: The (height, width, 4) uint8 array
+    '''
+    # pygame is slow to import, and only needed once a texture is loaded
+    import pygame
+
+    surface = pygame.image.load(io.BytesIO(data), name_hint)
+    pixels = pygame.image.tostring(surface, 'RGBA', True)
+    width, height = surface.get_size()
+    return np.frombuffer(pixels, np.uint8).reshape(height, width, 4)
+
+
+class TextureEntry:
+    '''
+    An image uploaded to an OpenGL texture, shared by all the Texture handles of files with the same content.
+    '''
+
+    def __init__(self, digest, path):
+        self.digest = digest
+        self.path = path
+        self.texture = None
+        self.width = 0
+        self.height = 0
+        # memory used by the texture and its mipmaps
+        self.nbytes = 0
+
+
+class Texture:
+    '''
+    Handle to an image file, loaded in the background by a TextureManager. Until the image is uploaded,
+    binding the handle does nothing.
+    '''
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.entry = None
+
+        # set if the file cannot be read or decoded
+        self.failed = False
+
+    @property
+    def ready(self):
+        return self.entry is not None and self.entry.texture is not None
+
+    def bind(self, unit=0):
+        '''
+        Binds the texture to a texture unit.
+        :return: False if the texture is not loaded (yet)
+        '''
+        if not self.ready:
+            # a texture evicted from the memory budget is loaded again
+            if self.entry is not None and not self.failed:
+                self.entry = None
+                self.manager.submit(self)
+            return False
+
+        gl.glActiveTexture(GL_TEXTURE0 + unit)
+        gl.glBindTexture(GL_TEXTURE_2D, self.entry.texture)
+        gl.glActiveTexture(GL_TEXTURE0)
+        self.manager.touch(self.entry)
+        return True
+
+
+class TextureManager:
+    '''
+    Loads the textures of a scene. Call update() once per frame on the OpenGL thread to upload the images
+    decoded since the last frame.
+    The textures are only bound, and so marked as used, when a shader declares a texture_map sampler: until one
+    does, the least recently bound textures evicted first are simply the first uploaded.
+    '''
+
+    def __init__(self, workers=2, max_bytes=256 * 1024 * 1024, max_uploads_per_frame=2):
+        '''
+        :param workers: The number of threads decoding images
+        :param max_bytes: The memory budget of the textures, mipmaps included
+        :param max_uploads_per_frame: The number of images uploaded per frame at most, to avoid long frames
+        '''
+        self.max_bytes = max_bytes
+        self.max_uploads_per_frame = max_uploads_per_frame
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='TextureDecoder')
+
+        # one handle per file
+        self.handles = {}
+
+        # uploaded textures by content hash, least recently bound first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        # hashes of the images decoded or being decoded, shared with the decoding threads
+        self.lock = threading.Lock()
+        self.decoding = set()
+
+        # futures of the decoding threads, and the handles waiting for an image decoded by another one
+        self.futures = []
+        self.waiting = {}
+
+        # decoded images not uploaded yet
+        self.decoded = []
+
+    def load(self, path):
+        '''
+        Returns the handle of an image file, and starts loading it the first time.
+        '''
+        path = os.path.normpath(path)
+        handle = self.handles.get(path)
+        if handle is None:
+            handle = Texture(self, path)
+            self.handles[path] = handle
+            self.submit(handle)
+        return handle
+
+    def load_material(self, material):
+        '''
+        Loads the diffuse map (map_Kd) of a material into material.texture_map, if it has one.
+        '''
+        if material.texture is not None and material.texture_map is None:
+            # material libraries often name maps that are not shipped with the model
+            if not os.path.exists(material.texture):
+                logger.debug('Texture %s of material %s not found', material.texture, material.name)
+                return None
+            material.texture_map = self.load(material.texture)
+        return material.texture_map
+
+    def submit(self, handle):
+        self.futures.append((handle, self.executor.submit(self.decode, handle.path)))
+
+    def decode(self, path):
+        '''
+        Reads and decodes an image, on a decoding thread.
+        :return: The hash of the file content, and the pixels or None if the same content is already decoded
+        '''
+        with open(path, 'rb') as file:
+            data = file.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        with self.lock:
+            if digest in self.decoding:
+                return digest, None
+            self.decoding.add(digest)
+
+        try:
+            return digest, decode_image(data, os.path.basename(path))
+        except Exception:
+            with self.lock:
+                self.decoding.discard(digest)
+            raise
+
+    def update(self):
+        '''
+        Uploads the images decoded since the last call, and evicts the textures above the memory budget.
+        :return: True if textures became ready
+        '''
+        running = []
+        for handle, future in self.futures:
+            if not future.done():
+                running.append((handle, future))
+                continue
+
+            try:
+                digest, pixels = future.result()
+            except Exception as error:
+                logger.warning('Cannot load texture %s: %s', handle.path, error)
+                handle.failed = True
+                continue
+
+            if digest in self.entries:
+                handle.entry = self.entries[digest]
+            else:
+                self.waiting.setdefault(digest, []).append(handle)
+                if pixels is not None:
+                    self.decoded.append((digest, handle.path, pixels))
+        self.futures = running
+
+        uploaded = False
+        for _ in range(min(self.max_uploads_per_frame, len(self.decoded))):
+            digest, path, pixels = self.decoded.pop(0)
+            entry = self.upload(digest, path, pixels)
+            for handle in self.waiting.pop(digest, []):
+                handle.entry = entry
+            uploaded = True
+
+        if uploaded:
+            self.evict()
+        return uploaded
+
+    def upload(self, digest, path, pixels):
+        '''
+        Creates the OpenGL texture of a decoded image, with its mipmaps.
+        '''
+        entry = TextureEntry(digest, path)
+        entry.height, entry.width = pixels.shape[:2]
+        # the mipmaps add a third to the size of the image
+        entry.nbytes = pixels.nbytes * 4 // 3
+
+        entry.texture = gl.glGenTextures(1)
+        gl.glBindTexture(GL_TEXTURE_2D, entry.texture)
+        gl.glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, entry.width, entry.height, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                        np.ascontiguousarray(pixels))
+        gl.glGenerateMipmap(GL_TEXTURE_2D)
+        gl.glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        gl.glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        gl.glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        gl.glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        gl.glBindTexture(GL_TEXTURE_2D, 0)
+
+        logger.debug('Uploaded texture %s (%dx%d)', path, entry.width, entry.height)
+
+        self.entries[digest] = entry
+        self.total_bytes += entry.nbytes
+        return entry
+
+    def touch(self, entry):
+        '''
+        Marks a texture as the most recently used.
+        '''
+        self.entries.move_to_end(entry.digest)
+
+    def evict(self):
+        '''
+        Deletes the least recently bound textures until the memory budget is met. The most recent one is kept
+        even if it is larger than the budget.
+        '''
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            digest, entry = self.entries.popitem(last=False)
+            logger.debug('Evicting texture %s', entry.path)
+            gl.glDeleteTextures([entry.texture])
+            entry.texture = None
+            self.total_bytes -= entry.nbytes
+            with self.lock:
+                self.decoding.discard(digest)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+
+    def delete(self):
+        for entry in self.entries.values():
+            gl.glDeleteTextures([entry.texture])
+            entry.texture = None
+        self.entries.clear()
+        self.total_bytes = 0
+        with self.lock:
+            self.decoding.clear()